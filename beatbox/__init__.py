@@ -3,4 +3,5 @@ from .vector import *
 from .do import *
 from .downloaders import *
 from .moving_windows import *
+from .clusters import *
 from .convex_hulls import *
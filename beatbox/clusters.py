@@ -0,0 +1,839 @@
+#!/usr/bin/env python2
+
+__author__ = "Kyle Taylor"
+__copyright__ = "Copyright 2018, Playa Lakes Joint Venture"
+__credits__ = ["Kyle Taylor", "Stephen Chang"]
+__license__ = "GPL"
+__version__ = "3"
+__maintainer__ = "Kyle Taylor"
+__email__ = "kyle.taylor@pljv.org"
+__status__ = "Testing"
+
+import os
+import shutil
+import tempfile
+import logging
+import numpy as np
+import pandas as pd
+import geopandas as gp
+import pyproj
+import shapely
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    FIRST_COMPLETED, wait, as_completed
+from functools import partial
+from itertools import islice
+from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+
+from beatbox.vector import Vector, _as_geometry_array, _hilbert_distance, \
+    _open_collection
+
+_DEFAULT_CHUNK_SIZE = 50000  # points per KD-tree query for large inputs
+_MAX_PENDING_PAIRS = 10000000  # linked pairs buffered between label merges
+_TILES_PER_WORKER = 4  # tiles per worker when clustering in parallel
+# scipy treats zero-weight edges as missing, so coincident points are linked
+# by an edge of this (negligible) length instead
+_MIN_EDGE_LENGTH = np.finfo(float).tiny
+# streaming (out-of-core) clustering -- see stream_cluster_points
+_STREAM_BAND_ROWS = 16  # grid cell rows per band of spilled points
+_STREAM_BUFFER_POINTS = 5000000  # points held in memory before bands spill
+_STREAM_DTYPE = np.dtype([('id', np.int64), ('x', np.float64),
+                          ('y', np.float64)])
+# ClusterIndex : default buffer width (in meters), and grid-hash keys (cells
+# are offset so keys stay positive)
+_DEFAULT_CLUSTER_WIDTH = 1000
+_GRID_OFFSET = 2 ** 30
+_GRID_STRIDE = 2 ** 31
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _point_coordinates(points=None):
+    """
+    Hidden function that will accept point features as an (n, 2) array of
+    coordinates, a Vector, a GeoDataFrame / GeoSeries, or an array of shapely
+    points and return an (n, 2) array of x, y coordinates
+    :param points: point features
+    :return: numpy array
+    """
+    # args[0] / points=
+    if points is None:
+        raise IndexError("invalid points= argument provided by user")
+    if isinstance(points, np.ndarray) and points.dtype != object:
+        if points.ndim != 2 or points.shape[1] < 2:
+            raise ValueError("points= coordinates should be an (n, 2) array")
+        return np.asarray(points[:, :2], dtype=float)
+    if isinstance(points, Vector):
+        _geometries = points.geometries
+    elif isinstance(points, (gp.GeoDataFrame, gp.GeoSeries)):
+        _geometries = np.asarray(points.geometry.values)
+    else:
+        _geometries = _as_geometry_array(points)
+    if not np.all(shapely.get_type_id(_geometries) == 0):
+        raise TypeError("points= should only contain (non-missing) "
+                        "Point geometries")
+    return shapely.get_coordinates(_geometries)
+
+
+def _canonical_labels(labels=None):
+    """
+    Renumber cluster labels 0..k-1 in order of the first (lowest index)
+    point of each cluster, so that labels don't depend on how the clusters
+    were found
+    """
+    _, _first, _inverse = np.unique(labels, return_index=True,
+                                    return_inverse=True)
+    _rank = np.empty(len(_first), dtype=np.int64)
+    _rank[np.argsort(_first)] = np.arange(len(_first))
+    return _rank[_inverse.ravel()]
+
+
+def _grid_labels(coords=None, distance=None):
+    """
+    Initial cluster labels from a grid of cells whose diagonal is distance=,
+    so that points sharing a cell are already (correctly) linked
+    """
+    if distance <= 0:
+        return np.arange(len(coords))
+    _cells = np.floor(
+        (coords - coords.min(axis=0)) / (distance / np.sqrt(2))
+    ).astype(np.int64)
+    _n_rows = int(_cells[:, 1].max()) + 1
+    # wide extents and small distances can overflow a packed int64 key, so
+    # we fall back on (slower) unique rows of cells
+    if (int(_cells[:, 0].max()) + 1) * _n_rows > np.iinfo(np.int64).max:
+        return np.unique(_cells, axis=0, return_inverse=True)[1].ravel()
+    _keys = _cells[:, 0] * _n_rows + _cells[:, 1]
+    return np.unique(_keys, return_inverse=True)[1].ravel()
+
+
+def _merge_label_pairs(labels=None, i=None, j=None):
+    """
+    Fold a batch of linked point pairs into our current cluster labels.
+    Pairs whose points already share a label are dropped before we solve for
+    connected components over our labels
+    """
+    _a, _b = labels[i], labels[j]
+    _linked = _a != _b
+    if not _linked.any():
+        return labels
+    _n = len(labels)
+    _adjacency = csr_matrix(
+        (np.ones(np.count_nonzero(_linked), dtype=bool),
+         (_a[_linked], _b[_linked])),
+        shape=(_n, _n)
+    )
+    _, _components = connected_components(_adjacency, directed=True,
+                                          connection='weak')
+    return _components[labels]
+
+
+def _point_tiles(coords=None, distance=None, n_tiles=None):
+    """
+    Generator that splits our points into about n_tiles rectangular tiles
+    of (roughly) equal point counts -- equal-count strips in x, each split
+    into equal-count cells in y -- and yields the ids of the points each
+    tile should cluster : the points it owns, plus every point within
+    distance= of their bounding box. Any two points within distance= of
+    each other are then clustered together by the tile that owns either
+    one, so tiles never miss a link across their edges
+    """
+    _n_x = int(np.ceil(np.sqrt(n_tiles)))
+    _n_y = int(np.ceil(n_tiles / _n_x))
+    _x_order = np.argsort(coords[:, 0], kind='stable')
+    _x = coords[_x_order, 0]
+    for _strip in np.array_split(_x_order, _n_x):
+        _strip = _strip[np.argsort(coords[_strip, 1], kind='stable')]
+        for _owned in np.array_split(_strip, _n_y):
+            if len(_owned) == 0:
+                continue
+            _min = coords[_owned].min(axis=0) - distance
+            _max = coords[_owned].max(axis=0) + distance
+            _ids = _x_order[np.searchsorted(_x, _min[0], side='left'):
+                            np.searchsorted(_x, _max[0], side='right')]
+            _y = coords[_ids, 1]
+            yield _ids[(_y >= _min[1]) & (_y <= _max[1])]
+
+
+def _cluster_tile(coords=None, ids=None, distance=None,
+                  chunk_size=_DEFAULT_CHUNK_SIZE):
+    """
+    Cluster the points of one tile and return the links we found as
+    (point id, point id) arrays -- a star from the first point of each
+    cluster to its other points
+    """
+    _labels = cluster_points(coords, distance, chunk_size=chunk_size)
+    _first = np.unique(_labels, return_index=True)[1][_labels]
+    _linked = _first != np.arange(len(_labels))
+    return ids[_linked], ids[_first[_linked]]
+
+
+def _tiled_cluster_points(coords=None, distance=None,
+                          chunk_size=_DEFAULT_CHUNK_SIZE, n_workers=None,
+                          backend="process", n_tiles=None):
+    """
+    Cluster our points tile-by-tile in a pool of workers and stitch the
+    clusters that cross tile edges together with a global union (connected
+    components over the links found by every tile). Labels are canonical,
+    so they match a single (untiled) run exactly
+    """
+    if backend not in ("thread", "process"):
+        raise ValueError("backend= should be 'thread' or 'process'")
+    _n = len(coords)
+    _function = partial(_cluster_tile, distance=distance,
+                        chunk_size=chunk_size)
+    _executor = ThreadPoolExecutor if backend == "thread" else \
+        ProcessPoolExecutor
+    _i, _j = [], []
+    with _executor(max_workers=n_workers) as pool:
+        _pending = set()
+
+        def _collect(futures):
+            for future in futures:
+                _links = future.result()
+                _i.append(_links[0])
+                _j.append(_links[1])
+
+        for _ids in _point_tiles(coords, distance,
+                                 n_tiles or _TILES_PER_WORKER * n_workers):
+            _pending.add(pool.submit(_function, coords[_ids], _ids))
+            # cap the number of tiles in flight at twice our worker count
+            if len(_pending) >= 2 * n_workers:
+                _done, _pending = wait(_pending, return_when=FIRST_COMPLETED)
+                _collect(_done)
+        _collect(as_completed(_pending))
+    return _canonical_labels(_merge_label_pairs(
+        np.arange(_n), np.concatenate(_i), np.concatenate(_j)
+    ))
+
+
+def cluster_points(points=None, distance=None, chunk_size=_DEFAULT_CHUNK_SIZE,
+                   n_workers=None, backend="process", n_tiles=None):
+    """
+    Single-linkage clustering of point features : two points share a cluster
+    if they are within distance= of each other, or are linked by a chain of
+    points that are. Pairs of nearby points are found with a KD-tree and
+    clusters are the connected components of the resulting sparse graph,
+    working directly on coordinate arrays. Points that share a grid cell
+    with a diagonal of distance= start out linked, so most pairs in dense
+    clusters never reach the graph solver. Inputs larger than chunk_size=
+    are queried in spatially coherent (Hilbert-ordered) chunks whose pairs
+    are folded into our labels as we go, so memory is bounded by the pairs
+    found for one chunk rather than for all of our points
+    :param arg1: (n, 2) array of coordinates, Vector, GeoDataFrame, or array of shapely points
+    :param arg2: linkage distance, in the units of our coordinates
+    :param points: Keyword specification for first positional arg
+    :param distance: Keyword specification for second positional arg
+    :param chunk_size: Number of points per KD-tree query for large inputs
+    :param n_workers: Cluster tiles of our points in a pool of this many
+    workers, stitching clusters that cross tile edges (labels are identical
+    to a single run)
+    :param backend: 'process' (default) or 'thread' pool for n_workers=
+    :param n_tiles: Number of tiles to split our points into with n_workers=
+    (defaults to four per worker)
+    :return: numpy array of cluster labels (0..k-1, numbered in order of
+    each cluster's first point)
+    """
+    # args[1] / distance=
+    if distance is None:
+        raise IndexError("invalid distance= argument provided by user")
+    _coords = _point_coordinates(points)
+    _n = len(_coords)
+    if _n == 0:
+        return np.zeros(0, dtype=np.int64)
+    if n_workers and n_workers > 1:
+        return _tiled_cluster_points(_coords, distance, chunk_size,
+                                     n_workers, backend, n_tiles)
+    _tree = cKDTree(_coords)
+    _labels = _grid_labels(_coords, distance)
+    if _n <= chunk_size:
+        _pairs = _tree.query_pairs(distance, output_type='ndarray')
+        return _canonical_labels(
+            _merge_label_pairs(_labels, _pairs[:, 0], _pairs[:, 1])
+        )
+    _order = np.argsort(_hilbert_distance(_coords), kind='stable')
+    # linked pairs are buffered and folded into our labels in batches
+    _pending_i, _pending_j, _n_pending = [], [], 0
+    for _start in range(0, _n, chunk_size):
+        _chunk = _order[_start:_start + chunk_size]
+        _pairs = cKDTree(_coords[_chunk]).sparse_distance_matrix(
+            _tree, distance, output_type='ndarray'
+        )
+        _i, _j = _chunk[_pairs['i']], _pairs['j']
+        # every pair is found from both of its points -- keep one, and only
+        # if it links points that we haven't already linked
+        _keep = (_j > _i) & (_labels[_i] != _labels[_j])
+        _pending_i.append(_i[_keep])
+        _pending_j.append(_j[_keep])
+        _n_pending += np.count_nonzero(_keep)
+        if _n_pending >= _MAX_PENDING_PAIRS or \
+                _start + chunk_size >= _n:
+            _labels = _merge_label_pairs(
+                _labels, np.concatenate(_pending_i),
+                np.concatenate(_pending_j)
+            )
+            _pending_i, _pending_j, _n_pending = [], [], 0
+    return _canonical_labels(_labels)
+
+
+def _minimum_spanning_forest(i=None, j=None, lengths=None, n=None):
+    """
+    Minimum spanning forest of a graph of n points given as edge arrays
+    :return: tuple of (i, j, length) arrays of our forest's edges
+    """
+    _forest = minimum_spanning_tree(csr_matrix(
+        (np.maximum(lengths, _MIN_EDGE_LENGTH), (i, j)), shape=(n, n)
+    )).tocoo()
+    return _forest.row.astype(np.int64), _forest.col.astype(np.int64), \
+        _forest.data
+
+
+def _spanning_forest(coords=None, max_distance=None,
+                     chunk_size=_DEFAULT_CHUNK_SIZE):
+    """
+    Euclidean minimum spanning forest of the graph that links points within
+    max_distance= of each other -- the single-linkage dendrogram of our
+    points, up to max_distance. Pairs are found in Hilbert-ordered chunks
+    (as in cluster_points) and folded into our forest in batches; an edge
+    that isn't in the forest of a subgraph can't be in the forest of the
+    whole graph, so memory is bounded by one batch of pairs plus the forest
+    :return: tuple of (i, j, length) arrays of our forest's edges
+    """
+    _n = len(coords)
+    _tree = cKDTree(coords)
+    _order = np.argsort(_hilbert_distance(coords), kind='stable')
+    _forest = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+               np.zeros(0))
+    _pending, _n_pending = [], 0
+    for _start in range(0, _n, chunk_size):
+        _chunk = _order[_start:_start + chunk_size]
+        _pairs = cKDTree(coords[_chunk]).sparse_distance_matrix(
+            _tree, max_distance, output_type='ndarray'
+        )
+        _i, _j = _chunk[_pairs['i']], _pairs['j']
+        # every pair is found from both of its points -- keep one
+        _once = _j > _i
+        _pending.append((_i[_once], _j[_once], _pairs['v'][_once]))
+        _n_pending += np.count_nonzero(_once)
+        if _n_pending >= _MAX_PENDING_PAIRS or _start + chunk_size >= _n:
+            _forest = _minimum_spanning_forest(*[
+                np.concatenate([_forest[k]] + [p[k] for p in _pending])
+                for k in range(3)
+            ], n=_n)
+            _pending, _n_pending = [], 0
+    return _forest
+
+
+def cluster_sweep(points=None, distances=None, chunk_size=_DEFAULT_CHUNK_SIZE):
+    """
+    Single-linkage clusters of our points (see cluster_points) at several
+    linkage distances. The minimum spanning forest of our points (up to the
+    largest distance) is built once from a KD-tree, and the clusters for
+    each distance are the connected components of the forest edges no
+    longer than it -- so each extra distance costs one cheap cut
+    :param arg1: (n, 2) array of coordinates, Vector, GeoDataFrame, or array of shapely points
+    :param arg2: list of linkage distances, in the units of our coordinates
+    :param points: Keyword specification for first positional arg
+    :param distances: Keyword specification for second positional arg
+    :param chunk_size: Number of points per KD-tree query
+    :return: dict of distance : numpy array of cluster labels (numbered as
+    in cluster_points)
+    """
+    # args[1] / distances=
+    if distances is None or len(distances) == 0:
+        raise IndexError("invalid distances= argument provided by user")
+    _coords = _point_coordinates(points)
+    _n = len(_coords)
+    if _n == 0:
+        return dict((d, np.zeros(0, dtype=np.int64)) for d in distances)
+    _i, _j, _lengths = _spanning_forest(_coords, max(distances), chunk_size)
+    _labels = {}
+    for _distance in distances:
+        _cut = _lengths <= _distance
+        _labels[_distance] = _canonical_labels(_merge_label_pairs(
+            np.arange(_n), _i[_cut], _j[_cut]
+        ))
+    return _labels
+
+
+def _iter_point_chunks(points=None, chunk_size=_DEFAULT_CHUNK_SIZE):
+    """
+    Generator over (feature ids, (n, 2) coordinates) chunks of point
+    features, in file order, from a vector file read with fiona (attributes
+    aren't decoded, for drivers that can ignore them) or from an (n, 2)
+    array / np.memmap. Features without a geometry are skipped
+    """
+    if not isinstance(points, str):
+        for _start in range(0, len(points), chunk_size):
+            _coords = np.asarray(points[_start:_start + chunk_size, :2],
+                                 dtype=float)
+            yield np.arange(_start, _start + len(_coords)), _coords
+        return
+    with _open_collection(points, include_fields=[]) as src:
+        _features = iter(src)
+        _start = 0
+        while True:
+            _geometries = [f.geometry for f in islice(_features, chunk_size)]
+            if not _geometries:
+                break
+            _ids = np.flatnonzero([g is not None for g in _geometries])
+            if any(_geometries[i].type != 'Point' for i in _ids):
+                raise ValueError("points= should only contain Point features")
+            yield _start + _ids, np.array(
+                [_geometries[i].coordinates[:2] for i in _ids], dtype=float
+            ).reshape(-1, 2)
+            _start += len(_geometries)
+
+
+def _spill_bands(points=None, distance=None, chunk_size=_DEFAULT_CHUNK_SIZE,
+                 band_rows=_STREAM_BAND_ROWS, work_dir=None):
+    """
+    Stream our points once, hashing each into a band of band_rows= rows of
+    grid cells (of size distance=) and appending it to that band's file
+    in work_dir=. Bands are buffered in memory up to _STREAM_BUFFER_POINTS
+    points before they are written
+    :return: tuple of (number of features read, sorted band keys)
+    """
+    _height = distance * band_rows
+    _buffered, _n_buffered, _bands, _n = {}, 0, set(), 0
+
+    def _flush():
+        for _band, _records in _buffered.items():
+            with open(os.path.join(work_dir, '%d.band' % _band), 'ab') as f:
+                np.concatenate(_records).tofile(f)
+        _buffered.clear()
+
+    for _ids, _coords in _iter_point_chunks(points, chunk_size):
+        _n = max(_n, int(_ids[-1]) + 1 if len(_ids) else 0)
+        _keys = np.floor(_coords[:, 1] / _height).astype(np.int64)
+        _order = np.argsort(_keys, kind='stable')
+        _keys = _keys[_order]
+        _starts = np.flatnonzero(np.r_[True, _keys[1:] != _keys[:-1]])
+        _records = np.empty(len(_ids), dtype=_STREAM_DTYPE)
+        _records['id'], _records['x'], _records['y'] = \
+            _ids[_order], _coords[_order, 0], _coords[_order, 1]
+        for _band, _chunk in zip(_keys[_starts],
+                                 np.split(_records, _starts[1:])):
+            _buffered.setdefault(int(_band), []).append(_chunk)
+            _bands.add(int(_band))
+        _n_buffered += len(_ids)
+        if _n_buffered >= _STREAM_BUFFER_POINTS:
+            _flush()
+            _n_buffered = 0
+    _flush()
+    # feature counts for files include trailing features without geometries
+    if isinstance(points, str):
+        with _open_collection(points, include_fields=[]) as src:
+            _n = len(src)
+    return _n, sorted(_bands)
+
+
+def _find_roots(parent=None, nodes=None):
+    """ roots of nodes= in our union-find by pointer jumping """
+    _roots = parent[nodes]
+    while True:
+        _next = parent[_roots]
+        if np.array_equal(_next, _roots):
+            return _roots
+        _roots = _next
+
+
+def _union(parent=None, a=None, b=None):
+    """
+    Union the sets of nodes a= and b= (element-wise) in our union-find. Each
+    merged set is rooted at its smallest root, so parents never point up
+    """
+    if len(a) == 0:
+        return
+    _roots = np.concatenate([_find_roots(parent, a), _find_roots(parent, b)])
+    _nodes, _inverse = np.unique(_roots, return_inverse=True)
+    _n = len(_nodes)
+    _half = len(a)
+    _components = connected_components(csr_matrix(
+        (np.ones(_half, dtype=bool), (_inverse[:_half], _inverse[_half:])),
+        shape=(_n, _n)
+    ), directed=True, connection='weak')[1]
+    # _nodes is sorted, so the first node of each component is its minimum
+    _smallest = np.full(_components.max() + 1, _n, dtype=np.int64)
+    np.minimum.at(_smallest, _components, np.arange(_n))
+    parent[_nodes] = _nodes[_smallest[_components]]
+
+
+def _runs(values=None):
+    """
+    Iterator over (value, start, stop) for each run of equal values in a
+    sorted array
+    """
+    _starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]]) \
+        if len(values) else np.zeros(0, dtype=np.int64)
+    _stops = np.append(_starts[1:], len(values))
+    return zip(values[_starts].tolist(), _starts.tolist(), _stops.tolist())
+
+
+class ClusterIndex(object):
+    def __init__(self, points=None, width=_DEFAULT_CLUSTER_WIDTH,
+                 filename=None):
+        """
+        Persistent fuzzy convex hull state for a growing point inventory.
+        Points are clustered as in fuzzy_convex_hull(method='kdtree') (i.e.,
+        single-linkage at 2 * width), and we keep a flat union-find over
+        point ids (every point points at the root id of its cluster) with
+        the members of each cluster, a grid-hash spatial index of per-cell
+        buckets, and the hull of each cluster. New points are inserted by
+        looking up existing points in neighboring grid cells, merging only
+        the clusters they touch, and rebuilding only those hulls -- so an
+        update costs about as much as its batch and the clusters it touches
+
+        Keyword arguments:
+        points= initial point features (filename, Vector, or GeoDataFrame,
+        which are reprojected to our default metric CRS, or an (n, 2) array
+        of metric coordinates)
+        width= buffer width (in meters) that defines our clusters
+        filename= restore a ClusterIndex previously saved with write()
+        """
+        self._distance = 2 * float(width)
+        self._crs = None
+        # point coordinates and parents are over-allocated as they grow;
+        # only the first _n rows are in use
+        self._n = 0
+        self._coords = np.zeros((0, 2))
+        self._parent = np.zeros(0, dtype=np.int64)
+        # root id -> member ids of each cluster
+        self._members = {}
+        # grid cell key -> ids of the points in that cell
+        self._cells = {}
+        # root id -> hull (Polygon) of each cluster
+        self._hulls = {}
+        # filename= / args[0] / points=
+        if filename is not None:
+            self.read(filename)
+        elif points is not None:
+            self.insert(points)
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def width(self):
+        """ buffer width (in meters) that defines our clusters """
+        return self._distance / 2
+
+    @property
+    def labels(self):
+        """ cluster (root point) id of each of our points """
+        return self._parent[:self._n]
+
+    @property
+    def hulls(self):
+        """ our convex hulls as a GeoDataFrame indexed by cluster id """
+        _ids = np.sort(np.fromiter(self._hulls, dtype=np.int64,
+                                   count=len(self._hulls)))
+        return gp.GeoDataFrame(
+            {'geometry': np.array([self._hulls[i] for i in _ids],
+                                  dtype=object)},
+            index=pd.Index(_ids, name='clst_id'),
+            crs=self._crs
+        )
+
+    def _cell_key(self, coords=None):
+        """ hash of the grid cell (of side distance) holding each point """
+        _cells = np.floor(coords / self._distance).astype(np.int64) + \
+            _GRID_OFFSET
+        return _cells[:, 0] * _GRID_STRIDE + _cells[:, 1]
+
+    def _neighbors(self, coords=None):
+        """ (query position, point id) pairs of existing points within our
+        linkage distance of each query point, found in the buckets of the
+        3 x 3 block of grid cells around it
+        """
+        _empty = np.zeros(0, dtype=np.int64)
+        if not self._cells:
+            return _empty, _empty
+        _keys, _inverse = np.unique(self._cell_key(coords),
+                                    return_inverse=True)
+        _offsets = np.array([i * _GRID_STRIDE + j for i in (-1, 0, 1)
+                             for j in (-1, 0, 1)], dtype=np.int64)
+        _buckets = [self._cells.get(k) for k in
+                    (_keys[:, None] + _offsets).ravel().tolist()]
+        _counts = np.array([0 if b is None else len(b) for b in _buckets],
+                           dtype=np.int64).reshape(-1, len(_offsets)).sum(1)
+        _starts = np.cumsum(_counts) - _counts
+        _counts = _counts[_inverse.ravel()]
+        _query = np.repeat(np.arange(len(coords)), _counts)
+        _positions = np.repeat(
+            _starts[_inverse.ravel()] - np.cumsum(_counts) + _counts, _counts
+        ) + np.arange(_counts.sum())
+        _ids = np.concatenate(
+            [b for b in _buckets if b is not None] + [_empty]
+        )[_positions]
+        _near = ((coords[_query] - self._coords[_ids]) ** 2).sum(axis=1) \
+            <= self._distance ** 2
+        return _query[_near], _ids[_near]
+
+    def _reserve(self, m=None):
+        """ make room for m= more points, doubling our arrays as needed """
+        if self._n + m <= len(self._parent):
+            return
+        _size = max(self._n + m, 2 * len(self._parent))
+        _coords = np.zeros((_size, 2))
+        _coords[:self._n] = self._coords[:self._n]
+        _parent = np.zeros(_size, dtype=np.int64)
+        _parent[:self._n] = self._parent[:self._n]
+        self._coords, self._parent = _coords, _parent
+
+    def _add_to_cells(self, ids=None, keys=None):
+        """ append point ids= to the buckets of their grid cells keys= """
+        _order = np.argsort(keys, kind='stable')
+        _ids = ids[_order]
+        for _key, _start, _stop in _runs(keys[_order]):
+            _bucket = self._cells.get(_key)
+            self._cells[_key] = _ids[_start:_stop] if _bucket is None else \
+                np.concatenate([_bucket, _ids[_start:_stop]])
+
+    def _cluster_members(self, root=None):
+        """ ids of the points in the cluster rooted at root= (clusters of a
+        single point aren't kept in our members map)
+        """
+        _members = self._members.get(root)
+        return np.array([root], dtype=np.int64) if _members is None \
+            else _members
+
+    def insert(self, points=None):
+        """ add points to our inventory, merging the clusters they link and
+        rebuilding the hulls of the clusters they touch
+
+        Keyword arguments:
+        points= point features (see ClusterIndex)
+        :return: sorted array of the (root) ids of the clusters that were
+        created or changed
+        """
+        # args[0] / points=
+        if points is None:
+            raise IndexError("invalid points= argument provided by user")
+        # convex_hulls imports this module, so its helpers are imported
+        # when we first need them
+        from beatbox.convex_hulls import _grouped_convex_hulls, _metric_points
+        if isinstance(points, (str, Vector, gp.GeoDataFrame)):
+            points = _metric_points(points)
+            if self._crs is None:
+                self._crs = points.crs
+        _coords = _point_coordinates(points)
+        _n, _m = self._n, len(_coords)
+        if _m == 0:
+            return np.zeros(0, dtype=np.int64)
+        _ids = np.arange(_n, _n + _m)
+        # links from new points to existing points, and the clusters of our
+        # new points among themselves (rooted at their first point)
+        _query, _near = self._neighbors(_coords)
+        _labels = cluster_points(_coords, self._distance)
+        _first = np.unique(_labels, return_index=True)[1]
+        self._reserve(_m)
+        self._coords[_n:_n + _m] = _coords
+        self._parent[_n:_n + _m] = _ids[_first[_labels]]
+        self._n += _m
+        _order = np.argsort(_labels, kind='stable')
+        _members = _ids[_order]
+        for _label, _start, _stop in _runs(_labels[_order]):
+            if _stop - _start > 1:
+                self._members[_n + int(_first[_label])] = \
+                    _members[_start:_stop]
+        self._add_to_cells(_ids, self._cell_key(_coords))
+        # union the clusters of linked points (merged clusters take the
+        # lowest root id) and point the members of every cluster we merge
+        # away straight at its new root
+        _roots = np.unique(np.concatenate([_ids[_first],
+                                           self._parent[_near]]))
+        _local = np.arange(len(_roots))
+        _union(_local, np.searchsorted(_roots, self._parent[_ids[_query]]),
+               np.searchsorted(_roots, self._parent[_near]))
+        _merged = _roots[_find_roots(_local, np.arange(len(_roots)))]
+        for _root, _new in zip(_roots.tolist(), _merged.tolist()):
+            self._hulls.pop(_root, None)
+            if _root != _new:
+                _members = self._cluster_members(_root)
+                self._members.pop(_root, None)
+                self._parent[_members] = _new
+                self._members[_new] = np.concatenate(
+                    [self._cluster_members(_new), _members]
+                )
+        # rebuild the hulls of every cluster we touched
+        _affected = np.unique(_merged)
+        _members = np.concatenate([self._cluster_members(i)
+                                   for i in _affected.tolist()])
+        _hull_ids, _hulls = _grouped_convex_hulls(self._coords[_members],
+                                                  self._parent[_members])
+        self._hulls.update(zip(_hull_ids.tolist(), _hulls))
+        return _affected
+
+    def write(self, filename=None):
+        """ save our state (points, union-find, spatial index, and hulls as
+        WKB) to a numpy .npz file that can be restored with
+        ClusterIndex(filename=...)
+        """
+        # args[0] / filename=
+        if filename is None:
+            raise IndexError("invalid filename= argument provided by user")
+        _hulls = self.hulls
+        _wkb = shapely.to_wkb(np.asarray(_hulls.geometry.values))
+        _lengths = np.array([len(b) for b in _wkb], dtype=np.int64)
+        # our cell buckets are saved as sorted keys and the ids in each
+        _keys = sorted(self._cells)
+        _buckets = [self._cells[k] for k in _keys]
+        np.savez(
+            filename,
+            distance=self._distance,
+            crs=np.array('' if self._crs is None else self._crs.to_wkt()),
+            coords=self._coords[:self._n],
+            parent=self.labels,
+            cell_keys=np.repeat(np.array(_keys, dtype=np.int64),
+                                [len(b) for b in _buckets]),
+            cell_order=np.concatenate(
+                _buckets + [np.zeros(0, dtype=np.int64)]
+            ),
+            hull_ids=np.asarray(_hulls.index, dtype=np.int64),
+            hull_offsets=np.concatenate([[0], np.cumsum(_lengths)]),
+            hull_wkb=np.frombuffer(b''.join(_wkb), dtype=np.uint8)
+        )
+
+    def read(self, filename=None):
+        """ restore our state from a file saved with write() """
+        # args[0] / filename=
+        if filename is None:
+            raise IndexError("invalid filename= argument provided by user")
+        with np.load(filename) as _state:
+            self._distance = float(_state['distance'])
+            _crs = str(_state['crs'])
+            self._crs = pyproj.CRS.from_wkt(_crs) if _crs else None
+            self._coords = _state['coords']
+            self._parent = _state['parent']
+            self._n = len(self._parent)
+            _cell_keys, _cell_order = _state['cell_keys'], _state['cell_order']
+            _hull_ids = _state['hull_ids']
+            _offsets, _wkb = _state['hull_offsets'], _state['hull_wkb']
+            _hulls = shapely.from_wkb(np.array(
+                [_wkb[_offsets[i]:_offsets[i + 1]].tobytes()
+                 for i in range(len(_hull_ids))], dtype=object
+            ))
+        self._cells = {_key: _cell_order[_start:_stop]
+                       for _key, _start, _stop in _runs(_cell_keys)}
+        _order = np.argsort(self._parent, kind='stable')
+        self._members = {_root: _order[_start:_stop]
+                         for _root, _start, _stop in
+                         _runs(self._parent[_order]) if _stop - _start > 1}
+        self._hulls = dict(zip(_hull_ids.tolist(), _hulls))
+
+
+def stream_cluster_points(points=None, distance=None,
+                          chunk_size=_DEFAULT_CHUNK_SIZE,
+                          band_rows=_STREAM_BAND_ROWS, work_dir=None,
+                          filename=None):
+    """
+    Out-of-core single-linkage clustering (see cluster_points) for point
+    sets that are too large to hold in memory -- e.g., rasterized pixel
+    centroids. Points are streamed from a vector file in chunks and hashed
+    into horizontal bands of grid cells (of size distance=) that are
+    spilled to disk. Bands are then clustered one at a time, in order, and
+    each is only compared with the edge of the band below it. Provisional
+    cluster ids are merged in a union-find that lives in a memory-mapped
+    file, and labels are written to a memory-mapped .npy file. Memory use
+    is bounded by the size of our densest band (which is read and
+    clustered whole), not by the size of points= -- lower band_rows= if a
+    band of dense points won't fit in memory
+    :param arg1: filename of a vector file of points, or an (n, 2) array or np.memmap of coordinates
+    :param arg2: linkage distance, in the units of our coordinates (i.e., 2 * width for fuzzy_convex_hull)
+    :param points: Keyword specification for first positional arg
+    :param distance: Keyword specification for second positional arg
+    :param chunk_size: Number of features read at a time
+    :param band_rows: Number of grid cell rows per band -- larger bands
+    mean fewer files but more points in memory at once
+    :param work_dir: directory for our spilled bands and union-find
+    (defaults to a temporary directory that is removed when we are done)
+    :param filename: .npy file to write our labels to (defaults to
+    labels.npy in work_dir=, or to memory if work_dir= is temporary)
+    :return: np.memmap of cluster labels (or a numpy array, if they were
+    kept in memory), one per feature in file order (numbered as in
+    cluster_points; -1 for features without a geometry)
+    """
+    # args[0] / points=
+    if points is None:
+        raise IndexError("invalid points= argument provided by user")
+    # args[1] / distance=
+    if distance is None or distance <= 0:
+        raise IndexError("invalid distance= argument provided by user")
+    _temporary = work_dir is None
+    work_dir = tempfile.mkdtemp() if _temporary else work_dir
+    _band_dir = tempfile.mkdtemp(dir=work_dir)
+    try:
+        _n, _bands = _spill_bands(points, distance, chunk_size, band_rows,
+                                  _band_dir)
+        # labels can't be mapped from a work_dir= we are about to remove
+        if filename is None and _temporary:
+            _labels = np.full(_n, -1, dtype=np.int64)
+        else:
+            _labels = np.lib.format.open_memmap(
+                filename or os.path.join(work_dir, 'labels.npy'), mode='w+',
+                dtype=np.int64, shape=(_n,)
+            )
+            _labels[:] = -1
+        # union-find over provisional cluster ids -- at most one per point
+        _parent = np.memmap(os.path.join(_band_dir, 'parent'), mode='w+',
+                            dtype=np.int64, shape=(max(_n, 1),))
+        _n_provisional, _edge, _previous = 0, None, None
+        for _band in _bands:
+            _records = np.fromfile(
+                os.path.join(_band_dir, '%d.band' % _band), dtype=_STREAM_DTYPE
+            )
+            _coords = np.column_stack([_records['x'], _records['y']])
+            _provisional = cluster_points(_coords, distance,
+                                          chunk_size=chunk_size) + _n_provisional
+            _n_cluster = _provisional.max() + 1 - _n_provisional
+            _parent[_n_provisional:_n_provisional + _n_cluster] = np.arange(
+                _n_provisional, _n_provisional + _n_cluster
+            )
+            _n_provisional += _n_cluster
+            _labels[_records['id']] = _provisional
+            # link across the edge we share with the band below us
+            _bottom = _band * distance * band_rows
+            _near = _coords[:, 1] < _bottom + distance
+            if _previous == _band - 1 and len(_edge[0]) and _near.any():
+                _pairs = cKDTree(_coords[_near]).sparse_distance_matrix(
+                    cKDTree(_edge[0]), distance, output_type='ndarray'
+                )
+                _union(_parent, _provisional[_near][_pairs['i']],
+                       _edge[1][_pairs['j']])
+            _top = _coords[:, 1] >= _bottom + distance * (band_rows - 1)
+            _edge, _previous = (_coords[_top], _provisional[_top]), _band
+            del _records, _coords
+        # resolve our provisional ids to their roots (parents never point
+        # up, so ascending chunks only depend on roots we've resolved)
+        for _start in range(0, _n_provisional, chunk_size):
+            _stop = min(_start + chunk_size, _n_provisional)
+            _parent[_start:_stop] = _find_roots(_parent, np.arange(_start, _stop))
+        # number our clusters in order of their first point
+        _first = np.memmap(os.path.join(_band_dir, 'first'), mode='w+',
+                           dtype=np.int64, shape=(max(_n_provisional, 1),))
+        _first[:] = _n
+        for _start in range(0, _n, chunk_size):
+            _chunk = np.asarray(_labels[_start:_start + chunk_size])
+            _valid = _chunk >= 0
+            np.minimum.at(_first, _parent[_chunk[_valid]],
+                          np.arange(_start, _start + len(_chunk))[_valid])
+        _roots = np.flatnonzero(_first[:_n_provisional] < _n)
+        _rank = _first  # reuse our file, since we're done with _first
+        _rank[_roots[np.argsort(_first[_roots], kind='stable')]] = \
+            np.arange(len(_roots))
+        for _start in range(0, _n, chunk_size):
+            _chunk = np.asarray(_labels[_start:_start + chunk_size])
+            _valid = _chunk >= 0
+            _chunk[_valid] = _rank[_parent[_chunk[_valid]]]
+            _labels[_start:_start + chunk_size] = _chunk
+        if isinstance(_labels, np.memmap):
+            _labels.flush()
+        del _parent, _first, _rank
+    finally:
+        shutil.rmtree(work_dir if _temporary else _band_dir,
+                      ignore_errors=True)
+    return _labels
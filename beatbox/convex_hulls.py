@@ -15,46 +15,39 @@ import numpy as np
 import geopandas as gp
 import pandas as pd
 import fiona
+import shapely
 
-from beatbox.vector import Vector, _local_rebuild_crs
-from beatbox.do import Backend, EE, Local, Do
+from beatbox.vector import Vector, points_in_polygons, _local_rebuild_crs, \
+    _local_reproject, _as_geometry_array, _overlap_groups, _union_groups
+from beatbox.do import Backend
+from beatbox.clusters import cluster_points, cluster_sweep, \
+    _point_coordinates
 
-from copy import copy
-from scipy.sparse.csgraph import connected_components
 
 _DEFAULT_EPSG = 2163
 _DEFAULT_BUFFER_WIDTH = 1000  # default width (in meters) of a geometry for various buffer operations
-_ARRAY_MAX = 2E6 # maximum array length to attempt numpy operations on before chunking
+_FUZZY_HULL_METHODS = ('buffer', 'kdtree')
+# directions (counter-clockwise) of the extreme points we use to discard
+# interior points before building convex hulls
+_HULL_DIRECTIONS = ((1, 0), (1, 1), (0, 1), (-1, 1),
+                    (-1, 0), (-1, -1), (0, -1), (1, -1))
+_HULL_DIRECTIONS_FINE = tuple(
+    (np.cos(a), np.sin(a)) for a in np.arange(16) * np.pi / 8
+)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def _split_in_chunks(*args):
-    """
-    Hidden function that will accept an array (list) and split it up into
-    chunks of an arbitrary length using the Python yield built-in
-    :param arg1: A list of things we wish to split into chunks
-    :return: Generator object
-    """
-    try:
-        _array = args[0]
-        _n_chunks = args[1]
-    except IndexError as e:
-        raise e
-    """Yield successive n-sized chunks from l."""
-    for i in range(0, len(_array), _n_chunks):
-        yield _array[i:i + _n_chunks]
-
-
 def _dissolve_overlapping_geometries(buffers=None):
     """
-    Hidden function that will accept a GeoDataFrame containing Polygons,
-    explode the geometries from single part to multi part, and then dissolve
-    geometries that overlap spatially. Implementation is robust for extremely
-    large GeoDataFrames. Proposed dropping this in the future. A better implementation
-    is already available upstream in GeoPandas
-    :param arg1: A GeoDataFrame or Vector object specifying source buffers 'groups' we intend to attribute with
+    Hidden function that will accept a GeoDataFrame containing Polygons and
+    dissolve geometries that intersect spatially into groups. Candidate pairs
+    of geometries are pulled from an STRtree and filtered with the exact
+    intersects predicate, and groups are the connected components of the
+    resulting sparse adjacency matrix -- so time and memory scale with the
+    number of intersecting pairs, rather than n**2
+    :param arg1: A GeoDataFrame, GeoSeries, or Vector object specifying source buffers 'groups' we intend to attribute with
     :param buffers: Keyword specification for first positional argument
     :return: GeoDataFrame
     """
@@ -62,60 +55,29 @@ def _dissolve_overlapping_geometries(buffers=None):
     if buffers is None:
         raise IndexError("invalid buffers= "
                          "argument provided by user")
-    # force casting as a GeoDataFrame
-    try:
-        _crs = buffers.crs # retain our original CRS
-        buffers = gp.GeoDataFrame({'geometry' : buffers})
-    except ValueError:
-        if isinstance(buffers, gp.GeoDataFrame):
-            pass
-        else:
+    # cast our buffers as an array of shapely geometries, retaining our CRS
+    if isinstance(buffers, Vector):
+        _crs = buffers._crs_wkt or buffers.crs or None
+        _geometries = buffers.geometries
+    elif isinstance(buffers, (gp.GeoDataFrame, gp.GeoSeries)):
+        _crs = buffers.crs
+        _geometries = np.asarray(buffers.geometry.values)
+    else:
+        _crs = None
+        try:
+            _geometries = _as_geometry_array(buffers)
+        except TypeError:
             raise ValueError("Invalid buffers= argument input -- failed to"
                              " make a GeoDataFrame from input provided")
-    except Exception:
-        raise Exception("Unable to cast buffers= argument (type:" + str(type(buffers)) + ") as a GeoDataFrame.")
-    # determine appropriate groupings for our overlapping buffers -- implementation may differ based
-    # on how large the original GeoDataFrame is
-    if buffers.size > _ARRAY_MAX:
-        split = int(round(buffers.size / _ARRAY_MAX) + 1)
-        logger.warning("Attempting intersect operation on a large "
-                       "vector dataset -- processing in %s chunks, "
-                       "which may lead to artifacts at boundaries. "
-                       "ETA: %s min",
-                       split, round((split*16.5**2)/60))
-        chunks = _split_in_chunks(buffers, split)
-        try:
-            # listcomp magic : for each geometry, determine whether it overlaps with
-            # all other geometries in this chunk
-            overlap_matrix = np.concatenate(
-                [ buffers.geometry.overlaps(d).values.astype(int) for i, d in enumerate(chunks) ]
-            )
-            # free-up our RAM
-            del chunks
-        except AttributeError as e:
-            raise AttributeError("Encountered an error when checking for overlaps in chunks of buffered input. "
-                                 "This shouldn't happen. Consider updating your libraries with conda/pip and try"
-                                 " again. Full attribute error: " + str(e))
-        # merge attributes
-        overlap_matrix.shape = (buffers.size, buffers.size)
-        n, ids = connected_components(overlap_matrix)
-        dissolved_buffers = gp.GeoDataFrame({
-            'geometry': buffers.geometry,
-            'group': ids
-        })
-        # call geopandas dissolve with our 'ids' column and
-        dissolved_buffers = dissolved_buffers.dissolve(by='group')
-        dissolved_buffers.crs = _crs
-    else:
-        # a sane default implementation used for most small GeoDataFrames
-        # this is mostly redundant -- a user can call unary_union directly
-        dissolved_buffers = buffers.geometry.unary_union
-        dissolved_buffers = gp.GeoDataFrame({
-            'geometry':dissolved_buffers,
-            'group':pd.Series(range(1,len(dissolved_buffers)+1))
-        })
-        dissolved_buffers.crs = _crs
-    return dissolved_buffers
+    # missing and empty geometries can't belong to any group
+    _geometries = _geometries[
+        ~(shapely.is_missing(_geometries) | shapely.is_empty(_geometries))
+    ]
+    _n_groups, _groups = _overlap_groups(_geometries)
+    return gp.GeoDataFrame({
+        'geometry': _union_groups(_geometries, _groups, _n_groups),
+        'group': np.arange(1, _n_groups + 1)
+    }, crs=_crs)
 
 
 def _spatial_join(buffers=None, points=None):
@@ -137,11 +99,15 @@ def _spatial_join(buffers=None, points=None):
     # explode and dissolve geometries
     gdf_out = _dissolve_overlapping_geometries(buffers)
     # ensure consistent CRS
-    gdf_out = gdf_out.to_crs(points.crs)
-    # return the right-sided spatial join
-    return gp.\
-        sjoin(points, gdf_out, how='inner', op='intersects').\
-        rename(columns={'index_right': 'clst_id'})
+    gdf_out = _local_reproject(gdf_out, points.crs)
+    # our dissolved groups don't overlap, so each point joins at most one
+    _clst_ids = points_in_polygons(points, np.asarray(gdf_out.geometry.values))
+    _joined = _clst_ids >= 0
+    # return the inner spatial join
+    return points[_joined].assign(
+        clst_id=_clst_ids[_joined],
+        group=gdf_out['group'].to_numpy()[_clst_ids[_joined]]
+    )
 
 
 def _local_convex_hull(points=None):
@@ -167,65 +133,217 @@ def _local_convex_hull(points=None):
     return points.convex_hull()
 
 
-def _ee_fuzzy_convex_hull(points=None, width=_DEFAULT_BUFFER_WIDTH):
+def _group_starts(labels=None):
+    """
+    Hidden function that will accept sorted group labels and return the
+    group index (0..k-1) of each element and the position of the first
+    element of each group
+    """
+    _new_group = np.concatenate([[True], labels[1:] != labels[:-1]])
+    return np.cumsum(_new_group) - 1, np.flatnonzero(_new_group)
+
+
+def _akl_toussaint_filter(coords=None, groups=None, starts=None,
+                          directions=_HULL_DIRECTIONS):
+    """
+    Hidden function implementing the Akl-Toussaint heuristic for grouped
+    points : a point that falls strictly inside the polygon spanned by the
+    extreme points of its group (in each of directions=) can't be a hull
+    vertex, so we drop it before building hulls
+    :param coords: (n, 2) coordinates, sorted by group
+    :param groups: group index (0..k-1) of each point, in sorted order
+    :param starts: position of the first point of each group
+    :param directions: (x, y) directions in counter-clockwise order
+    :return: boolean array of points to keep
+    """
+    _n = len(coords)
+    _positions = np.arange(_n)
+    # extreme point of each group in each direction
+    _extremes = []
+    for _direction in directions:
+        _value = coords @ np.asarray(_direction, dtype=float)
+        _max = np.maximum.reduceat(_value, starts)[groups]
+        _extremes.append(coords[np.minimum.reduceat(
+            np.where(_value == _max, _positions, _n), starts
+        )][groups])
+    _inside = np.ones(_n, dtype=bool)
+    for _a, _b in zip(_extremes, _extremes[1:] + _extremes[:1]):
+        _edge = _b - _a
+        # repeated extreme points make zero-length edges we can skip
+        _inside &= ((_edge[:, 0] * (coords[:, 1] - _a[:, 1]) -
+                     _edge[:, 1] * (coords[:, 0] - _a[:, 0])) > 0) | \
+            ((_edge[:, 0] == 0) & (_edge[:, 1] == 0))
+    return ~_inside
+
+
+def _monotone_chain(coords=None):
+    """
+    Hidden function implementing Andrew's monotone chain convex hull for a
+    (small) array of coordinates, sorted by x and then y
+    :param coords: (n, 2) coordinates
+    :return: list of counter-clockwise hull vertices (collinear points are
+    dropped, so degenerate hulls have fewer than three vertices)
+    """
+    def _cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+    _points = coords.tolist()
+    _lower, _upper = [], []
+    for _p in _points:
+        while len(_lower) >= 2 and _cross(_lower[-2], _lower[-1], _p) <= 0:
+            _lower.pop()
+        _lower.append(_p)
+    for _p in reversed(_points):
+        while len(_upper) >= 2 and _cross(_upper[-2], _upper[-1], _p) <= 0:
+            _upper.pop()
+        _upper.append(_p)
+    return _lower[:-1] + _upper[:-1]
+
+
+def _grouped_convex_hulls(coords=None, labels=None):
+    """
+    Hidden function that builds the convex hull of each group of points
+    straight from coordinate arrays : points are sorted by group, thinned
+    with the Akl-Toussaint heuristic, passed group-by-group through a
+    monotone chain, and the resulting rings are built into polygons in bulk.
+    Groups whose hull has fewer than three vertices (one or two points, or
+    collinear points) are dropped
+    :param coords: (n, 2) array of point coordinates
+    :param labels: (n,) array of integer group labels
+    :return: tuple of (group label of each hull, numpy array of Polygons)
+    """
+    if len(coords) == 0:
+        return np.zeros(0, dtype=np.int64), np.empty(0, dtype=object)
+    _order = np.argsort(labels, kind='stable')
+    _coords, _labels = coords[_order], labels[_order]
+    _groups, _starts = _group_starts(_labels)
+    # drop groups of one or two points outright
+    _keep = np.diff(np.append(_starts, len(_labels)))[_groups] >= 3
+    _coords, _labels = _coords[_keep], _labels[_keep]
+    # then interior points, with a coarse and a fine pass
+    for _directions in (_HULL_DIRECTIONS, _HULL_DIRECTIONS_FINE):
+        if len(_labels) == 0:
+            break
+        _groups, _starts = _group_starts(_labels)
+        _keep = _akl_toussaint_filter(_coords, _groups, _starts, _directions)
+        _coords, _labels = _coords[_keep], _labels[_keep]
+    if len(_labels) == 0:
+        return np.zeros(0, dtype=np.int64), np.empty(0, dtype=object)
+    # our monotone chain wants each group sorted by x, then y
+    _order = np.lexsort((_coords[:, 1], _coords[:, 0], _labels))
+    _coords, _labels = _coords[_order], _labels[_order]
+    _groups, _starts = _group_starts(_labels)
+    _ids = _labels[_starts]
+    _ends = np.append(_starts[1:], len(_labels))
+    _vertices, _rings, _hull_ids = [], [], []
+    for _group in np.flatnonzero(_ends - _starts >= 3):
+        _hull = _monotone_chain(_coords[_starts[_group]:_ends[_group]])
+        if len(_hull) >= 3:
+            _vertices.extend(_hull)
+            _rings.extend([len(_hull_ids)] * len(_hull))
+            _hull_ids.append(_ids[_group])
+    if not _hull_ids:
+        return np.zeros(0, dtype=np.int64), np.empty(0, dtype=object)
+    _polygons = shapely.polygons(shapely.linearrings(
+        np.asarray(_vertices), indices=np.asarray(_rings)
+    ))
+    return np.asarray(_hull_ids), _polygons
+
+
+def _metric_points(points=None):
+    """
+    Hidden function that casts point features (a filename, Vector, or
+    GeoDataFrame) as a GeoDataFrame in our default metric CRS
+    :param points: point features
+    :return: GeoDataFrame
+    """
+    # cast our points features as a gdf (if they aren't already)
+    if isinstance(points, str):
+        points = Vector(points).to_geodataframe()
+    elif isinstance(points, Vector):
+        points = points.to_geodataframe()
+    # reproject to something that uses metric units
+    points = _local_rebuild_crs(points)
+    return _local_reproject(points, _DEFAULT_EPSG)
+
+
+def _ee_fuzzy_convex_hull(points=None, width=_DEFAULT_BUFFER_WIDTH,
+                          method='buffer'):
     raise NotImplementedError
 
 
-def _local_fuzzy_convex_hull(points=None, width=_DEFAULT_BUFFER_WIDTH):
+def _cluster_convex_hulls(points=None, width=_DEFAULT_BUFFER_WIDTH,
+                          n_workers=None):
+    """
+    Hidden function that builds fuzzy convex hulls without any buffering.
+    Buffers of radius width= around two points intersect when the points are
+    within 2 * width of each other, so our buffer / union / spatial join
+    clusters are just single-linkage clusters at that distance, which we find
+    with a KD-tree (see clusters.cluster_points)
+    :param points: GeoDataFrame of points in a metric CRS
+    :param width: buffer radius (in meters) that defines our clusters
+    :param n_workers: cluster tiles of our points in a pool of this many
+    processes (see clusters.cluster_points)
+    :return: GeoDataFrame of hulls, indexed by cluster id
+    """
+    _coords = _point_coordinates(points)
+    _ids, _hulls = _grouped_convex_hulls(
+        _coords, cluster_points(_coords, 2 * width, n_workers=n_workers)
+    )
+    return gp.GeoDataFrame(
+        {'geometry': _hulls},
+        index=pd.Index(_ids, name='clst_id'),
+        crs=points.crs
+    )
+
+
+def _local_fuzzy_convex_hull(points=None, width=_DEFAULT_BUFFER_WIDTH,
+                             method='buffer', n_workers=None):
     """
     Accepts a GeoDataFrame containing points, buffers the point geometries by some distance,
     and than builds convex hulls from point clusters
     :param arg1: A GeoDataFrame or Vector object specifying source points we intend to buffer
     :param arg2: An integer value (in meters) specifying the radius we wish to buffer point features by
+    :param arg3: 'buffer' to buffer, dissolve, and spatially join our points, or
+    'kdtree' to find the same clusters directly from point coordinates (much faster)
     :param points: Keyword argument for arg1
     :param width: Keyword argument for arg2
+    :param method: Keyword argument for arg3
+    :param n_workers: cluster tiles of our points (method='kdtree') or
+    buffer and dissolve partitions of our points (method='buffer') in a
+    pool of this many processes, stitching clusters across their edges
     :return: GeoDataFrame
     """
     # args[0] / points=
     if points is None:
         raise IndexError("invalid points= argument passed by user")
-    # cast our points features as a gdf (if they aren't already)
-    if isinstance(points, str):
-        points = Vector(points).to_geodataframe()
-    # reproject to something that uses metric units
-    points = _local_rebuild_crs(points)
-    points = points.to_crs(epsg=_DEFAULT_EPSG)
+    if method not in _FUZZY_HULL_METHODS:
+        raise ValueError("method= should be one of " + str(_FUZZY_HULL_METHODS))
+    points = _metric_points(points)
+    if method == 'kdtree':
+        gdf = _cluster_convex_hulls(points, width, n_workers=n_workers)
+        if len(gdf) < 1:
+            logger.warning("Length of our convex hulls generated from "
+                           "clustered point features is <1 -- are all of "
+                           "our clusters smaller than 3 points?")
+        return gdf
     # generate circular point buffers around our SpatialPoints features
-    try:
-        point_buffers = copy(points)
-        # adjust the width= parameter based on the projection
-        # of our point buffers
-        point_buffers = point_buffers.buffer(width).unary_union
-        point_buffers = gp.GeoDataFrame({
-            'geometry': point_buffers,
-            'group':pd.Series(range(1,len(point_buffers)+1))
-        })
-        # set the CRS
-        point_buffers.crs = {'init':'epsg:'+str(_DEFAULT_EPSG)}
-    except Exception as e:
-        raise e
-    # spatial join of our point_buffers
-    point_clusters = _spatial_join(point_buffers, points)
-    # drop any extra columns lurking in our point clusters data
-    # and dissolve by our clst_id field
-    if len(point_clusters.columns) > 2:
-        cols_to_remove = list(point_clusters.columns)
-        # i.e., not our clst_id or geometries
-        cols_to_remove.remove('clst_id')
-        cols_to_remove.remove('geometry')
-        for col in cols_to_remove:
-            del point_clusters[col]
-    # group our point clusters by cluster id
-    _clst_id = point_clusters['clst_id']
-    point_clusters = point_clusters.dissolve(by='clst_id')
-    point_clusters['clst_id'] = _clst_id
-    # estimate our convex hulls and drop geometries that are not polygons
-    convex_hulls = point_clusters.convex_hull
-    convex_hulls = convex_hulls[[str(ft).find("POLYGON") != -1
-                                 for ft in convex_hulls.geometry]]
+    # and dissolve them into groups, partition-by-partition -- each point
+    # is labeled with the group its buffer was dissolved into
+    _clst_ids = Vector.from_geodataframe(points).buffer_dissolve(
+        width, n_workers=n_workers
+    )[1]
+    _joined = _clst_ids >= 0
+    # build a convex hull from the points of each cluster (degenerate
+    # clusters are dropped)
+    _ids, _hulls = _grouped_convex_hulls(
+        _point_coordinates(points)[_joined], _clst_ids[_joined]
+    )
     # return our convex hulls as a GeoDataFrame
-    gdf = gp.GeoDataFrame({'geometry': convex_hulls})
-    gdf.crs = points.crs
+    gdf = gp.GeoDataFrame(
+        {'geometry': _hulls},
+        index=pd.Index(_ids, name='clst_id'),
+        crs=points.crs
+    )
     # sanity check
     if len(gdf) < 1:
         logger.warning("Length of our convex hulls generated from buffered "
@@ -233,6 +351,42 @@ def _local_fuzzy_convex_hull(points=None, width=_DEFAULT_BUFFER_WIDTH):
     return gdf
 
 
+def _local_fuzzy_convex_hull_sweep(points=None, widths=None):
+    """
+    Builds fuzzy convex hulls (as with method='kdtree') at several buffer
+    widths from one minimum spanning forest of our points -- see
+    clusters.cluster_sweep. Useful for sensitivity analysis, where N widths
+    cost about one clustering run plus N cheap cuts and N hull builds
+    :param arg1: A GeoDataFrame or Vector object specifying source points
+    :param arg2: list of buffer radii (in meters) we want hulls for
+    :param points: Keyword argument for arg1
+    :param widths: Keyword argument for arg2
+    :return: dict of width : GeoDataFrame of hulls, indexed by cluster id
+    """
+    # args[0] / points=
+    if points is None:
+        raise IndexError("invalid points= argument passed by user")
+    # args[1] / widths=
+    if widths is None or len(widths) == 0:
+        raise IndexError("invalid widths= argument passed by user")
+    points = _metric_points(points)
+    _coords = _point_coordinates(points)
+    _labels = cluster_sweep(_coords, [2 * w for w in widths])
+    _sweep = {}
+    for _width in widths:
+        _ids, _hulls = _grouped_convex_hulls(_coords, _labels[2 * _width])
+        _sweep[_width] = gp.GeoDataFrame(
+            {'geometry': _hulls},
+            index=pd.Index(_ids, name='clst_id'),
+            crs=points.crs
+        )
+        if len(_hulls) < 1:
+            logger.warning("Length of our convex hulls at width=%s is <1 -- "
+                           "are all of our clusters smaller than 3 points?",
+                           _width)
+    return _sweep
+
+
 def _guess_backend(obj=None):
     """
     Will attempt to parse a proper backend code based on object context
@@ -247,7 +401,8 @@ def _guess_backend(obj=None):
         return "unknown"
 
 
-def fuzzy_convex_hull(obj=None, width=_DEFAULT_BUFFER_WIDTH):
+def fuzzy_convex_hull(obj=None, width=_DEFAULT_BUFFER_WIDTH, method='buffer',
+                      n_workers=None):
     """
     Fuzzy convex hull wrapper function that will call either a local or earth engine
     implementation of the Carter fuzzy convex hull generator. Currently only a local
@@ -256,22 +411,32 @@ def fuzzy_convex_hull(obj=None, width=_DEFAULT_BUFFER_WIDTH):
     :param arg2: An integer value (in meters) specifying the radius we wish to buffer point features by
     :param points: Keyword specification for first positional arg
     :param width: Keyword specification for second positional arg
+    :param method: 'buffer' (default) or 'kdtree' -- see _local_fuzzy_convex_hull
+    :param n_workers: number of processes to cluster (or buffer and
+    dissolve) partitions of our points with
     :return: GeoDataFrame
     """
     # args[0]/points=
     if obj is None:
         raise IndexError("invalid points= argument")
-    # launch our context runner
-    if isinstance(obj, EE):
-        return Do(
-            this=_ee_fuzzy_convex_hull,
-            that=[obj, width]
-        ).run()
-    elif isinstance(obj, Local):
-        return Do(
-            this=_local_fuzzy_convex_hull,
-            that=[obj, width]
-        ).run()
-    else:
-        # our default action is to just assume local operation
-        return _local_fuzzy_convex_hull(points=obj, width=width)
+    # only a local implementation exists -- Vector and GeoDataFrame inputs
+    # aren't Backend objects, so there is nothing to dispatch on yet
+    return _local_fuzzy_convex_hull(points=obj, width=width, method=method,
+                                    n_workers=n_workers)
+
+
+def fuzzy_convex_hull_sweep(obj=None, widths=None):
+    """
+    Builds fuzzy convex hulls for every buffer width in widths= from a single
+    clustering of our points. Hulls at each width match those of
+    fuzzy_convex_hull(obj, width, method='kdtree')
+    :param arg1: A GeoDataFrame or Vector object specifying source points
+    :param arg2: list of buffer radii (in meters) we want hulls for
+    :param obj: Keyword specification for first positional arg
+    :param widths: Keyword specification for second positional arg
+    :return: dict of width : GeoDataFrame
+    """
+    # args[0]/points=
+    if obj is None:
+        raise IndexError("invalid points= argument")
+    return _local_fuzzy_convex_hull_sweep(points=obj, widths=widths)
@@ -11,6 +11,10 @@ __status__ = "Testing"
 
 import logging
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    FIRST_COMPLETED, wait
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -32,68 +36,239 @@ class EE(Backend):
     pass
 
 
+class Output(object):
+    def __init__(self, name=None):
+        """
+        Output is a reference to the result of a named step of a Do graph.
+        It can be used anywhere in a step's 'that' arguments (including
+        inside lists, tuples, and dicts) and is replaced by that step's
+        result before the step runs
+        :param name: name of the step whose result we refer to
+        """
+        if name is None:
+            raise IndexError("invalid name= argument provided by user")
+        self.name = name
+
+    def __repr__(self):
+        return "Output(%r)" % self.name
+
+
+def _references(value=None):
+    """
+    Names of the steps referenced by Output objects anywhere in value=
+    """
+    if isinstance(value, Output):
+        return [value.name]
+    if isinstance(value, (list, tuple)):
+        return [n for v in value for n in _references(v)]
+    if isinstance(value, dict):
+        return [n for v in value.values() for n in _references(v)]
+    return []
+
+
+def _resolve(value=None, results=None):
+    """
+    Replace the Output objects anywhere in value= with their step's result
+    """
+    if isinstance(value, Output):
+        return results[value.name]
+    if isinstance(value, (list, tuple)):
+        return type(value)(_resolve(v, results) for v in value)
+    if isinstance(value, dict):
+        return dict((k, _resolve(v, results)) for k, v in value.items())
+    return value
+
+
+def _call(what=None, args=(), kwargs=None):
+    """
+    Call a step function (a top-level function, so process pools can
+    pickle it)
+    """
+    return what(*args, **(kwargs or {}))
+
+
 class Do(Backend):
     def __init__(self, this=None, that=None, *args):
         """
         Do is a dictcomp interface for performing arbitrary spatial tasks with
-        Vector and Raster objects
+        Vector and Raster objects. A Do either runs a single 'this' function
+        with 'that' arguments, or a graph of named steps (see step) whose
+        arguments may be the outputs of other steps
         :param this: run 'this' function
-        :param that: Backend class describing with 'this' function's
-        parameters
+        :param that: arguments for our 'this' function -- a list (or tuple)
+        of positional arguments, a dict of keyword arguments, or a single
+        argument
         :param args: list of any additional positional arguments that are
         passed to the 'this' function
         """
+        self._steps = OrderedDict()
         if this is None or that is None:
             try:
                 self._what = args[0]
                 self._with = args[1]
-                args = args[:2]
+                args = args[2:]
             except IndexError:
-                raise IndexError("this=, that= are empty and we failed to ",
-                                 "parse any positional arguments")
+                if this is not None or that is not None or args:
+                    raise IndexError("this=, that= are empty and we failed to "
+                                     "parse any positional arguments")
+                args = ()  # an empty Do that we'll build a graph with
         else:
-            self._what = this # run function
-            self._with = that # Currently EE or Local are supported
-        self._using = self._unpack_with_arguments(*args)
+            self._what = this  # run function
+            self._with = that  # arguments for our run function
+        self._using = args
+
+    def __setattr__(self, name, value):
+        # run used to be a property whose setter took a {'what', 'with'}
+        # dict -- assigning to it now would silently replace our method
+        if name == 'run':
+            raise AttributeError("run is a method -- pass this= and that= "
+                                 "to Do (or add steps) and call run()")
+        super(Do, self).__setattr__(name, value)
 
-    def _unpack_with_arguments(self, *args, **kwargs):
+    def _unpack_with_arguments(self, that=None, *args):
         """
-        The what arguments specified by the user can be pass as a dictionary or as a list. This
+        The with arguments specified by the user can be passed as a dictionary or as a list. This
         method will unpack user-specified 'with' arguments so that they can be handled by a user-specified
         'what' function
-        :return: None
+        :return: tuple of (positional arguments, keyword arguments)
         """
-        return args
+        if that is None:
+            return tuple(args), {}
+        if isinstance(that, dict):
+            return tuple(args), dict(that)
+        if isinstance(that, (list, tuple)):
+            return tuple(that) + tuple(args), {}
+        return (that,) + tuple(args), {}
 
-    @property
-    def run(self):
+    def step(self, name=None, this=None, that=None):
         """
-        Get method that will call our user-supplied run function
-        :param args:
-        :return: Result of a what function
+        Add a named step to our graph. Steps run 'this' with 'that'
+        arguments (see __init__), where any Output(name) is replaced by the
+        result of the named step. Steps that don't depend on each other
+        can run concurrently (see run)
+        :param name: a unique name for this step
+        :param this: function to run
+        :param that: arguments for our function, which may contain Output
+        references to other steps
+        :return: self, so that steps can be chained
         """
-        # if we haven't already specified our 'what' and 'with' parameters
-        if self._what is None or self._with is None:
-            raise AttributeError("'what' and 'with' parameters are undefined.")
-        return self._what(self._with)
+        if name is None or name in self._steps:
+            raise IndexError("invalid (or duplicate) name= argument provided "
+                             "by user")
+        if this is None:
+            raise IndexError("invalid this= argument provided by user")
+        self._steps[name] = {'this': this, 'that': that,
+                             'inputs': set(_references(that))}
+        return self
+
+    def _schedule(self, outputs=None):
+        """
+        Validate our graph and count the consumers of each step's result
+        :return: dict of step name : number of consumers (a requested
+        output counts as a consumer that never finishes)
+        """
+        _consumers = dict((name, 0) for name in self._steps)
+        for _name, _step in self._steps.items():
+            for _input in _step['inputs']:
+                if _input not in self._steps:
+                    raise ValueError("step '%s' refers to an undefined step "
+                                     "'%s'" % (_name, _input))
+                _consumers[_input] += 1
+        for _name in outputs:
+            if _name not in self._steps:
+                raise ValueError("outputs= refers to an undefined step '%s'" %
+                                 _name)
+            _consumers[_name] += 1
+        # Kahn's algorithm -- every step should be reachable from our roots
+        _remaining = dict((n, len(s['inputs'])) for n, s in
+                          self._steps.items())
+        _ready = [n for n, k in _remaining.items() if k == 0]
+        _visited = 0
+        while _ready:
+            _name = _ready.pop()
+            _visited += 1
+            for _other, _step in self._steps.items():
+                if _name in _step['inputs']:
+                    _remaining[_other] -= 1
+                    if _remaining[_other] == 0:
+                        _ready.append(_other)
+        if _visited != len(self._steps):
+            raise ValueError("our steps have a circular dependency")
+        return _consumers
 
-    @run.setter
-    def run(self, *args):
+    def _run_graph(self, n_workers=None, backend='thread', outputs=None):
         """
-        Set method for our run function. This specifies what we are going to do with our instance
-        and does some object checks to determine an appropriate backend based on objects specified
-        with the 'what' parameter. The setter will then call the function to perform the user
-        specified action
-        :param args:
-        :return:
+        Run our steps in a pool of workers, submitting each step as soon as
+        all of its inputs are available and dropping each result as soon as
+        every step that consumes it has started
+        :return: dict of step name : result for each of our outputs
         """
-        try:
-            self._what = args[0]['what']
-            self._with = args[0]['with']
-        except KeyError or IndexError as e:
-            raise KeyError("run= accepts a dict as a single positional argument specifying "
-                           "'what' and 'with' keys")
-        # determine what backend to use (or if the user specified
-        # backend is inappropriate for the given data)
-        self._unpack_with_arguments()
-        self._guess_backend()
+        if backend not in ('thread', 'process'):
+            raise ValueError("backend= should be 'thread' or 'process'")
+        if outputs is None:
+            # steps that no other step consumes
+            _consumed = set(n for s in self._steps.values()
+                            for n in s['inputs'])
+            outputs = [n for n in self._steps if n not in _consumed]
+        _consumers = self._schedule(outputs)
+        _waiting = OrderedDict((n, set(s['inputs'])) for n, s in
+                               self._steps.items())
+        _results = {}
+        _executor = ThreadPoolExecutor if backend == 'thread' else \
+            ProcessPoolExecutor
+        with _executor(max_workers=n_workers) as pool:
+            _running = {}
+
+            def _submit():
+                for _name in [n for n, w in _waiting.items() if not w]:
+                    del _waiting[_name]
+                    _step = self._steps[_name]
+                    _args, _kwargs = self._unpack_with_arguments(
+                        _resolve(_step['that'], _results)
+                    )
+                    _running[pool.submit(_call, _step['this'], _args,
+                                         _kwargs)] = _name
+                    # free intermediates that no other step still needs
+                    for _input in _step['inputs']:
+                        _consumers[_input] -= 1
+                        if _consumers[_input] == 0:
+                            del _results[_input]
+
+            _submit()
+            while _running:
+                _done = wait(list(_running), return_when=FIRST_COMPLETED)[0]
+                for _future in _done:
+                    _name = _running.pop(_future)
+                    try:
+                        _result = _future.result()
+                    except Exception:
+                        for _other in _running:
+                            _other.cancel()
+                        logger.warning("step '%s' failed", _name)
+                        raise
+                    if _consumers[_name] > 0:
+                        _results[_name] = _result
+                    for _inputs in _waiting.values():
+                        _inputs.discard(_name)
+                _submit()
+        return dict((n, _results[n]) for n in outputs)
+
+    def run(self, n_workers=None, backend='thread', outputs=None):
+        """
+        Run our function, or our graph of steps (see step). Independent
+        steps run concurrently in a pool of n_workers= workers
+        :param n_workers: size of our worker pool (graphs only; defaults to
+        the concurrent.futures default)
+        :param backend: 'thread' (default) or 'process' pool -- process
+        pools need picklable step functions, arguments, and results
+        :param outputs: names of the steps whose results we return (graphs
+        only; defaults to every step that no other step consumes)
+        :return: the result of our function, or a dict of step name : result
+        """
+        if self._steps:
+            return self._run_graph(n_workers, backend, outputs)
+        # if we haven't already specified our 'what' and 'with' parameters
+        if self._what is None or self._with is None:
+            raise AttributeError("'what' and 'with' parameters are undefined.")
+        _args, _kwargs = self._unpack_with_arguments(self._with, *self._using)
+        return self._what(*_args, **_kwargs)
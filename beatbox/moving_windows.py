@@ -14,8 +14,11 @@ import re
 import numpy as np
 import logging
 
+from functools import partial
 from scipy import ndimage
 
+from beatbox.raster import tile_apply
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -36,10 +39,13 @@ def _dict_to_mwindow_filename(key=None, window_size=None):
     return str(key)+"_"+str(window_size)+"x"+str(window_size)
 
 def filter(r=None, dest_filename=None, write=True, footprint=None,
-           overwrite=True, function=None, size=None, dtype=np.uint16):
+           overwrite=True, function=None, size=None, dtype=np.uint16,
+           n_workers=None):
     """ wrapper for ndimage.generic_filter that can comprehend a GeoRaster,
     apply a common circular buffer, and optionally writes a numpy array to
-    disk following user specifications
+    disk following user specifications. If n_workers= is specified, the
+    filter is applied tile-wise (with a halo of half our window) across
+    a pool of workers.
     """
     try:
         _WRITE_FILE = ((not os.path.isfile(dest_filename)) | overwrite) & write \
@@ -55,31 +61,67 @@ def filter(r=None, dest_filename=None, write=True, footprint=None,
         raise TypeError("Unknown size= or footprint= arguments passed to",
         "filter() :", e)
     # apply ndimage filter to user specifications
-    try:
-        image = np.array(r.array, dtype=dtype)
-    except AttributeError as e:
-        image = np.array(r, dtype=dtype)
+    if n_workers is not None:
+        # Raster objects (even lazy ones) are read tile-by-tile
+        _source = r if hasattr(r, 'array') else np.array(r, dtype=dtype)
+        image = np.ma.getdata(tile_apply(
+            rasters=_source,
+            function=partial(
+                _filter_block,
+                function=function,
+                footprint=_FOOTPRINT,
+                dtype=dtype
+            ),
+            halo=max(_FOOTPRINT.shape)//2,
+            n_workers=n_workers
+        ).array)
+    else:
+        try:
+            image = np.array(r.array, dtype=dtype)
+        except AttributeError as e:
+            image = np.array(r, dtype=dtype)
+        image = _filter_block(image, function=function, footprint=_FOOTPRINT,
+                              dtype=dtype)
+    # either save to disk or return to user
+    if _WRITE_FILE:
+        try:
+            r.array = image
+            r.write(dst_filename = str(dest_filename))
+        except AttributeError as e:
+            dest_filename = dest_filename.replace(".tif", "") # gdal will append for us
+            r.array = image
+            r.write(dst_filename=str(dest_filename))
+        except Exception as e:
+            logger.warning("%s doesn't appear to be a Raster object; "
+                           "returning result to user", e)
+            return image
+    else:
+        return image
+
+def _filter_block(image=None, function=None, footprint=None, dtype=np.uint16):
+    """ apply an ndimage filter to a single array (or tile of an array) """
+    image = np.array(image, dtype=dtype)
     # these ndimage filters can be used for the most common functions
     # we may encounter for moving windows analyses
     if function == np.median or function == np.mean:
         image = ndimage.median_filter(
             input=image,
-            footprint=_FOOTPRINT
+            footprint=footprint
         )
     elif function == sum or function == np.sum:
         image = ndimage.median_filter(
             input = image,
-            footprint = _FOOTPRINT
-        ) * _FOOTPRINT.size
+            footprint = footprint
+        ) * footprint.size
     elif function == np.max:
         image = ndimage.maximum_filter(
             input = image,
-            footprint = _FOOTPRINT
+            footprint = footprint
         )
     elif function == np.min:
         image = ndimage.minimum_filter(
             input = image,
-            footprint = _FOOTPRINT
+            footprint = footprint
         )
     # but, if all else fails, use the (slower) ndimage.generic_filter
     else:
@@ -90,22 +132,8 @@ def filter(r=None, dest_filename=None, write=True, footprint=None,
             image = ndimage.generic_filter(
                 input=np.array(image, dtype=dtype),
                 function=function,
-                footprint=_FOOTPRINT
+                footprint=footprint
             )
         except Exception as e:
                 raise RuntimeError("Failed to execute generic_filter using user-specified function. See:", e)
-    # either save to disk or return to user
-    if _WRITE_FILE:
-        try:
-            r.array = image
-            r.write(dst_filename = str(dest_filename))
-        except AttributeError as e:
-            dest_filename = dest_filename.replace(".tif", "") # gdal will append for us
-            r.array = image
-            r.write(dst_filename=str(dest_filename))
-        except Exception as e:
-            logger.warning("%s doesn't appear to be a Raster object; "
-                           "returning result to user", e)
-            return image
-    else:
-        return image
+    return image
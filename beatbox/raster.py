@@ -11,15 +11,24 @@ __email__ = "kyle.taylor@pljv.org"
 __status__ = "Testing"
 
 # mmap file caching and file handling
+import os
 import sys
+import json
+import math
 from random import randint
 from copy import copy
+# parallel tile processing
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    FIRST_COMPLETED, wait, as_completed
 # raster manipulation
 from georasters import GeoRaster
 from georasters import get_geo_info, create_geotiff, merge
 import gdalnumeric
 import gdal
 import numpy as np
+import pandas as pd
+import shapely
 from osgeo import gdal_array
 # memory profiling
 import types
@@ -47,7 +56,7 @@ NUMPY_TYPES = {
   "uint8": np.uint8,
   "int8": np.uint8,
   "int": np.intc,
-  "byte": np.int8,
+  "byte": np.uint8,  # GDAL's Byte type is unsigned (e.g., CDL codes 0-255)
   "uint16": np.uint16,
   "int16": np.int16,
   "uint32": np.uint32,
@@ -61,8 +70,133 @@ NUMPY_TYPES = {
 
 _DEFAULT_NA_VALUE = 0
 _DEFAULT_PRECISION = np.uint16
+_DEFAULT_TILE_SIZE = 1024  # rows and columns per tile for block operations
+_CROSSTAB_MAX_BINS = 2**20  # largest key space we will bincount densely
+_SKETCH_SIZE = 1000  # points kept in our streaming quantile summaries
+_DEFAULT_QUANTILES = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+_STATS_SIDECAR_SUFFIX = ".stats.json"
 
-class Raster(object):
+class _RasterAlgebra(object):
+    """
+    Operator overloads shared by Raster and RasterExpression. Arithmetic,
+    comparison, and logical operators don't compute anything -- they
+    build a RasterExpression graph that is evaluated block-wise later.
+    """
+    # keep numpy from trying to broadcast over our objects and
+    # defer to our reflected operators instead
+    __array_ufunc__ = None
+
+    def __add__(self, other):
+        return RasterExpression(np.add, [self, other])
+
+    def __radd__(self, other):
+        return RasterExpression(np.add, [other, self])
+
+    def __sub__(self, other):
+        return RasterExpression(np.subtract, [self, other])
+
+    def __rsub__(self, other):
+        return RasterExpression(np.subtract, [other, self])
+
+    def __mul__(self, other):
+        return RasterExpression(np.multiply, [self, other])
+
+    def __rmul__(self, other):
+        return RasterExpression(np.multiply, [other, self])
+
+    def __truediv__(self, other):
+        return RasterExpression(np.true_divide, [self, other])
+
+    def __rtruediv__(self, other):
+        return RasterExpression(np.true_divide, [other, self])
+
+    def __floordiv__(self, other):
+        return RasterExpression(np.floor_divide, [self, other])
+
+    def __rfloordiv__(self, other):
+        return RasterExpression(np.floor_divide, [other, self])
+
+    def __mod__(self, other):
+        return RasterExpression(np.mod, [self, other])
+
+    def __rmod__(self, other):
+        return RasterExpression(np.mod, [other, self])
+
+    def __pow__(self, other):
+        return RasterExpression(np.power, [self, other])
+
+    def __rpow__(self, other):
+        return RasterExpression(np.power, [other, self])
+
+    def __and__(self, other):
+        return RasterExpression(np.bitwise_and, [self, other])
+
+    def __rand__(self, other):
+        return RasterExpression(np.bitwise_and, [other, self])
+
+    def __or__(self, other):
+        return RasterExpression(np.bitwise_or, [self, other])
+
+    def __ror__(self, other):
+        return RasterExpression(np.bitwise_or, [other, self])
+
+    def __xor__(self, other):
+        return RasterExpression(np.bitwise_xor, [self, other])
+
+    def __rxor__(self, other):
+        return RasterExpression(np.bitwise_xor, [other, self])
+
+    def __lt__(self, other):
+        return RasterExpression(np.less, [self, other])
+
+    def __le__(self, other):
+        return RasterExpression(np.less_equal, [self, other])
+
+    def __gt__(self, other):
+        return RasterExpression(np.greater, [self, other])
+
+    def __ge__(self, other):
+        return RasterExpression(np.greater_equal, [self, other])
+
+    def __eq__(self, other):
+        # only comparisons against scalars are lazy -- between our objects,
+        # == keeps Python's identity semantics so that membership tests
+        # (raster in some_list, list.index) still work. See eq()
+        if not _local_is_scalar(other):
+            return NotImplemented
+        return self.eq(other)
+
+    def __ne__(self, other):
+        if not _local_is_scalar(other):
+            return NotImplemented
+        return self.ne(other)
+
+    # we still want to be able to put Rasters in sets and dicts
+    __hash__ = object.__hash__
+
+    def eq(self, other):
+        """
+        Lazy, cell-wise equality with a Raster, RasterExpression, or scalar
+        """
+        return RasterExpression(np.equal, [self, other])
+
+    def ne(self, other):
+        """
+        Lazy, cell-wise inequality with a Raster, RasterExpression, or scalar
+        """
+        return RasterExpression(np.not_equal, [self, other])
+
+    def __neg__(self):
+        return RasterExpression(np.negative, [self])
+
+    def __abs__(self):
+        return RasterExpression(np.absolute, [self])
+
+    def __invert__(self):
+        return RasterExpression(np.invert, [self])
+
+
+class Raster(_RasterAlgebra):
 
     """
     Raster class is a wrapper for generating GeoRasters,
@@ -71,16 +205,20 @@ class Raster(object):
     actions associated with Do.
     :arg file string specifying the full path to a raster
     file (typically a GeoTIFF) or an asset id for earth engine
+    :arg lazy if True, only read the raster's meta information on
+    open and leave the cell values on disc for block-wise operations
     :return None
     """
 
     def __init__(self, filename=None, array=None, dtype=None,
-                 disc_caching=None):
+                 disc_caching=None, lazy=None):
         # Privates
         self._backend = "local"
         self._array = None
         self._filename = None
         self._using_disc_caching = None  # Use mmcache?
+        self._lazy = bool(lazy)  # leave our array on disc?
+        self._stats = None  # cached stats and histograms
         # Public properties (maintained for GeoRasters)
         self.ndv = _DEFAULT_NA_VALUE # no data value
         self.x_cell_size = None  # cell size of x (meters/degrees)
@@ -113,11 +251,13 @@ class Raster(object):
         _raster._backend = copy(self._backend)
         _raster._filename = copy(self._filename)
         _raster._using_disc_caching = copy(self._filename)
+        _raster._lazy = self._lazy
         _raster.ndv = self.ndv
         _raster.x_cell_size = self.x_cell_size
         _raster.y_cell_size = self.y_cell_size
         _raster.geot = self.geot
         _raster.projection = self.projection
+        _raster.dtype = self.dtype
         # if we are mem caching, generate a new tempfile
         return _raster
 
@@ -131,14 +271,36 @@ class Raster(object):
     @array.setter
     def array(self, *args):
         """
-        Assign a numpy masked array to our Raster object
+        Assign a numpy masked array to our Raster object. A masked array
+        that carries its own mask keeps it -- otherwise, cells equal to our
+        no data value are masked
         """
+        self._stats = None  # new cell values, stale stats
+        if args[0] is None:
+            self._array = None
+            return
+        if isinstance(args[0], np.ma.MaskedArray) and \
+                args[0].mask is not np.ma.nomask:
+            _mask = args[0].mask
+        else:
+            _mask = np.asarray(args[0]) == self.ndv
         self._array = np.ma.masked_array(
             args[0],
-            mask=self._array == self.ndv,
+            mask=_mask,
             fill_value=self.ndv
         )
 
+    @property
+    def shape(self):
+        """
+        (rows, cols) of our raster, whether or not the array is loaded
+        """
+        if self._array is not None:
+            return self._array.shape
+        # GeoRasters' get_geo_info reports the raster dimensions
+        # in what we call our cell size properties
+        return (int(self.y_cell_size), int(self.x_cell_size))
+
     @property
     def filename(self):
         return self._filename
@@ -181,6 +343,9 @@ class Raster(object):
             self.dtype = NUMPY_TYPES[self.dtype.lower()]
         if self.ndv is None:
             self.ndv = _DEFAULT_NA_VALUE
+        # lazy rasters are read block-by-block as needed
+        if self._lazy:
+            return
         # low-level call to gdal with explicit type specification
         # that will store in memory or as a disc cache, depending
         # on the state of our _using_disc_caching property
@@ -250,6 +415,47 @@ class Raster(object):
             datatype=self.array.dtype
         )
 
+    def stats(self, quantiles=_DEFAULT_QUANTILES, refresh=False,
+              tile_size=_DEFAULT_TILE_SIZE, n_workers=None, backend="thread"):
+        """
+        Count, min, max, mean, standard deviation, and quantiles of our
+        valid cells, computed in one streaming pass over our tiles. Quantiles
+        are exact for 8 and 16-bit integer rasters and approximate
+        (from a quantile summary) otherwise. Results are cached, and lazy
+        Rasters keep their cache in a sidecar file next to the source
+        raster so that later sessions get an answer without a pass.
+        :param quantiles: list of quantiles (0-1) to report, or None
+        :param refresh: if True, ignore any cached results
+        :param tile_size: see tile_apply
+        :param n_workers: see tile_apply
+        :param backend: see tile_apply
+        :return: dict
+        """
+        return _local_raster_stats(self, quantiles, refresh, tile_size,
+                                   n_workers, backend)
+
+    def histogram(self, bins=256, range=None, refresh=False,
+                  tile_size=_DEFAULT_TILE_SIZE, n_workers=None,
+                  backend="thread"):
+        """
+        Histogram of our valid cells, computed in one streaming pass and
+        cached like stats()
+        :param bins: number of equal-width bins
+        :param range: (min, max) of our bins (default: from stats())
+        :param refresh: if True, ignore any cached results
+        :return: tuple of (counts, bin edges) like np.histogram
+        """
+        return _local_raster_histogram(self, bins, range, refresh, tile_size,
+                                       n_workers, backend)
+
+    def evaluate(self, **kwargs):
+        """
+        A Raster is the simplest expression -- evaluate() hands back an
+        in-memory copy, cast to dtype= if specified. See
+        RasterExpression.evaluate for keyword arguments.
+        """
+        return RasterExpression(np.positive, [self]).evaluate(**kwargs)
+
     def to_ee_image(self):
         """
         Parses our internal numpy array as an Earth Engine ee.array object.
@@ -262,8 +468,234 @@ class Raster(object):
         return ee.array(self.array)
 
 
-def crop(*args):
-    return _local_crop(args)
+class RasterExpression(_RasterAlgebra):
+    """
+    A lazy expression graph built from Raster operators, e.g.
+    (a > 5) & (b == 3) * c or a.eq(b) -- == and != only build expressions
+    against scalars, use eq() and ne() between rasters. Nothing is computed until evaluate() is
+    called, at which point the whole graph is evaluated one tile at a
+    time with tile_apply, so intermediate full-size arrays never exist.
+    :arg function numpy ufunc (or function) applied to our operands
+    :arg operands list of Raster, RasterExpression, or scalar operands
+    """
+
+    def __init__(self, function=None, operands=None):
+        # args[0]/function=
+        if function is None:
+            raise IndexError("invalid function= argument specified")
+        # args[1]/operands=
+        if operands is None:
+            raise IndexError("invalid operands= argument specified")
+        for operand in operands:
+            if isinstance(operand, np.ndarray) and operand.ndim > 0:
+                raise ValueError("numpy arrays can't be used in raster "
+                                 "expressions -- wrap them as a "
+                                 "Raster(array=) first")
+        self._function = function
+        self._operands = list(operands)
+
+    def __bool__(self):
+        raise TypeError("the truth value of a RasterExpression is ambiguous "
+                        "-- use & and | instead of 'and' and 'or', and "
+                        "avoid chained comparisons")
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "RasterExpression(%s, %s)" % (
+            getattr(self._function, '__name__', str(self._function)),
+            str(self._operands)
+        )
+
+    @property
+    def rasters(self):
+        """
+        The unique Raster objects at the leaves of our graph
+        """
+        _rasters = []
+        _stack = [self]
+        while _stack:
+            _node = _stack.pop()
+            if isinstance(_node, RasterExpression):
+                _stack.extend(reversed(_node._operands))
+            elif isinstance(_node, Raster) and \
+                    not any([_node is r for r in _rasters]):
+                _rasters.append(_node)
+        return _rasters
+
+    def _compile(self, rasters=None):
+        """
+        Reduce our graph to a picklable tree of (function, operands) tuples
+        with Raster leaves swapped for their index in rasters=. This is all
+        a tile worker needs to see of our expression.
+        """
+        _operands = []
+        for operand in self._operands:
+            if isinstance(operand, RasterExpression):
+                _operands.append(operand._compile(rasters))
+            elif isinstance(operand, Raster):
+                _operands.append(
+                    _RasterLeaf([i for i, r in enumerate(rasters)
+                                 if r is operand][0])
+                )
+            else:
+                _operands.append(operand)
+        return (self._function, tuple(_operands))
+
+    @property
+    def dtype(self):
+        """
+        Data type of our expression's result, determined by evaluating our
+        graph over single-cell arrays of each input's type
+        """
+        _rasters = self.rasters
+        _cells = [
+            np.ones(1, dtype=r.array.dtype if r.array is not None else r.dtype)
+            for r in _rasters
+        ]
+        with np.errstate(all='ignore'):
+            return _local_evaluate_node(self._compile(_rasters), _cells).dtype
+
+    def evaluate(self, dtype=None, ndv=None, tile_size=_DEFAULT_TILE_SIZE,
+                 n_workers=None, backend="thread", dst_filename=None,
+                 driver='GTiff'):
+        """
+        Evaluate our expression graph block-wise into a new Raster. Inputs
+        are checked for alignment and our no data value is checked against
+        the output data type before any cells are read. Cells that are no
+        data in any input (or non-finite in a floating-point result) are
+        no data in the output -- in memory, that mask is kept as-is, so
+        valid cells that happen to equal our no data value stay valid.
+        :param dtype: output data type (default: numpy's result type;
+        boolean results are stored as uint8)
+        :param ndv: output no data value (default: NaN for floating-point
+        results, 255 for boolean results, and that of the first input
+        otherwise). Files written with dst_filename= can only flag no data
+        by value, so pick one outside of the range of your results
+        :param tile_size: see tile_apply
+        :param n_workers: see tile_apply
+        :param backend: see tile_apply
+        :param dst_filename: see tile_apply
+        :param driver: see tile_apply
+        :return: Raster
+        """
+        _rasters = self.rasters
+        if not _rasters:
+            raise ValueError("expression doesn't reference any Raster objects")
+        _local_check_alignment(_rasters)
+        if dtype is None:
+            try:
+                dtype = self.dtype
+            except TypeError as e:
+                raise TypeError("expression isn't valid for the data types "
+                                "of our input rasters : %s" % str(e))
+            if dtype == np.bool_:
+                dtype = np.uint8
+                ndv = 255 if ndv is None else ndv
+        dtype = np.dtype(dtype)
+        if ndv is None:
+            ndv = np.nan if dtype.kind in 'fc' else _rasters[0].ndv
+        if not _local_can_represent(ndv, dtype):
+            raise ValueError("no data value %s can't be represented as %s -- "
+                             "specify a suitable ndv= or dtype=" %
+                             (str(ndv), str(dtype)))
+        return tile_apply(
+            rasters=_rasters,
+            function=partial(
+                _local_evaluate_block,
+                expression=self._compile(_rasters),
+                dtype=dtype
+            ),
+            tile_size=tile_size,
+            n_workers=n_workers,
+            backend=backend,
+            dtype=dtype,
+            ndv=ndv,
+            dst_filename=dst_filename,
+            driver=driver
+        )
+
+
+class _RasterLeaf(int):
+    """
+    Index of a Raster in a compiled RasterExpression (an int subclass so
+    that leaves can't be confused with scalar operands)
+    """
+    pass
+
+
+def where(condition=None, x=None, y=None):
+    """
+    Lazy, raster expression version of np.where : take cells from x=
+    where condition= is true and from y= elsewhere
+    :param condition: RasterExpression or Raster
+    :param x: Raster, RasterExpression, or scalar
+    :param y: Raster, RasterExpression, or scalar
+    :return: RasterExpression
+    """
+    if condition is None or x is None or y is None:
+        raise IndexError("condition=, x=, and y= arguments are required")
+    return RasterExpression(np.where, [condition, x, y])
+
+
+def _local_evaluate_node(node=None, blocks=None):
+    """
+    Recursively evaluate a compiled expression node over a list of blocks
+    """
+    _function, _operands = node
+    return _function(*[
+        _local_evaluate_node(o, blocks) if isinstance(o, tuple) else
+        blocks[o] if isinstance(o, _RasterLeaf) else o
+        for o in _operands
+    ])
+
+
+def _local_evaluate_block(*blocks, **kwargs):
+    """
+    Per-block kernel for RasterExpression.evaluate : the whole expression is
+    computed on the raw block data and the no data masks of our inputs are
+    combined once, rather than carried through every intermediate step
+    """
+    _expression = kwargs.get('expression')
+    _dtype = kwargs.get('dtype')
+    with np.errstate(all='ignore'):
+        _result = _local_evaluate_node(
+            _expression, [np.ma.getdata(b) for b in blocks]
+        )
+    _result = np.broadcast_to(_result, blocks[0].shape)
+    _mask = np.zeros(blocks[0].shape, dtype=bool)
+    for b in blocks:
+        _mask |= np.ma.getmaskarray(b)
+    if _result.dtype.kind in 'fc':
+        _mask |= ~np.isfinite(_result)
+    return np.ma.masked_array(_result.astype(_dtype), mask=_mask)
+
+
+def _local_is_scalar(value=None):
+    """
+    Determine whether a raster expression operand is a plain scalar
+    """
+    return np.isscalar(value) or \
+        (isinstance(value, np.ndarray) and value.ndim == 0)
+
+
+def _local_can_represent(value=None, dtype=None):
+    """
+    Determine whether a scalar value can be stored as dtype= without loss
+    """
+    try:
+        if np.dtype(dtype).kind in 'fc' and np.isnan(value):
+            return True
+        return bool(np.array(value).astype(dtype) == value)
+    except (OverflowError, ValueError, TypeError):
+        return False
+
+
+def crop(*args, **kwargs):
+    """
+    Crop wrapper function -- see _local_crop
+    """
+    return _local_crop(*args, **kwargs)
 
 
 def extract(*args):
@@ -275,11 +707,12 @@ def extract(*args):
     :return:
     """
 
-def binary_reclassify(array=None, match=None, *args):
+def binary_reclassify(array=None, match=None, n_workers=None, *args):
     """
     Generalized version of binary_reclassify that can accomodate
     a local numpy array or processing on EE
     :param args:
+    :param n_workers: number of workers to process Raster tiles with
     :return:
     """
     _backend = 'local'
@@ -297,23 +730,22 @@ def binary_reclassify(array=None, match=None, *args):
     # currently only local operations are supported
     if isinstance(array, Raster):
         _backend = 'local'
-        array = array.to_georaster()
     elif isinstance(array, GeoRaster):
         _backend = 'local'
-    elif isinstance(array, np.array):
+    elif isinstance(array, np.ndarray):
         _backend = 'local'
     else:
         _backend = 'unknown'
 
     if _backend == "local":
-        return _local_binary_reclassify(array, match)
+        return _local_binary_reclassify(array, match, n_workers=n_workers)
     else:
         raise NotImplementedError("Currently only local binary "
                                   "reclassification is supported")
 
 
 def _local_binary_reclassify(raster=None, match=None, invert=None,
-                             dtype=np.uint8):
+                             dtype=np.uint8, n_workers=None):
     """ binary reclassification of input data. All cell values in
     a numpy array are reclassified as uint8 (boolean) based on
     whether they match or do not match the values of an input match
@@ -322,6 +754,7 @@ def _local_binary_reclassify(raster=None, match=None, invert=None,
     :param: args1 : a list object of integers specifying match values for
     :param: raster : keyword version of args0
     :param: match : keyword version of args1
+    :param: n_workers : number of workers to process Raster tiles with
     """
     # args[0]/raster=
     if raster is None:
@@ -333,10 +766,21 @@ def _local_binary_reclassify(raster=None, match=None, invert=None,
     if invert is None:
         # this is an optional arg
         invert = False
-    # if this is a Raster object, just drop
-    # raster down to a GeoRaster and pass on
+    # if this is a Raster object, process it tile-wise so that
+    # we never need more than a block of a (lazy) raster in memory
     if isinstance(raster, Raster):
-        raster = raster.to_georaster()
+        return np.ma.getdata(tile_apply(
+            rasters=raster,
+            function=partial(
+                _local_binary_reclassify_block,
+                match=match,
+                invert=invert,
+                dtype=dtype
+            ),
+            n_workers=n_workers
+        ).array)
+    elif isinstance(raster, np.ndarray):
+        return _local_binary_reclassify_block(raster, match, invert, dtype)
     # if this is a complete GeoRaster, try
     # to process the whole object
     if isinstance(raster, GeoRaster):
@@ -366,29 +810,105 @@ def _local_binary_reclassify(raster=None, match=None, invert=None,
                          "Generator that numpy can work with")
 
 
+def _local_binary_reclassify_block(block=None, match=None, invert=False,
+                                   dtype=np.uint8):
+    """
+    Per-block kernel for binary reclassification used with tile_apply
+    """
+    return np.array(
+        np.isin(np.ma.getdata(block), match, invert=invert),
+        dtype=dtype
+    )
+
+
 def _local_reclassify(*args):
     pass
 
 
-def _local_crop(raster=None, shape=None, *args):
-    """ wrapper for georasters.clip that will preform a crop operation on our input raster"""
+def _local_crop(raster=None, shape=None, tile_size=_DEFAULT_TILE_SIZE,
+                n_workers=None, backend="thread", dst_filename=None):
+    """
+    Crop our raster to the extent of a shape, masking the cells whose
+    centers fall outside of it. The crop runs tile-by-tile through
+    tile_apply, so only the window covering our shape is ever read
+    :param raster: Raster to crop (assumed north-up)
+    :param shape: shapely geometry, Vector, GeoDataFrame or GeoSeries
+    (in the raster's projection)
+    :param tile_size: see tile_apply
+    :param n_workers: see tile_apply
+    :param backend: see tile_apply
+    :param dst_filename: see tile_apply
+    :return: Raster
+    """
     # args[0] / raster=
     if raster is None:
         raise IndexError("invalid raster= argument specified")
     # args[1] / shape=
     if shape is None:
         raise IndexError("invalid shape=argument specified")
-    # sanity check and then do our crop operation
-    # and return to user
-    _enough_ram = _local_ram_sanity_check(raster.array)
-    if not _enough_ram['available'] and not raster._using_disc_caching:
-        logger.warning(" There doesn't apprear to be enough free memory"
-                       " available for our raster operation. You should use"
-                       "disc caching options with your dataset. Est Megabytes "
-                       "needed: %s", -1*_enough_ram['bytes']*0.0000001)
-    return raster.to_georaster().clip(shape)
+    _geometry = _local_crop_geometry(shape)
+    if shapely.is_empty(_geometry):
+        raise ValueError("shape= is empty -- there is nothing to crop to")
+    _window = _local_bounds_window(raster.geot, raster.shape[:2],
+                                   shapely.bounds(_geometry))
+    if _window is None:
+        raise ValueError("shape= doesn't overlap our raster")
+    shapely.prepare(_geometry)
+    return tile_apply(
+        raster,
+        partial(_local_crop_block, geometry=_geometry),
+        tile_size=tile_size,
+        n_workers=n_workers,
+        backend=backend,
+        dst_filename=dst_filename,
+        with_tile=True,
+        window=_window
+    )
 
 
+def _local_crop_geometry(shape=None):
+    """
+    Dissolve whatever we were handed as a crop shape into one geometry
+    """
+    if isinstance(shape, shapely.Geometry):
+        return shape
+    if hasattr(shape, 'geometries'):  # Vector
+        shape = shape.geometries
+    elif hasattr(shape, 'geometry'):  # GeoDataFrame / GeoSeries
+        shape = shape.geometry
+    return shapely.union_all(np.asarray(list(shape), dtype=object))
+
+
+def _local_bounds_window(geot=None, shape=None, bounds=None):
+    """
+    (row, col, nrows, ncols) window of a north-up raster covering some
+    (minx, miny, maxx, maxy) bounds, or None if they don't overlap
+    """
+    _minx, _miny, _maxx, _maxy = bounds
+    _c0 = int(np.floor((_minx - geot[0]) / geot[1]))
+    _c1 = int(np.ceil((_maxx - geot[0]) / geot[1]))
+    _r0 = int(np.floor((_maxy - geot[3]) / geot[5]))
+    _r1 = int(np.ceil((_miny - geot[3]) / geot[5]))
+    _r0, _c0 = max(_r0, 0), max(_c0, 0)
+    _r1, _c1 = min(_r1, shape[0]), min(_c1, shape[1])
+    if _r1 <= _r0 or _c1 <= _c0:
+        return None
+    return (_r0, _c0, _r1 - _r0, _c1 - _c0)
+
+
+def _local_crop_block(block=None, tile=None, geometry=None):
+    """
+    Mask the cells of a tile whose centers fall outside of geometry=
+    """
+    _geot = tile['geot']
+    _rows, _cols = np.indices(block.shape[:2]) + 0.5
+    _x = _geot[0] + _cols * _geot[1] + _rows * _geot[2]
+    _y = _geot[3] + _cols * _geot[4] + _rows * _geot[5]
+    _outside = ~shapely.contains_xy(geometry, _x, _y)
+    return np.ma.masked_array(
+        block, mask=np.ma.getmaskarray(block) | _outside
+    )
+
 
 def _local_clip(raster=None, shape=None):
     """clip is a hold-over from gr that performs a crop operation"""
@@ -434,19 +954,51 @@ def _local_reproject(*args):
 
 def _local_merge(rasters=None):
     """
-    Wrapper for georasters.merge that simplifies merging raster segments
-    returned by parallel operations.
+    Merges raster segments returned by parallel operations (e.g.,
+    _local_split) back into a single Raster. Each segment is placed using
+    its own geographic transformation and written straight into the
+    output, so a lazy segment is only read when it is placed. Lists of
+    GeoRasters are handed off to georasters.merge.
     """
     if rasters is None:
         raise IndexError("invalid raster= argument specified")
-    return merge(rasters)
-
+    if not all([isinstance(r, Raster) for r in rasters]):
+        return merge(rasters)
+    # position of each segment relative to the first segment's origin
+    _offsets = [_local_geot_offset(rasters[0].geot, r.geot) for r in rasters]
+    _row_min = min([o[0] for o in _offsets])
+    _col_min = min([o[1] for o in _offsets])
+    _rows = max([o[0] + r.shape[0] for o, r in zip(_offsets, rasters)])
+    _cols = max([o[1] + r.shape[1] for o, r in zip(_offsets, rasters)])
+    _shape = (_rows - _row_min, _cols - _col_min)
+    _data = None
+    _mask = np.ones(_shape, dtype=bool)  # uncovered cells are no data
+    for offset, segment in zip(_offsets, rasters):
+        _block = _local_read_window(
+            _local_tile_source(segment),
+            (0, 0, segment.shape[0], segment.shape[1])
+        )
+        if _data is None:
+            _data = np.full(_shape, rasters[0].ndv, dtype=_block.dtype)
+        _window = (
+            slice(offset[0] - _row_min, offset[0] - _row_min + segment.shape[0]),
+            slice(offset[1] - _col_min, offset[1] - _col_min + segment.shape[1])
+        )
+        _data[_window] = np.ma.filled(_block, rasters[0].ndv)
+        _mask[_window] = np.ma.getmaskarray(_block)
+    return _local_raster_like(
+        template=rasters[0],
+        array=np.ma.masked_array(_data, mask=_mask),
+        geot=_local_tile_geot(rasters[0].geot, _row_min, _col_min)
+    )
 
 
 def _local_split(raster=None, n=None):
     """
-    Stump for np._array_split. splits an input array into n (mostly) equal segments,
-    possibly for a future parallel operation.
+    Splits an input Raster into n (mostly) equal strips of rows, possibly
+    for a future parallel operation. Each segment is returned as a Raster
+    with its own geographic transformation so that the segments can be
+    processed independently and put back together with _local_merge.
     """
     # args[0]/raster=
     if raster is None:
@@ -454,10 +1006,796 @@ def _local_split(raster=None, n=None):
     #args[1]/n=
     if n is None:
         raise IndexError("invalid n= argument specified")
-    return np.array_split(
-        np.array(raster.array, dtype=str(raster.array.data.dtype)),
-        n
+    _rows, _cols = raster.shape
+    _source = _local_tile_source(raster)
+    _segments = []
+    for tile in _local_tiles(shape=raster.shape,
+                             tile_size=(int(np.ceil(_rows / float(n))), _cols),
+                             geot=raster.geot):
+        _segments.append(_local_raster_like(
+            template=raster,
+            array=_local_read_window(_source, tile['window']),
+            geot=tile['geot']
+        ))
+    return _segments
+
+
+def tile_apply(rasters=None, function=None, halo=0,
+               tile_size=_DEFAULT_TILE_SIZE, n_workers=None, backend="thread",
+               dtype=None, ndv=None, dst_filename=None, driver='GTiff',
+               with_tile=False, window=None):
+    """
+    Generic split-apply-merge executor for block-wise raster operations.
+    The extent of our input raster(s) is split into tiles, each tile
+    (padded with a halo of neighboring cells, if asked) is handed to
+    function=, and the result is written straight into the output array
+    or file as workers finish. Only the tiles in flight are ever held in
+    memory for lazy Rasters.
+    :param rasters: a Raster, numpy array, or list of aligned Rasters
+    :param function: per-block function that accepts one masked array
+    block per input raster and returns an array with the shape of the
+    (haloed) block or of the tile itself. Functions used with the
+    'process' backend need to be picklable (e.g., functools.partial
+    wrapping a module-level function)
+    :param halo: number of cells of overlap to read around each tile
+    :param tile_size: int or (rows, cols) tuple specifying the tile size
+    :param n_workers: number of workers. Tiles are processed serially
+    if this is None or 1
+    :param backend: 'thread' or 'process' worker pool
+    :param dtype: output data type (default: the dtype of function's output)
+    :param ndv: output no data value (default: that of the first raster)
+    :param dst_filename: if specified, tiles are written to this file with
+    GDAL instead of being kept in memory
+    :param driver: GDAL driver name used with dst_filename=
+    :param with_tile: if True, pass the tile description (row, col,
+    window, geot, ...) to function= as a tile= keyword argument
+    :param window: (row, col, nrows, ncols) subset of our rasters to
+    process -- only the tiles of this window are read, and the result
+    covers just the window (with a geographic transformation to match)
+    :return: Raster
+    """
+    # args[0]/rasters=
+    if rasters is None:
+        raise IndexError("invalid rasters= argument specified")
+    # args[1]/function=
+    if function is None:
+        raise IndexError("invalid function= argument specified")
+    if not isinstance(rasters, (list, tuple)):
+        rasters = [rasters]
+    _local_check_alignment(rasters)
+    _template = rasters[0]
+    if ndv is None:
+        ndv = _template.ndv if isinstance(_template, Raster) else \
+            _DEFAULT_NA_VALUE
+    _shape = _template.shape[:2]
+    _geot = _template.geot if isinstance(_template, Raster) else None
+    _origin = (0, 0)
+    if window is not None:
+        _origin, _shape = tuple(window[:2]), tuple(window[2:])
+        if min(_origin) < 0 or \
+                any(o + n > s for o, n, s in zip(_origin, _shape,
+                                                  _template.shape[:2])):
+            raise ValueError("window= %s falls outside of our rasters" %
+                             str(window))
+    # GDAL can't create (and we can't describe) a raster without any cells
+    if min(_shape) <= 0:
+        raise ValueError("there are no cells to process in a %s x %s "
+                         "extent" % tuple(_shape))
+    _data = _mask = _dst = _band = None
+    for tile, result in _local_map_tiles(
+            sources=[_local_tile_source(r) for r in rasters],
+            function=function,
+            tiles=_local_tiles(_shape, tile_size, halo, _geot, _origin,
+                               extent=_template.shape[:2]),
+            n_workers=n_workers,
+            backend=backend,
+            with_tile=with_tile):
+        result = _local_trim_tile(result, tile)
+        if dtype is None:
+            dtype = result.dtype
+        _block = np.ma.filled(result, ndv).astype(dtype, copy=False)
+        # write our result straight into the output
+        if dst_filename is not None:
+            if _dst is None:
+                _dst = _local_create_dataset(
+                    dst_filename, _shape, dtype, _template, ndv, driver,
+                    geot=_local_tile_geot(_geot, *_origin)
+                )
+                _band = _dst.GetRasterBand(1)
+            _band.WriteArray(_block, tile['col'], tile['row'])
+        else:
+            if _data is None:
+                _data = np.empty(_shape, dtype=dtype)
+                _mask = np.zeros(_shape, dtype=bool)
+            _window = (
+                slice(tile['row'], tile['row'] + tile['nrows']),
+                slice(tile['col'], tile['col'] + tile['ncols'])
+            )
+            _data[_window] = _block
+            _mask[_window] = np.ma.getmaskarray(result)
+    if dst_filename is not None:
+        _band.FlushCache()
+        _band = _dst = None  # close our file handle
+        return Raster(dst_filename, lazy=True)
+    return _local_raster_like(
+        template=_template,
+        array=np.ma.masked_array(_data, mask=_mask),
+        geot=_local_tile_geot(_geot, *_origin),
+        ndv=ndv
+    )
+
+
+def crosstab(rasters=None, names=None, levels=None, area=False,
+             tile_size=_DEFAULT_TILE_SIZE, n_workers=None, backend="thread"):
+    """
+    Streaming cross-tabulation of two or more aligned categorical rasters
+    (e.g., transitions between CDL years). The codes of each cell are
+    combined into a single integer key and counted with np.bincount one
+    tile at a time, so no raster is ever loaded in full. When there are
+    too many combinations of codes for a dense count, keys are tallied
+    sparsely, and when they can't be packed into a 64-bit integer at all,
+    the rows of codes themselves are tallied. Cells that are no
+    data in any input are skipped. A transition matrix is just a pivot of
+    the result, e.g. df.pivot(index='2016', columns='2017', values='count')
+    :param rasters: list of aligned Rasters with integer cell values
+    :param names: column names for each raster (default: filenames)
+    :param levels: list of (min, max) codes for each raster. 8-bit rasters
+    default to their type's range, otherwise a streaming min/max pass is
+    made first. Cells outside of the specified levels are skipped.
+    :param area: if True, add an 'area' column (count * cell area, in
+    squared map units)
+    :param tile_size: see tile_apply
+    :param n_workers: see tile_apply
+    :param backend: see tile_apply
+    :return: pandas DataFrame with one column per raster and a count column
+    """
+    # args[0]/rasters=
+    if rasters is None or len(rasters) < 2:
+        raise IndexError("invalid rasters= argument specified -- need a "
+                         "list of at least two rasters")
+    _local_check_alignment(rasters)
+    _sources = [_local_tile_source(r) for r in rasters]
+    for r in rasters:
+        _dtype = np.dtype(r.array.dtype if r.array is not None else r.dtype)
+        if _dtype.kind not in 'biu':
+            raise TypeError("crosstab is only defined for categorical "
+                            "(integer) rasters, not %s" % str(_dtype))
+    # args[1]/names=
+    if names is None:
+        names = [
+            os.path.splitext(os.path.basename(r.filename))[0]
+            if r.filename else "raster_" + str(i)
+            for i, r in enumerate(rasters)
+        ]
+    # args[2]/levels=
+    if levels is None:
+        levels = [_local_code_range(r, tile_size, n_workers, backend)
+                  for r in rasters]
+    levels = [(0, l) if np.isscalar(l) else tuple(l) for l in levels]
+    # mixed-radix strides used to pack each raster's code into our key --
+    # python ints, so that a product too large for int64 can't wrap around
+    _ranges = [int(hi) - int(lo) + 1 for lo, hi in levels]
+    _strides = [math.prod(_ranges[i + 1:]) for i in range(len(_ranges))]
+    _n_bins = math.prod(_ranges)
+    if _n_bins > np.iinfo(np.int64).max:
+        logger.warning("the levels of our rasters can't be packed into a "
+                       "64-bit key -- tallying rows of codes instead, "
+                       "which is slower")
+        _strides = None
+    _keys = _counts = None
+    for tile, result in _local_map_tiles(
+            sources=_sources,
+            function=partial(
+                _local_crosstab_block,
+                levels=levels,
+                strides=_strides,
+                n_bins=_n_bins
+            ),
+            tiles=_local_tiles(rasters[0].shape, tile_size),
+            n_workers=n_workers,
+            backend=backend):
+        if _n_bins <= _CROSSTAB_MAX_BINS:
+            _counts = result if _counts is None else _counts + result
+        else:
+            _keys, _counts = _local_merge_counts(_keys, _counts, *result)
+    if _n_bins <= _CROSSTAB_MAX_BINS:
+        _keys = np.flatnonzero(_counts)
+        _counts = _counts[_keys]
+    elif _keys is None:
+        _keys = np.empty((0, len(rasters)) if _strides is None else 0,
+                         dtype=np.int64)
+        _counts = np.array([], dtype=np.int64)
+    # unpack our keys back into codes
+    if _strides is None:
+        _table = pd.DataFrame(_keys, columns=names)
+    else:
+        _table = pd.DataFrame({
+            name: (_keys // stride) % rng + lo
+            for name, stride, rng, (lo, hi) in
+            zip(names, _strides, _ranges, levels)
+        }, columns=names)
+    _table['count'] = _counts
+    if area:
+        _geot = rasters[0].geot
+        _table['area'] = _counts * abs(_geot[1] * _geot[5] - _geot[2] * _geot[4])
+    return _table
+
+
+def _local_crosstab_block(*blocks, **kwargs):
+    """
+    Per-block kernel for crosstab : pack codes into keys and count them.
+    Without strides=, our keys are the (n, n_rasters) rows of codes
+    """
+    _levels = kwargs.get('levels')
+    _strides = kwargs.get('strides')
+    _n_bins = kwargs.get('n_bins')
+    _mask = np.zeros(blocks[0].shape, dtype=bool)
+    for block, (lo, hi) in zip(blocks, _levels):
+        _data = np.ma.getdata(block)
+        _mask |= np.ma.getmaskarray(block) | (_data < lo) | (_data > hi)
+    if _strides is None:
+        _rows = np.column_stack([
+            np.ma.getdata(block)[~_mask].astype(np.int64) for block in blocks
+        ])
+        return np.unique(_rows, axis=0, return_counts=True)
+    _key = np.zeros(blocks[0].shape, dtype=np.int64)
+    for block, (lo, hi), stride in zip(blocks, _levels, _strides):
+        _key += (np.ma.getdata(block).astype(np.int64) - lo) * stride
+    _key = _key[~_mask]
+    if _n_bins <= _CROSSTAB_MAX_BINS:
+        return np.bincount(_key, minlength=_n_bins)
+    return np.unique(_key, return_counts=True)
+
+
+def _local_merge_counts(keys=None, counts=None, other_keys=None,
+                        other_counts=None):
+    """
+    Merge two sparse (keys, counts) tallies. Keys are either 1-d or rows
+    of a 2-d array
+    """
+    if keys is None:
+        return other_keys, other_counts
+    _keys, _inverse = np.unique(
+        np.concatenate([keys, other_keys]), return_inverse=True,
+        axis=0 if keys.ndim > 1 else None
     )
+    return _keys, np.bincount(
+        _inverse.ravel(), weights=np.concatenate([counts, other_counts]),
+        minlength=len(_keys)
+    ).astype(np.int64)
+
+
+def _local_code_range(raster=None, tile_size=_DEFAULT_TILE_SIZE,
+                      n_workers=None, backend="thread"):
+    """
+    (min, max) of the codes in a categorical raster. 8-bit (and boolean)
+    rasters are assumed to span their type's range, anything else takes a
+    streaming pass over the raster
+    """
+    _dtype = np.dtype(raster.array.dtype if raster.array is not None
+                      else raster.dtype)
+    if _dtype.kind == 'b':
+        return (0, 1)
+    if _dtype.itemsize == 1:
+        return (int(np.iinfo(_dtype).min), int(np.iinfo(_dtype).max))
+    _lo, _hi = None, None
+    for tile, result in _local_map_tiles(
+            sources=[_local_tile_source(raster)],
+            function=_local_minmax_block,
+            tiles=_local_tiles(raster.shape, tile_size),
+            n_workers=n_workers,
+            backend=backend):
+        if result is None:
+            continue
+        _lo = result[0] if _lo is None else min(_lo, result[0])
+        _hi = result[1] if _hi is None else max(_hi, result[1])
+    if _lo is None:
+        return (0, 0)
+    return (int(_lo), int(_hi))
+
+
+def _local_minmax_block(block=None):
+    """
+    (min, max) of the valid cells in a block, or None if there aren't any
+    """
+    _valid = block.compressed() if isinstance(block, np.ma.MaskedArray) \
+        else np.ravel(block)
+    if _valid.size == 0:
+        return None
+    return (_valid.min(), _valid.max())
+
+
+def _local_raster_stats(raster=None, quantiles=_DEFAULT_QUANTILES,
+                        refresh=False, tile_size=_DEFAULT_TILE_SIZE,
+                        n_workers=None, backend="thread"):
+    """
+    Summary statistics for a Raster, computed in a single streaming pass
+    over our tiles. Results (and the quantile summary they came from) are
+    cached on the Raster and, for lazy Rasters, in a JSON sidecar next to
+    the source file that is keyed by the file's size and mtime.
+    """
+    _cache = _local_stats_cache(raster, refresh)
+    if 'summary' not in _cache:
+        _summary = None
+        for tile, result in _local_map_tiles(
+                sources=[_local_tile_source(raster)],
+                function=_local_stats_block,
+                tiles=_local_tiles(raster.shape, tile_size),
+                n_workers=n_workers,
+                backend=backend):
+            _summary = _local_merge_stats(_summary, result)
+        if _summary is None:
+            _summary = {'count': 0}
+        _cache['summary'] = _local_finish_stats(_summary)
+        _local_write_stats_cache(raster, _cache)
+    _summary = _cache['summary']
+    _stats = {
+        k: _summary.get(k) for k in ('count', 'min', 'max', 'mean', 'std')
+    }
+    if quantiles is not None:
+        _values, _weights = _summary.get('values', []), \
+            _summary.get('weights', [])
+        _stats['quantiles'] = dict(zip(
+            quantiles,
+            _local_weighted_quantiles(_values, _weights, quantiles)
+        ))
+    return _stats
+
+
+def _local_raster_histogram(raster=None, bins=256, range=None, refresh=False,
+                            tile_size=_DEFAULT_TILE_SIZE, n_workers=None,
+                            backend="thread"):
+    """
+    Histogram of the valid cells of a Raster. Our bin range defaults to the
+    min and max from (cached) stats. Integer rasters with exact value counts
+    in their stats don't need another pass over the raster.
+    """
+    if range is None:
+        _stats = _local_raster_stats(raster, None, refresh, tile_size,
+                                     n_workers, backend)
+        if not _stats['count']:
+            return np.zeros(bins, dtype=np.int64), np.linspace(0, 1, bins + 1)
+        range = (_stats['min'], _stats['max'])
+        refresh = False  # our cache was just refreshed by stats()
+    _cache = _local_stats_cache(raster, refresh)
+    _key = "%s:%s:%s" % (bins, repr(float(range[0])), repr(float(range[1])))
+    _histograms = _cache.setdefault('histograms', {})
+    if _key not in _histograms:
+        _edges = np.linspace(range[0], range[1], bins + 1)
+        _summary = _cache.get('summary', {})
+        if _summary.get('exact'):
+            _counts = np.histogram(
+                _summary['values'], bins=_edges, weights=_summary['weights']
+            )[0].astype(np.int64)
+        else:
+            _counts = np.zeros(bins, dtype=np.int64)
+            for tile, result in _local_map_tiles(
+                    sources=[_local_tile_source(raster)],
+                    function=partial(_local_histogram_block, edges=_edges),
+                    tiles=_local_tiles(raster.shape, tile_size),
+                    n_workers=n_workers,
+                    backend=backend):
+                _counts += result
+        _histograms[_key] = {
+            'counts': _counts.tolist(),
+            'edges': _edges.tolist()
+        }
+        _local_write_stats_cache(raster, _cache)
+    return (np.array(_histograms[_key]['counts'], dtype=np.int64),
+            np.array(_histograms[_key]['edges']))
+
+
+def _local_stats_block(block=None):
+    """
+    Per-block kernel for our streaming stats : moments, extremes, and either
+    exact value counts (for 8 and 16-bit integer rasters) or a quantile
+    summary of the block's valid cells
+    """
+    _valid = block.compressed() if isinstance(block, np.ma.MaskedArray) \
+        else np.ravel(block)
+    if _valid.dtype.kind == 'f':
+        _valid = _valid[np.isfinite(_valid)]
+    if _valid.size == 0:
+        return None
+    _mean = _valid.mean(dtype=np.float64)
+    _summary = {
+        'count': int(_valid.size),
+        'min': _valid.min().item(),
+        'max': _valid.max().item(),
+        'mean': float(_mean),
+        'm2': float(np.sum((_valid - _mean)**2, dtype=np.float64)),
+        'exact': _valid.dtype.kind in 'biu' and _valid.dtype.itemsize <= 2
+    }
+    if _summary['exact']:
+        _summary['values'], _summary['weights'] = \
+            np.unique(_valid, return_counts=True)
+    elif _valid.size <= _SKETCH_SIZE:
+        _summary['values'] = np.sort(_valid)
+        _summary['weights'] = np.ones(_valid.size)
+    else:
+        _summary['values'] = np.quantile(_valid, _local_sketch_ranks())
+        _summary['weights'] = np.full(_SKETCH_SIZE,
+                                      _valid.size / float(_SKETCH_SIZE))
+    return _summary
+
+
+def _local_merge_stats(summary=None, other=None):
+    """
+    Combine two block summaries. Means and variances are merged with Chan
+    et al.'s parallel algorithm and quantile summaries are compressed back
+    down to _SKETCH_SIZE points whenever they grow too large.
+    """
+    if other is None:
+        return summary
+    if summary is None:
+        return other
+    _n = summary['count'] + other['count']
+    _delta = other['mean'] - summary['mean']
+    _merged = {
+        'count': _n,
+        'min': min(summary['min'], other['min']),
+        'max': max(summary['max'], other['max']),
+        'mean': summary['mean'] + _delta * other['count'] / float(_n),
+        'm2': summary['m2'] + other['m2'] +
+        _delta**2 * summary['count'] * other['count'] / float(_n),
+        'exact': summary['exact'] and other['exact']
+    }
+    if _merged['exact']:
+        _merged['values'], _merged['weights'] = _local_merge_counts(
+            summary['values'], summary['weights'],
+            other['values'], other['weights']
+        )
+    else:
+        _merged['values'] = np.concatenate(
+            [summary['values'], other['values']])
+        _merged['weights'] = np.concatenate(
+            [summary['weights'], other['weights']])
+        if len(_merged['values']) > 2 * _SKETCH_SIZE:
+            _total = float(np.sum(_merged['weights']))
+            _merged['values'] = _local_weighted_quantiles(
+                _merged['values'], _merged['weights'], _local_sketch_ranks()
+            )
+            _merged['weights'] = np.full(_SKETCH_SIZE, _total / _SKETCH_SIZE)
+    return _merged
+
+
+def _local_finish_stats(summary=None):
+    """
+    Turn a merged summary into something we can serialize as JSON
+    """
+    if not summary['count']:
+        return {'count': 0, 'min': None, 'max': None, 'mean': None,
+                'std': None, 'exact': True, 'values': [], 'weights': []}
+    return {
+        'count': int(summary['count']),
+        'min': summary['min'],
+        'max': summary['max'],
+        'mean': summary['mean'],
+        'std': float(np.sqrt(summary['m2'] / summary['count'])),
+        'exact': bool(summary['exact']),
+        'values': np.asarray(summary['values']).tolist(),
+        'weights': np.asarray(summary['weights']).tolist()
+    }
+
+
+def _local_weighted_quantiles(values=None, weights=None, quantiles=None):
+    """
+    Quantiles of a set of weighted values (i.e., value counts or the points
+    of a quantile summary). Exact for value counts.
+    """
+    _values = np.asarray(values, dtype=np.float64)
+    if _values.size == 0:
+        return [None for q in quantiles]
+    _weights = np.asarray(weights, dtype=np.float64)
+    _order = np.argsort(_values, kind='mergesort')
+    _values, _weights = _values[_order], _weights[_order]
+    # treat our values as a sorted multiset where each value is repeated
+    # weight times and interpolate linearly between ranks, like np.quantile
+    _upper = np.cumsum(_weights)
+    _ranks = np.asarray(quantiles, dtype=np.float64) * (_upper[-1] - 1)
+    _floor = np.floor(_ranks)
+    _last = len(_values) - 1
+    _lo = _values[np.clip(np.searchsorted(_upper, _floor, side='right'),
+                          0, _last)]
+    _hi = _values[np.clip(np.searchsorted(_upper, _floor + 1, side='right'),
+                          0, _last)]
+    return (_lo + (_ranks - _floor) * (_hi - _lo)).tolist()
+
+
+def _local_sketch_ranks():
+    """
+    Quantiles that a summary of _SKETCH_SIZE points is built from. Each
+    point sits in the middle of the slice of cells it stands in for.
+    """
+    return (np.arange(_SKETCH_SIZE) + 0.5) / _SKETCH_SIZE
+
+
+def _local_histogram_block(block=None, edges=None):
+    """
+    Per-block kernel for our histograms
+    """
+    _valid = block.compressed() if isinstance(block, np.ma.MaskedArray) \
+        else np.ravel(block)
+    return np.histogram(_valid, bins=edges)[0].astype(np.int64)
+
+
+def _local_stats_cache(raster=None, refresh=False):
+    """
+    Our stats cache for a Raster : an in-memory dict on the Raster object
+    that lazy Rasters back with a JSON sidecar file
+    """
+    if refresh:
+        raster._stats = {}
+    if raster._stats is None:
+        raster._stats = {}
+        if raster.array is None and raster.filename:
+            raster._stats = _local_read_stats_cache(raster.filename)
+    return raster._stats
+
+
+def _local_stats_sidecar(filename=None):
+    """
+    Path to the stats sidecar of a raster file, and the (size, mtime) key
+    that a sidecar has to match to be valid
+    """
+    _stat = os.stat(filename)
+    return filename + _STATS_SIDECAR_SUFFIX, [_stat.st_size, _stat.st_mtime]
+
+
+def _local_read_stats_cache(filename=None):
+    """
+    Read a stats sidecar, ignoring it if it's stale or unreadable
+    """
+    try:
+        _sidecar, _key = _local_stats_sidecar(filename)
+        with open(_sidecar, 'r') as f:
+            _cache = json.load(f)
+        if _cache.pop('key', None) == _key:
+            return _cache
+    except (OSError, IOError, ValueError):
+        pass
+    return {}
+
+
+def _local_write_stats_cache(raster=None, cache=None):
+    """
+    Persist our stats cache for a lazy Raster next to its source file
+    """
+    if raster.array is not None or not raster.filename:
+        return
+    try:
+        _sidecar, _key = _local_stats_sidecar(raster.filename)
+        with open(_sidecar, 'w') as f:
+            json.dump(dict(cache, key=_key), f)
+    except (OSError, IOError) as e:
+        logger.warning("failed to write a stats sidecar for %s : %s",
+                       raster.filename, e)
+
+
+def _local_tiles(shape=None, tile_size=_DEFAULT_TILE_SIZE, halo=0,
+                 geot=None, origin=(0, 0), extent=None):
+    """
+    Generator that will describe the tiles covering an array of some
+    shape as dicts with keys for the tile's position (row, col), its
+    dimensions (nrows, ncols), the read window including our halo
+    (row, col, nrows, ncols), and the tile's geographic transformation.
+    With origin=, our array is a (row, col)-offset window of a larger
+    raster of shape extent= : tile positions are relative to the window,
+    while read windows and geographic transformations are relative to the
+    raster, and halos reach past the window to the raster's edge
+    """
+    # args[0]/shape=
+    if shape is None:
+        raise IndexError("invalid shape= argument specified")
+    if not isinstance(tile_size, (list, tuple)):
+        tile_size = (tile_size, tile_size)
+    _rows, _cols = shape[:2]
+    if extent is None:
+        extent = (origin[0] + _rows, origin[1] + _cols)
+    for row in range(0, _rows, tile_size[0]):
+        for col in range(0, _cols, tile_size[1]):
+            _nrows = min(tile_size[0], _rows - row)
+            _ncols = min(tile_size[1], _cols - col)
+            _r0 = max(row + origin[0] - halo, 0)
+            _c0 = max(col + origin[1] - halo, 0)
+            _r1 = min(row + origin[0] + _nrows + halo, extent[0])
+            _c1 = min(col + origin[1] + _ncols + halo, extent[1])
+            yield {
+                'row': row,
+                'col': col,
+                'nrows': _nrows,
+                'ncols': _ncols,
+                'window': (_r0, _c0, _r1 - _r0, _c1 - _c0),
+                'origin': tuple(origin),
+                'geot': _local_tile_geot(geot, row + origin[0],
+                                         col + origin[1])
+            }
+
+
+def _local_tile_geot(geot=None, row=0, col=0):
+    """
+    Geographic transformation for a window whose upper-left cell is at
+    row, col of a raster with transformation geot=
+    """
+    if geot is None:
+        return None
+    return (
+        geot[0] + col * geot[1] + row * geot[2], geot[1], geot[2],
+        geot[3] + col * geot[4] + row * geot[5], geot[4], geot[5]
+    )
+
+
+def _local_geot_offset(geot=None, other=None):
+    """
+    (row, col) offset of the origin of other= relative to the origin of
+    geot=. Assumes that both share a (north-up) cell size.
+    """
+    return (
+        int(round((other[3] - geot[3]) / geot[5])),
+        int(round((other[0] - geot[0]) / geot[1]))
+    )
+
+
+def _local_check_alignment(rasters=None):
+    """
+    Raise a ValueError if a list of Rasters (or arrays) don't share
+    dimensions and a geographic transformation
+    """
+    _shape = rasters[0].shape[:2]
+    _geot = getattr(rasters[0], 'geot', None)
+    for r in rasters[1:]:
+        if r.shape[:2] != _shape:
+            raise ValueError("rasters are not aligned -- dimensions differ: "
+                             "%s vs. %s" % (str(_shape), str(r.shape[:2])))
+        _other = getattr(r, 'geot', None)
+        if _geot is not None and _other is not None and \
+                not np.allclose(_geot, _other):
+            raise ValueError("rasters are not aligned -- geographic "
+                             "transformations differ: %s vs. %s" %
+                             (str(_geot), str(_other)))
+
+
+def _local_tile_source(raster=None):
+    """
+    Something a tile worker can read a window from : an in-memory array,
+    or a (filename, ndv, dtype) description of a lazy Raster's file
+    """
+    if isinstance(raster, Raster):
+        if raster.array is None:
+            return (raster.filename, raster.ndv, raster.dtype)
+        return raster.array
+    elif isinstance(raster, np.ndarray):
+        return raster
+    raise ValueError("tile sources should be Raster objects or numpy arrays")
+
+
+def _local_read_window(source=None, window=None):
+    """
+    Read a (row, col, nrows, ncols) window from a tile source as a masked
+    array. File sources are opened with GDAL for each read so that
+    workers never share a dataset handle.
+    """
+    _r0, _c0, _nrows, _ncols = window
+    if isinstance(source, np.ndarray):
+        return source[_r0:_r0 + _nrows, _c0:_c0 + _ncols]
+    _filename, _ndv, _dtype = source
+    _ds = gdal.Open(_filename)
+    _block = _ds.GetRasterBand(1).ReadAsArray(_c0, _r0, _ncols, _nrows)
+    _ds = None
+    if _dtype is not None:
+        _block = _block.astype(_dtype, copy=False)
+    return np.ma.masked_array(_block, mask=_block == _ndv, fill_value=_ndv)
+
+
+def _local_run_tile(function=None, sources=None, tile=None, with_tile=False):
+    """
+    Worker task : read our tile's blocks and apply function= to them
+    """
+    _blocks = [
+        s if isinstance(s, np.ndarray) else
+        _local_read_window(s, tile['window']) for s in sources
+    ]
+    if with_tile:
+        return tile, function(*_blocks, tile=tile)
+    return tile, function(*_blocks)
+
+
+def _local_map_tiles(sources=None, function=None, tiles=None, n_workers=None,
+                     backend="thread", with_tile=False):
+    """
+    Generator that applies function= to each tile and yields (tile, result)
+    tuples as tiles finish. In-memory sources are sliced before a tile is
+    handed to a worker (so process workers aren't sent the full array) and
+    the number of tiles in flight is capped at twice our worker count.
+    """
+    if backend not in ("thread", "process"):
+        raise ValueError("backend= should be 'thread' or 'process'")
+
+    def _blocks(tile):
+        # slice in-memory arrays now, files are read by the worker
+        return [
+            _local_read_window(s, tile['window'])
+            if isinstance(s, np.ndarray) else s for s in sources
+        ]
+
+    if not n_workers or n_workers < 2:
+        for tile in tiles:
+            yield _local_run_tile(function, _blocks(tile), tile, with_tile)
+        return
+    _executor = ThreadPoolExecutor if backend == "thread" else \
+        ProcessPoolExecutor
+    with _executor(max_workers=n_workers) as pool:
+        _pending = set()
+        for tile in tiles:
+            _pending.add(pool.submit(
+                _local_run_tile, function, _blocks(tile), tile, with_tile
+            ))
+            if len(_pending) >= 2 * n_workers:
+                _done, _pending = wait(_pending, return_when=FIRST_COMPLETED)
+                for future in _done:
+                    yield future.result()
+        for future in as_completed(_pending):
+            yield future.result()
+
+
+def _local_trim_tile(result=None, tile=None):
+    """
+    Drop the halo from a block returned by a tile function
+    """
+    if result.shape[:2] == (tile['nrows'], tile['ncols']):
+        return result
+    _r0, _c0 = tile['window'][:2]
+    _origin = tile.get('origin', (0, 0))
+    _row = tile['row'] + _origin[0] - _r0
+    _col = tile['col'] + _origin[1] - _c0
+    return result[_row:_row + tile['nrows'], _col:_col + tile['ncols']]
+
+
+def _local_create_dataset(filename=None, shape=None, dtype=None,
+                          template=None, ndv=None, driver='GTiff',
+                          geot=None):
+    """
+    Create a single-band GDAL dataset that tiles can be written into. Our
+    geographic transformation defaults to the template's
+    """
+    _dst = gdal.GetDriverByName(driver).Create(
+        filename, shape[1], shape[0], 1,
+        gdal_array.NumericTypeCodeToGDALTypeCode(np.dtype(dtype).type)
+    )
+    if geot is None and isinstance(template, Raster):
+        geot = template.geot
+    if geot is not None:
+        _dst.SetGeoTransform(geot)
+    if isinstance(template, Raster):
+        if template.projection is not None:
+            _dst.SetProjection(
+                template.projection.ExportToWkt()
+                if hasattr(template.projection, 'ExportToWkt')
+                else str(template.projection)
+            )
+    _dst.GetRasterBand(1).SetNoDataValue(ndv)
+    return _dst
+
+
+def _local_raster_like(template=None, array=None, geot=None, ndv=None):
+    """
+    Build a new in-memory Raster that shares the meta information of a
+    template Raster (or sane defaults for a numpy array)
+    """
+    _raster = Raster()
+    if isinstance(template, Raster):
+        _raster.ndv = template.ndv
+        _raster.projection = template.projection
+        _raster.dtype = template.dtype
+    if ndv is not None:
+        _raster.ndv = ndv
+    _raster.geot = geot
+    if array is not None:
+        _raster.dtype = array.dtype
+        _raster.array = array
+        # GeoRasters keeps raster dimensions in our cell size properties
+        _raster.y_cell_size, _raster.x_cell_size = array.shape[:2]
+    return _raster
 
 
 def _local_ram_sanity_check(array=None):
@@ -12,23 +12,79 @@ __status__ = "Testing"
 
 
 import os
+import re
+import threading
 import fiona
 import geopandas as gp
 import pandas as pd
+import numpy as np
 import json
 
 import pyproj
+import shapely
+import hashlib
 
+from functools import partial
+from fiona.errors import DriverError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    FIRST_COMPLETED, wait, as_completed
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
 from shapely.geometry import *
-from beatbox.do import Local, EE, Do
 
 import logging
 
 _DEFAULT_EPSG = 2163
+_DEFAULT_CHUNK_SIZE = 50000  # features per batch for bulk i/o operations
+# process-wide caches of parsed CRS objects and CRS transformers
+_CRS_CACHE = {}
+_TRANSFORMER_CACHE = {}
+# spatial partitioning of features (see Vector.partition)
+_PARTITION_METHODS = ('hilbert', 'grid', 'quadtree')
+_HILBERT_ORDER = 16  # Hilbert curves are drawn on a 2**order grid
+_QUADTREE_MAX_DEPTH = 32
+_PARTITIONS_PER_WORKER = 4  # partitions per worker for Vector.buffer_dissolve
+# binary cache of parsed vector files (see Vector.read)
+_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'beatbox')
+_CACHE_GEOMETRY_COLUMN = '__wkb_geometry'
+_CACHE_MAX_QUERIES = 8  # cached reads (column / filter sets) kept per source
+# files that belong to a shapefile and should invalidate its cache
+_SHAPEFILE_SIDECARS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+# fiona drivers that we can guess from a file extension
+_VECTOR_DRIVERS = {
+    '.shp': 'ESRI Shapefile',
+    '.gpkg': 'GPKG',
+    '.fgb': 'FlatGeobuf',
+    '.geojson': 'GeoJSON',
+    '.json': 'GeoJSON'
+}
+# drivers that accept a SPATIAL_INDEX layer creation option
+_INDEXED_DRIVERS = ('GPKG', 'FlatGeobuf', 'ESRI Shapefile')
+# drivers that reserve a column name for their feature ids -- GDAL would
+# silently consume an attribute with this name as the id
+_RESERVED_COLUMNS = {'GPKG': 'fid'}
+# fiona geometry type names for shapely's type ids
+_GEOMETRY_TYPES = {
+    0: 'Point',
+    1: 'LineString',
+    2: 'LineString',  # LinearRing
+    3: 'Polygon',
+    4: 'MultiPoint',
+    5: 'MultiLineString',
+    6: 'MultiPolygon',
+    7: 'GeometryCollection'
+}
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# pyarrow is only needed for our binary vector cache
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
 # Fickle beast handlers for Earth Engine
 try:
     import ee
@@ -40,7 +96,8 @@ except Exception:
 
 
 class Vector(object):
-    def __init__(self, filename=None, json=None):
+    def __init__(self, filename=None, json=None, cache=False, columns=None,
+                 where=None, bbox=None):
         """Handles file input/output operations for shapefiles \
         using fiona and shapely built-ins and performs select \
         spatial modifications on vector datasets
@@ -49,30 +106,41 @@ class Vector(object):
         filename= the full path filename to a vector
         dataset (typically a .shp file)
         json=jsonified text
+        cache= keep a binary copy of the parsed file in our cache directory
+        (see read)
+        columns= only read these attribute columns from filename
+        where= only read features matching this OGR SQL attribute filter
+        bbox= only read features intersecting this (minx, miny, maxx, maxy)
+        bounding box
         Positional arguments:
         1st= if no filname keyword argument was used,
         attempt to read the first positional argument
         """
-        self._geometries = []
+        self._geometries = _as_geometry_array([])
         self._attributes = {}
         self._filename = []
         self._schema = []
         self._crs = []
         self._crs_wkt = []
+        self._sindex = None  # (geometries, STRtree) built on demand
         # args[0] / filename= / json=
         if filename is None and json is None:
             pass  # allow an empty specification
+        # first argument is a GeoPandas object?
+        elif isinstance(filename, gp.GeoDataFrame):
+            _vector = Vector.from_geodataframe(filename)
+            self._geometries = _vector._geometries
+            self._attributes = _vector._attributes
+            self._crs = _vector._crs
+            self._crs_wkt = _vector._crs_wkt
         elif is_valid_file(filename):
             self.filename = filename
-            self.read(filename=self.filename)
+            self.read(filename=self.filename, cache=cache, columns=columns,
+                      where=where, bbox=bbox)
         elif is_json(filename):
-            self.read(filename=filename)
+            self.read(json=filename)
         elif is_json(json):
             self.read(json=json)
-        # first argument is a GeoPandas object?
-        elif isinstance(filename, gp):
-            self.read(json=filename.to_json())
-            
 
     def __copy__(self):
         """ simple copy method that creates a new instance of a vector class and assigns \
@@ -85,6 +153,7 @@ class Vector(object):
         _vector_geom._crs_wkt = self._crs_wkt
         _vector_geom._schema = self._schema
         _vector_geom._filename = self._filename
+        _vector_geom._sindex = self._sindex
 
         return _vector_geom
 
@@ -151,22 +220,26 @@ class Vector(object):
 
     @geometries.setter
     def geometries(self, *args):
-        try:
-            self._geometries = args[0]
-        except Exception as e:
-            raise e
+        """ decorated setter for our geometries. Geometries are kept as a
+        numpy array of shapely geometries so that shapely's vectorized
+        functions can operate on them without python-level loops
+        """
         # default behavior is to accept shapely geometry as input, but a
         # user may pass a string path to a shapefile and we will handle the input
         # and write it to output -- this is essentially a file copy operation
+        if isinstance(args[0], str):
+            try:
+                self.read(args[0])
+            # did you pass an incorrect filename?
+            except (OSError, ValueError):
+                raise OSError("Unable to read file passed passed by user")
+            return
         try:
-            self.read(self._geometries)
-        # did you pass an incorrect filename?
-        except OSError:
-            raise OSError("Unable to read file passed passed by user")
-        # it can't be a string path -- assume is a Collection or Geometry object
+            self._geometries = _as_geometry_array(args[0])
+        # it can't be a geometry array -- assume is a Collection of features
         # and pass it on
-        except Exception:
-            self._fiona_to_shapely_geometries(geometries=self._geometries)
+        except TypeError:
+            self._fiona_to_shapely_geometries(geometries=args[0])
 
     @property
     def attributes(self):
@@ -185,12 +258,12 @@ class Vector(object):
         :param geometries:
         :return: None
         """
-        self._geometries = [shape(ft['geometry']) for ft in list(geometries)]
+        self._geometries = _features_to_columns(geometries)[0]
 
     def _json_string_to_shapely_geometries(self, string=None):
         """
         Accepts a json string and parses it into a shapely feature collection
-        stored internally
+        stored internally, along with the attributes of each feature
         :param string: GeoJSON string containing a feature collection to parse
         :return: None
         """
@@ -209,24 +282,46 @@ class Vector(object):
                            "Is this not a GeoJSON string?")
         try:
             self.crs = _json['crs']
+            # named GeoJSON CRS objects just wrap an identifier
+            if 'properties' in self.crs:
+                self.crs = self.crs['properties']['name']
         except KeyError:
             # nobody uses CRS with GeoJSON -- but it's default
             # projection is always(?) EPSG:4326
             logger.warning("no crs property defined for json input "
                            "-- assuming EPSG:4326")
-            self.crs = {'crs': 'epsg:4326'}
-        # listcomp : iterate over our features and convert them
-        # to shape geometries
-        self._geometries = [shape(ft['geometry']) for ft in _features]
+            self.crs = {'init': 'epsg:4326'}
+        # single pass over our features for geometries and attributes
+        self._geometries, self._attributes = _features_to_columns(_features)
 
-    def read(self, filename=None, json=None):
+    def read(self, filename=None, json=None, cache=False, columns=None,
+             where=None, bbox=None):
         """
         Accepts a GeoJSON string or string path to a shapefile that is read
-        and used to assign internal class variables for CRS, geometries, and schema
+        and used to assign internal class variables for CRS, geometries, and schema.
+        Features are decoded in a single pass into a geometry array and typed
+        attribute columns.
 
         Keyword arguments:
         filename= the full path filename to a vector dataset (typically a .shp file)
         string= json string that we should assign our geometries from
+        cache= persist the parsed file as an Arrow (Feather) table with WKB
+        geometries in our cache directory ($BEATBOX_CACHE_DIR, or
+        ~/.cache/beatbox), keyed by the path, size and modification time of
+        the source, and memory-map that table on later reads instead of
+        decoding the source with fiona again (requires pyarrow). Cached
+        copies of an older version of the source are removed, and only the
+        most recently cached reads of each source are kept (see
+        _CACHE_MAX_QUERIES)
+        columns= list of attribute columns to read (an empty list reads
+        geometries only). Other columns are never decoded by OGR, for
+        drivers that can ignore fields (GeoJSON can't -- its other columns
+        are decoded by OGR and dropped)
+        where= OGR SQL WHERE clause used to filter features by attribute
+        (e.g., "acres > 40 AND county = 'Finney'")
+        bbox= (minx, miny, maxx, maxy) bounding box (or a geometry whose
+        bounds should be used), in the CRS of the file, used as an OGR spatial
+        filter
 
         Positional arguments:
         1st = either a full path to a file or a geojson string object
@@ -234,30 +329,137 @@ class Vector(object):
         """
         # args[0] / -filename / -string
         if is_valid_file(filename):
-            json = None
             self.filename = filename
         # if this is a json string, parse out our geometry and attribute
         # data accordingly
-        elif is_json(json):
+        elif is_json(json) or is_json(filename):
             self.filename = None
-            self._json_string_to_shapely_geometries(string=json)            
+            self._json_string_to_shapely_geometries(
+                string=json if json is not None else filename
+            )
+            return
+        else:
+            raise ValueError("filename= is not a valid file and json= is not "
+                             "a valid json string")
+        if cache and pa is None:
+            logger.warning("pyarrow is not available -- cache= will be "
+                           "ignored")
+            cache = False
+        if cache:
+            _cache_file = _vector_cache_file(
+                filename, columns=columns, where=where, bbox=bbox
+            )
+            if os.path.exists(_cache_file):
+                try:
+                    self._read_cache(_cache_file)
+                    return
+                except Exception as e:
+                    logger.warning("failed to read cached copy of %s (%s) "
+                                   "-- reading the source file instead",
+                                   filename, e)
+        if hasattr(bbox, 'bounds'):
+            bbox = tuple(bbox.bounds)
         # by default, process this as a file and parse out or data using Fiona
-        _shape_collection = fiona.open(filename)
-        self._crs = _shape_collection.crs
-        self._crs_wkt = _shape_collection.crs_wkt
-        # parse our dict of geometries into an actual shapely list
-        self._fiona_to_shapely_geometries(geometries=_shape_collection)
-        self._schema = _shape_collection.schema
-        # process our attributes
-        self._attributes = pd.DataFrame(
-            [dict(item['properties']) for item in _shape_collection]
+        # (pushing our column selection and filters down to OGR). Fields
+        # that our where= clause filters on have to be read too
+        _fields = None if columns is None else list(columns)
+        if _fields is not None and where is not None:
+            with fiona.open(filename) as _shape_collection:
+                _fields += [
+                    f for f in _where_fields(
+                        where, list(_shape_collection.schema['properties']))
+                    if f not in _fields
+                ]
+        with _open_collection(filename, _fields) as _shape_collection:
+            self._crs = _shape_collection.crs
+            self._crs_wkt = _shape_collection.crs_wkt
+            self._schema = _shape_collection.schema
+            if columns is not None:
+                self._schema = dict(self._schema, properties=dict(
+                    (k, v) for k, v in self._schema['properties'].items()
+                    if k in columns
+                ))
+            if where is None and bbox is None:
+                _features = _shape_collection
+            else:
+                _features = _shape_collection.filter(bbox=bbox, where=where)
+            self._geometries, self._attributes = _features_to_columns(
+                _features,
+                properties=self._schema['properties']
+            )
+        if cache:
+            try:
+                self._write_cache(_cache_file)
+                _prune_cache(_cache_file)
+            except Exception as e:
+                logger.warning("failed to cache a copy of %s : %s",
+                               filename, e)
+
+    def _write_cache(self, filename=None):
+        """ write our features to an uncompressed Arrow IPC (Feather) file
+        that can be memory-mapped by _read_cache. The file is written under
+        a temporary name and moved into place so that a concurrent reader
+        never sees a partial cache
+        """
+        if isinstance(self._attributes, pd.DataFrame):
+            _table = pa.Table.from_pandas(self._attributes,
+                                          preserve_index=False)
+        else:
+            _table = pa.table({})
+        _table = _table.append_column(
+            _CACHE_GEOMETRY_COLUMN,
+            pa.array(shapely.to_wkb(self._geometries), type=pa.binary())
         )
+        _table = _table.replace_schema_metadata(dict(
+            (_table.schema.metadata or {}),
+            beatbox=json.dumps({
+                'crs_wkt': self._crs_wkt or None,
+                'schema': self._schema or None
+            })
+        ))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        _tmp = filename + '.' + str(os.getpid()) + '.tmp'
+        with pa.OSFile(_tmp, 'wb') as _sink:
+            with pa.ipc.new_file(_sink, _table.schema) as _writer:
+                _writer.write_table(_table)
+        os.replace(_tmp, filename)
 
-    def write(self, filename=None, type=None):
-        """ wrapper for fiona.open that will write in-class geometry data to disk
+    def _read_cache(self, filename=None):
+        """ memory-map a cache file written by _write_cache and assign our
+        geometries, attributes, CRS, and schema from it
+        """
+        with pa.memory_map(filename, 'r') as _source:
+            _table = pa.ipc.open_file(_source).read_all()
+        _metadata = json.loads(_table.schema.metadata[b'beatbox'])
+        self._geometries = _as_geometry_array(shapely.from_wkb(
+            _table.column(_CACHE_GEOMETRY_COLUMN).to_numpy(
+                zero_copy_only=False)
+        ))
+        self._attributes = _table.drop_columns([_CACHE_GEOMETRY_COLUMN])\
+            .to_pandas()
+        if len(self._attributes.columns) == 0:
+            self._attributes = pd.DataFrame(
+                index=pd.RangeIndex(len(self._geometries))
+            )
+        self._schema = _metadata['schema'] or []
+        self._crs_wkt = _metadata['crs_wkt'] or []
+        self._crs = fiona.crs.CRS.from_wkt(self._crs_wkt) \
+            if self._crs_wkt else []
+
+    def write(self, filename=None, type=None, chunk_size=_DEFAULT_CHUNK_SIZE,
+              spatial_index=True):
+        """ wrapper for fiona.open that will write in-class geometry and
+        attribute data to disk. Features are streamed to fiona in batches
+        of chunk_size records with writerecords, so only one batch of
+        feature dicts exists at a time.
 
         (Optional) Keyword arguments:
         filename -- the full path filename to a vector dataset (typically a .shp file)
+        type -- fiona driver name. Guessed from the file extension (.shp,
+        .gpkg, .fgb, .geojson) if not specified
+        chunk_size -- number of features written per batch
+        spatial_index -- build a spatial index for formats that support one
+        (GeoPackage, FlatGeobuf, shapefile)
         (Optional) Positional arguments:
         1st -- if no keyword argument was used, attempt to .read the first pos argument
         """
@@ -266,45 +468,400 @@ class Vector(object):
             self.filename = filename
         # args[1] / type=
         if type is None:
-            type = 'ESRI Shapefile'  # by default, write as a shapefile
+            type = _VECTOR_DRIVERS.get(
+                os.path.splitext(str(self.filename))[1].lower(),
+                'ESRI Shapefile'  # by default, write as a shapefile
+            )
+        _options = {}
+        if type in _INDEXED_DRIVERS:
+            _options['SPATIAL_INDEX'] = 'YES' if spatial_index else 'NO'
+        _schema = self._schema if _schema_matches(
+            self._schema, self._attributes, self._geometries
+        ) else _build_schema(self._geometries, self._attributes)
+        _columns = list(_schema['properties'])
+        _names = _rename_reserved_columns(_columns, _RESERVED_COLUMNS.get(type))
+        if _names != _columns:
+            _schema = {
+                'geometry': _schema['geometry'],
+                'properties': dict(zip(_names,
+                                       _schema['properties'].values()))
+            }
         try:
             # call fiona to write our geometry to disk
             with fiona.open(
                 self.filename,
                 'w',
-                type,
-                crs=self.crs,
-                schema=self.schema
+                driver=type,
+                crs=self.crs if not self._crs_wkt else None,
+                crs_wkt=self._crs_wkt if self._crs_wkt else None,
+                schema=_schema,
+                **_options
             ) as shape:
-                # If there are multiple geometries, put the "for" loop here
-                shape.write({
-                    'geometry': mapping(self.geometries),
-                    'properties': {'id': 123},
-                })
-        except Exception:
+                for i in range(0, len(self._geometries), chunk_size):
+                    shape.writerecords(_feature_records(
+                        self, i, i + chunk_size, _columns, _names
+                    ))
+        except Exception as e:
             raise Exception("General error encountered trying "
                             "to call fiona.open on the input data. "
-                            "Is the file not a shapefile?")
+                            "Is the file not a shapefile? : " + str(e))
+
+    def __len__(self):
+        return len(self._geometries)
+
+    def _with_geometries(self, geometries=None):
+        """ shallow copy of our Vector (sharing attributes and CRS) with a
+        new geometry array. Our schema's geometry type follows the new
+        geometries
+        """
+        _vector = self.__copy__()
+        _vector._geometries = _as_geometry_array(geometries)
+        if isinstance(self._schema, dict) and 'geometry' in self._schema:
+            _vector._schema = dict(
+                self._schema, geometry=_schema_geometry(_vector._geometries)
+            )
+        return _vector
+
+    @property
+    def bounds(self):
+        """ (n, 4) array of minx, miny, maxx, maxy for each feature """
+        return shapely.bounds(self._geometries)
+
+    @property
+    def total_bounds(self):
+        """ minx, miny, maxx, maxy of all of our features """
+        return shapely.total_bounds(self._geometries)
+
+    @property
+    def area(self):
+        """ array of the area of each feature (in CRS units) """
+        return shapely.area(self._geometries)
+
+    @property
+    def length(self):
+        """ array of the length (or perimeter) of each feature """
+        return shapely.length(self._geometries)
+
+    @property
+    def coordinates(self):
+        """ (n, 2) array of all of the vertices of our features. For point
+        layers, this is one row per feature
+        """
+        return shapely.get_coordinates(self._geometries)
+
+    def buffer(self, distance=None, resolution=16):
+        """ vectorized buffer of each of our features
+
+        Keyword arguments:
+        distance= buffer width (in CRS units) as a scalar or per-feature array
+        resolution= number of segments used to approximate a quarter circle
+        :return: Vector
+        """
+        if distance is None:
+            raise IndexError("invalid distance= argument specified")
+        return self._with_geometries(
+            shapely.buffer(self._geometries, distance, quad_segs=resolution)
+        )
+
+    def buffer_dissolve(self, distance=None, resolution=16,
+                        n_partitions=None, method='hilbert', n_workers=None,
+                        backend='process'):
+        """ buffer our features and dissolve the buffers that overlap into
+        single polygons. Features are split into spatially coherent
+        partitions (see partition) that are buffered and dissolved
+        independently -- in a pool of workers with n_workers= -- and only
+        the dissolved polygons that reach into a neighboring partition are
+        tested against each other and merged, so no single union ever
+        spans our whole layer
+
+        Keyword arguments:
+        distance= buffer width (in CRS units)
+        resolution= number of segments used to approximate a quarter circle
+        n_partitions= number of partitions (defaults to four per worker)
+        method= partitioning method (see partition)
+        n_workers= buffer and dissolve partitions in a pool of this many
+        workers (partitions are processed serially without one)
+        backend= 'process' (default) or 'thread' pool for n_workers=
+        :return: tuple of (Vector of dissolved polygons with a 'group'
+        attribute, numpy array of the group of each of our features).
+        Groups are numbered in order of their first feature; features
+        without a geometry get a group of -1
+        """
+        if distance is None:
+            raise IndexError("invalid distance= argument specified")
+        if backend not in ('thread', 'process'):
+            raise ValueError("backend= should be 'thread' or 'process'")
+        _valid = np.flatnonzero(~(shapely.is_missing(self._geometries) |
+                                  shapely.is_empty(self._geometries)))
+        _groups = np.full(len(self._geometries), -1, dtype=np.int64)
+        if len(_valid) == 0:
+            _dissolved = self._with_geometries([])
+            _dissolved._attributes = pd.DataFrame(
+                {'group': np.zeros(0, dtype=int)}
+            )
+            return _dissolved, _groups
+        _partitions = self._with_geometries(self._geometries[_valid]).partition(
+            n_partitions or _PARTITIONS_PER_WORKER * (n_workers or 1),
+            method=method,
+            margin=2 * distance
+        )
+        _function = partial(_dissolve_partition, distance=distance,
+                            resolution=resolution)
+        _results = [None] * len(_partitions)
+        if n_workers and n_workers > 1:
+            _executor = ThreadPoolExecutor if backend == 'thread' else \
+                ProcessPoolExecutor
+            with _executor(max_workers=n_workers) as pool:
+                _pending = {}
+
+                def _collect(futures):
+                    for future in futures:
+                        _results[_pending.pop(future)] = future.result()
+
+                for _partition in _partitions:
+                    _future = pool.submit(_function, self._geometries[
+                        _valid[_partition['index']]
+                    ])
+                    _pending[_future] = _partition['id']
+                    # cap the partitions in flight at twice our worker count
+                    if len(_pending) >= 2 * n_workers:
+                        _collect(wait(
+                            list(_pending), return_when=FIRST_COMPLETED
+                        )[0])
+                _collect(as_completed(list(_pending)))
+        else:
+            for _partition in _partitions:
+                _results[_partition['id']] = _function(
+                    self._geometries[_valid[_partition['index']]]
+                )
+        _pieces, _piece_labels, _labels = _stitch_partitions(
+            _partitions, _results, distance
+        )
+        # number our groups in order of their first feature
+        _order = np.argsort(np.concatenate(
+            [_valid[p['index']] for p in _partitions]
+        ), kind='stable')
+        _labels = _labels[_order]
+        _first, _inverse = np.unique(_labels, return_index=True,
+                                     return_inverse=True)[1:]
+        _rank = np.empty(len(_first), dtype=np.int64)
+        _rank[np.argsort(_first, kind='stable')] = np.arange(len(_first))
+        _groups[_valid] = _rank[_inverse]
+        _n_groups = len(_first)
+        _dissolved = self._with_geometries(_union_groups(
+            _pieces, _rank[_piece_labels], _n_groups
+        ))
+        _dissolved._attributes = pd.DataFrame({'group': np.arange(_n_groups)})
+        return _dissolved, _groups
+
+    def transform(self, function=None):
+        """ apply a function to the coordinates of all of our features at
+        once. function= accepts an (n, 2) coordinate array and returns an
+        array of the same shape
+        :return: Vector
+        """
+        if function is None:
+            raise IndexError("invalid function= argument specified")
+        return self._with_geometries(
+            shapely.transform(self._geometries, function)
+        )
+
+    def to_crs(self, crs=None, epsg=None):
+        """ reproject our features, transforming the coordinates of all of
+        our features in one bulk call with a cached pyproj Transformer
+
+        Keyword arguments:
+        crs= target CRS (anything pyproj understands, e.g. 'EPSG:2163')
+        epsg= target EPSG code, as an alternative to crs=
+        :return: Vector
+        """
+        if epsg is not None:
+            crs = "EPSG:" + str(epsg)
+        _dst = _get_crs(crs)
+        _vector = self._with_geometries(_transform_geometries(
+            self._geometries, self._crs_wkt or self._crs, _dst
+        ))
+        _vector._crs = _dst
+        _vector._crs_wkt = _dst.to_wkt()
+        return _vector
+
+    def intersects(self, other=None):
+        """ element-wise intersects predicate against a geometry, an array
+        of geometries, or another Vector
+        :return: boolean array
+        """
+        return shapely.intersects(self._geometries, _as_geometries(other))
+
+    def contains(self, other=None):
+        """ element-wise contains predicate (see intersects) """
+        return shapely.contains(self._geometries, _as_geometries(other))
+
+    def within(self, other=None):
+        """ element-wise within predicate (see intersects) """
+        return shapely.within(self._geometries, _as_geometries(other))
+
+    @property
+    def sindex(self):
+        """ lazily built STRtree of our geometries. The tree is cached and
+        rebuilt whenever our geometry array is replaced (but not if the
+        array is modified in place)
+        """
+        if self._sindex is None or self._sindex[0] is not self._geometries:
+            self._sindex = (self._geometries, shapely.STRtree(self._geometries))
+        return self._sindex[1]
+
+    def query(self, geometries=None, predicate=None, distance=None):
+        """ bulk spatial query of our features using our cached STRtree
+
+        Keyword arguments:
+        geometries= a geometry, array of geometries, or Vector to query with
+        predicate= optional predicate that features must satisfy relative to
+        each query geometry (e.g., 'intersects', 'contains', 'dwithin').
+        Without one, features are matched on bounding boxes only.
+        distance= distance used with the 'dwithin' predicate
+        :return: (2, n) array of [query geometry index, feature index] pairs
+        """
+        if geometries is None:
+            raise IndexError("invalid geometries= argument specified")
+        return self.sindex.query(
+            _as_geometry_array(_as_geometries(geometries)),
+            predicate=predicate,
+            distance=distance
+        )
+
+    def nearest(self, geometries=None, max_distance=None,
+                return_distance=False, all_matches=False):
+        """ nearest feature to each query geometry using our cached STRtree
+
+        Keyword arguments:
+        geometries= a geometry, array of geometries, or Vector to query with
+        max_distance= ignore features further than this from a query geometry
+        return_distance= also return the distance of each pair
+        all_matches= return all equidistant features rather than just one
+        :return: (2, n) array of [query geometry index, feature index] pairs
+        (and an array of distances if return_distance=True)
+        """
+        if geometries is None:
+            raise IndexError("invalid geometries= argument specified")
+        return self.sindex.query_nearest(
+            _as_geometry_array(_as_geometries(geometries)),
+            max_distance=max_distance,
+            return_distance=return_distance,
+            all_matches=all_matches
+        )
+
+    def take(self, index=None):
+        """ subset of our features (geometries and attributes) by position
+        :param index: integer (or boolean) array of features to keep
+        :return: Vector
+        """
+        if index is None:
+            raise IndexError("invalid index= argument specified")
+        _index = np.asarray(index)
+        if _index.dtype == bool:
+            _index = np.flatnonzero(_index)
+        _vector = self._with_geometries(self._geometries[_index])
+        if isinstance(self._attributes, pd.DataFrame):
+            _vector._attributes = self._attributes.iloc[_index]
+        return _vector
+
+    def partition(self, n_partitions=None, method='hilbert',
+                  max_features=None, margin=0):
+        """ split our features into spatially coherent partitions that can be
+        processed in parallel. Features are placed by the midpoint of their
+        bounding box using one of:
+
+        'hilbert' -- sort along a Hilbert curve and cut into n_partitions
+        runs of (nearly) equal length
+        'grid' -- a regular grid of about n_partitions cells over our
+        total bounds (empty cells are dropped)
+        'quadtree' -- recursively quarter our total bounds until no cell
+        holds more than max_features features
+
+        Keyword arguments:
+        n_partitions= number of partitions to aim for (defaults to the number
+        of CPUs, or to len(self) / max_features if that is given)
+        method= one of 'hilbert', 'grid', or 'quadtree'
+        max_features= maximum features per quadtree cell
+        margin= partitions whose bounds are within this distance of each
+        other are recorded as neighbors
+        :return: list of dicts with the id, index (feature positions),
+        bounds (of the partition's features), and neighbors (ids) of each
+        partition
+        """
+        if method not in _PARTITION_METHODS:
+            raise ValueError("method= should be one of " +
+                             str(_PARTITION_METHODS))
+        _n = len(self._geometries)
+        if _n == 0:
+            return []
+        if n_partitions is None:
+            n_partitions = int(np.ceil(_n / max_features)) \
+                if max_features else (os.cpu_count() or 1)
+        n_partitions = max(1, min(int(n_partitions), _n))
+        _bounds = shapely.bounds(self._geometries)
+        _midpoints = _partition_midpoints(_bounds)
+        if method == 'hilbert':
+            _order = np.argsort(_hilbert_distance(_midpoints), kind='stable')
+            _splits = np.linspace(0, _n, n_partitions + 1).round().astype(int)
+        else:
+            if method == 'grid':
+                _cells = _grid_cells(_midpoints, n_partitions)
+            else:
+                _cells = _quadtree_cells(
+                    _midpoints,
+                    max_features or int(np.ceil(_n / n_partitions))
+                )
+            _order = np.argsort(_cells, kind='stable')
+            _splits = np.concatenate([
+                [0],
+                np.flatnonzero(np.diff(_cells[_order])) + 1,
+                [_n]
+            ])
+        return _partition_records(_order, _splits, _bounds, margin)
 
     def to_shapely_collection(self):
         """ return a shapely collection of our geometry data """
         return self.geometries
 
     def to_geodataframe(self):
-        """ return our spatial data as a geopandas dataframe """
-        try:
-            _gdf = gp.GeoDataFrame({
-                "geometry": gp.GeoSeries(self._geometries),
-            })
-            _gdf.crs = self.crs
-            # merge in our attributes
-            _gdf = _gdf.join(self._attributes)
-        except Exception:
-            logger.warning("failed to build a GeoDataFrame from shapely"
-                           "geometries -- will try to read from original"
-                           " source file instead")
-            _gdf = gp.read_file(self._filename)
-        return _gdf
+        """ return our spatial data as a geopandas dataframe. The GeoDataFrame
+        wraps our geometry array and attribute columns rather than copying
+        them (the shapely geometries are shared, not re-created)
+        :return: GeoDataFrame
+        """
+        _columns = dict(self._attributes.items()) \
+            if isinstance(self._attributes, (dict, pd.DataFrame)) else {}
+        if 'geometry' in _columns:
+            raise ValueError("'geometry' is reserved for our geometry column "
+                             "and can't be used as an attribute name")
+        _crs = self._crs_wkt or self._crs
+        _columns['geometry'] = gp.array.GeometryArray(
+            self._geometries,
+            crs=_get_crs(_crs) if _crs else None
+        )
+        return gp.GeoDataFrame(_columns, geometry='geometry', copy=False)
+
+    @classmethod
+    def from_geodataframe(cls, gdf=None):
+        """ build a Vector around the geometry array and attribute columns
+        of a GeoDataFrame without copying them
+        :param gdf: GeoDataFrame to wrap
+        :return: Vector
+        """
+        if not isinstance(gdf, gp.GeoDataFrame):
+            raise TypeError("gdf= should be a GeoDataFrame")
+        _geometry_column = gdf.geometry.name
+        _vector = cls()
+        # numpy view of the GeometryArray backing our GeoSeries
+        _vector._geometries = _as_geometry_array(np.asarray(gdf.geometry.values))
+        _vector._attributes = pd.DataFrame({
+            k: v for k, v in gdf.items() if k != _geometry_column
+        }, index=gdf.index, copy=False)
+        if gdf.crs is not None:
+            _vector._crs = gdf.crs
+            _vector._crs_wkt = gdf.crs.to_wkt()
+        return _vector
 
     def to_geopandas(self):
         """
@@ -316,47 +873,765 @@ class Vector(object):
     def to_ee_feature_collection(self):
         return ee.FeatureCollection(self.to_geojson(stringify=True))
 
-    def to_geojson(self, stringify=None):
+    def to_geojson(self, stringify=None, precision=None, filename=None,
+                   newline_delimited=False, chunk_size=_DEFAULT_CHUNK_SIZE):
         """
+        Serialize our features (with attributes) as a GeoJSON
+        FeatureCollection, or as newline-delimited GeoJSON features.
+        Serialization is streamed in chunks (see iter_geojson), so writing
+        to filename= never holds more than a chunk of text in memory.
 
-        :param args:
-        :return:
+        :param stringify: return a json string rather than a dict
+        :param precision: number of decimal places to round coordinates to
+        :param filename: if specified, stream our GeoJSON to this file and
+        return the filename
+        :param newline_delimited: one feature per line, without the
+        enclosing FeatureCollection
+        :param chunk_size: number of features serialized per chunk
+        :return: dict, string, or filename
         """
         # args[0]/stringify=
         if stringify is not None:
             stringify = True
-        # build a target dictionary
-        feature_collection = {
-            "type": "FeatureCollection",
-            "features": [],
-            "crs": [],
-            "properties": []
-        }
-        # iterate over features in our shapely geometries
-        # and build-out our feature_collection
-        for feature in self._geometries:
-            if isinstance(feature, dict):
-                feature_collection["features"].append(feature)
-            else:
-                # assume that json will know what to do with it
-                # and raise an error if it doesn't
-                try:
-                    feature_collection["features"].append(json.loads(feature))
-                except Exception as e:
-                    raise e
-        # note the CRS
-        if self._crs:
-            feature_collection["crs"].append(self._crs)
-        # define our properties (attributes)
-        for i in self.attributes.index:
-            feature_collection['properties'].append(
-                self.attributes.loc[i].to_json()
-            )
+        _fragments = self.iter_geojson(
+            precision=precision,
+            newline_delimited=newline_delimited,
+            chunk_size=chunk_size
+        )
+        # args[2]/filename=
+        if filename is not None:
+            with open(filename, 'w') as f:
+                for fragment in _fragments:
+                    f.write(fragment)
+            return filename
+        _text = "".join(_fragments)
         # do we want this stringified?
-        if stringify:
-            feature_collection = json.dumps(feature_collection)
+        if stringify or newline_delimited:
+            return _text
+        return json.loads(_text)
+
+    def iter_geojson(self, precision=None, newline_delimited=False,
+                     chunk_size=_DEFAULT_CHUNK_SIZE):
+        """
+        Generator of GeoJSON text fragments for our features. Geometries are
+        serialized with shapely's vectorized to_geojson and attributes
+        with a single DataFrame.to_json call per chunk.
+
+        :param precision: number of decimal places to round coordinates to
+        :param newline_delimited: yield one feature per line, without the
+        enclosing FeatureCollection
+        :param chunk_size: number of features serialized per chunk
+        :return: generator of strings
+        """
+        if not newline_delimited:
+            _crs = _geojson_crs(self._crs_wkt or self._crs)
+            yield '{"type": "FeatureCollection", ' + \
+                ('"crs": ' + json.dumps(_crs) + ', ' if _crs else '') + \
+                '"features": ['
+        for i in range(0, len(self._geometries), chunk_size):
+            _features = _geojson_features(
+                self, i, i + chunk_size, precision
+            )
+            if newline_delimited:
+                yield "\n".join(_features) + "\n"
+            else:
+                yield (", " if i > 0 else "") + ", ".join(_features)
+        if not newline_delimited:
+            yield ']}'
+
+
+def _as_geometry_array(geometries=None):
+    """
+    Cast a geometry, list of geometries, GeoSeries, or numpy array of
+    geometries as a 1-d numpy object array of shapely geometries, without
+    copying numpy input. Raises a TypeError for anything that isn't a
+    shapely geometry (or None).
+    """
+    if isinstance(geometries, shapely.Geometry):
+        geometries = [geometries]
+    elif isinstance(geometries, gp.GeoSeries):
+        geometries = geometries.values
+    if isinstance(geometries, np.ndarray) and geometries.dtype == object \
+            and geometries.ndim == 1:
+        _array = geometries
+    else:
+        _array = np.empty(len(geometries), dtype=object)
+        _array[:] = list(geometries)
+    if not np.all(shapely.is_geometry(_array) | shapely.is_missing(_array)):
+        raise TypeError("geometries should be shapely geometries")
+    return _array
+
+
+def _as_geometries(other=None):
+    """
+    Geometry (or geometry array) for the right-hand side of a predicate
+    """
+    if isinstance(other, Vector):
+        return other.geometries
+    if isinstance(other, shapely.Geometry):
+        return other
+    return _as_geometry_array(other)
+
+
+def _vector_cache_file(filename=None, columns=None, where=None, bbox=None):
+    """
+    Path of the cache file for a source vector file, named
+    <source>.<query>.<version>.arrow from digests of the source's absolute
+    path, of the columns / filters of our read (reads that select columns
+    or filter features are cached separately), and of the size and
+    modification time of the source (and of a shapefile's sidecar files)
+    so that edits to the source invalidate the cache
+    """
+    _path = os.path.abspath(filename)
+    _stem, _ext = os.path.splitext(_path)
+    _files = [_stem + e for e in _SHAPEFILE_SIDECARS] \
+        if _ext.lower() == '.shp' else [_path]
+    _version = []
+    for _file in _files:
+        if os.path.exists(_file):
+            _stat = os.stat(_file)
+            _version.append([_file, _stat.st_size, _stat.st_mtime_ns])
+    _query = None
+    if columns is not None or where is not None or bbox is not None:
+        _query = {
+            'columns': None if columns is None else list(columns),
+            'where': where,
+            'bbox': None if bbox is None else [
+                float(b) for b in getattr(bbox, 'bounds', bbox)
+            ]
+        }
+    return os.path.join(
+        os.environ.get('BEATBOX_CACHE_DIR', _CACHE_DIR),
+        '.'.join([_cache_digest(k) for k in (_path, _query, _version)]) +
+        '.arrow'
+    )
+
+
+def _open_collection(filename=None, include_fields=None):
+    """
+    fiona.open a vector file for reading that only decodes the fields in
+    include_fields=, for drivers that support ignoring fields. Others
+    (e.g., GeoJSON) are opened with all of their fields
+    """
+    if include_fields is None:
+        return fiona.open(filename)
+    try:
+        return fiona.open(filename, include_fields=include_fields)
+    except DriverError as e:
+        if 'ignore_fields' not in str(e):
+            raise
+        return fiona.open(filename)
+
+
+def _where_fields(where=None, fields=None):
+    """
+    The fields (of fields=) that an OGR SQL WHERE clause refers to. Field
+    names are matched without regard to case, as OGR does
+    """
+    # drop string literals so that their contents aren't taken as names
+    _clause = re.sub(r"'(?:[^']|'')*'", " ", where)
+    _names = set(
+        n.strip('"').lower()
+        for n in re.findall(r'"[^"]+"|[A-Za-z_][A-Za-z0-9_]*', _clause)
+    )
+    return [f for f in fields if f.lower() in _names]
+
+
+def _cache_digest(key=None):
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def _prune_cache(cache_file=None, max_queries=_CACHE_MAX_QUERIES):
+    """
+    Remove the cache files superseded by cache_file= : those of an older
+    version of the same source, and all but the max_queries= most recently
+    written reads of the source. Files that a concurrent reader already
+    removed are skipped
+    """
+    _dir = os.path.dirname(cache_file)
+    _source, _query, _version = \
+        os.path.basename(cache_file).split('.')[:3]
+    _stale, _entries = [], []
+    for _name in os.listdir(_dir):
+        _parts = _name.split('.')
+        if len(_parts) != 4 or _parts[0] != _source or _parts[3] != 'arrow':
+            continue
+        _file = os.path.join(_dir, _name)
+        if _parts[2] != _version:
+            _stale.append(_file)
+        elif _file != cache_file:
+            try:
+                _entries.append((os.stat(_file).st_mtime_ns, _file))
+            except FileNotFoundError:
+                pass
+    _entries = [f for t, f in sorted(_entries)]
+    _stale += _entries[:max(0, len(_entries) - max_queries + 1)]
+    for _file in _stale:
+        try:
+            os.remove(_file)
+        except FileNotFoundError:
+            pass
+
+
+def _overlap_groups(geometries=None, predicate='intersects'):
+    """
+    Label geometries by the connected components of their (sparse) graph of
+    pairwise intersections. Candidate pairs come from a bulk STRtree query
+    and are filtered by predicate=
+    :param geometries: numpy array of shapely geometries
+    :param predicate: the spatial predicate that links two geometries
+    :return: tuple of (number of groups, group label of each geometry)
+    """
+    _n = len(geometries)
+    if _n == 0:
+        return 0, np.array([], dtype=np.int32)
+    _pairs = shapely.STRtree(geometries).query(geometries, predicate=predicate)
+    _adjacency = coo_matrix(
+        (np.ones(_pairs.shape[1], dtype=bool), (_pairs[0], _pairs[1])),
+        shape=(_n, _n)
+    ).tocsr()
+    return connected_components(_adjacency, directed=False)
+
+
+def _union_groups(geometries=None, groups=None, n_groups=None):
+    """
+    Union of the geometries in each group. Singleton groups are passed
+    through without calling union_all
+    :return: numpy array of n_groups shapely geometries
+    """
+    if n_groups == 0:
+        return np.array([], dtype=object)
+    _order = np.argsort(groups, kind='stable')
+    _counts = np.bincount(groups, minlength=n_groups)
+    _starts = np.concatenate([[0], np.cumsum(_counts)[:-1]])
+    _unions = geometries[_order[_starts]]
+    for _group in np.flatnonzero(_counts > 1):
+        _unions[_group] = shapely.union_all(geometries[
+            _order[_starts[_group]:_starts[_group] + _counts[_group]]
+        ])
+    return _unions
+
+
+def _dissolve_partition(geometries=None, distance=None, resolution=16):
+    """
+    Buffer and dissolve the features of one partition. The parts of the
+    union of our buffers are our groups, and each feature joins the part
+    that holds a point on the surface of its buffer -- much cheaper than
+    testing every pair of overlapping buffers in dense layers
+    :return: tuple of (group of each feature, dissolved polygon of each group)
+    """
+    _buffers = shapely.buffer(geometries, distance, quad_segs=resolution)
+    _parts = shapely.get_parts(shapely.union_all(_buffers))
+    _groups = points_in_polygons(shapely.point_on_surface(_buffers), _parts)
+    # features that buffer to nothing (e.g., with a negative distance=) are
+    # groups of their own
+    _empty = np.flatnonzero(_groups < 0)
+    _groups[_empty] = len(_parts) + np.arange(len(_empty))
+    return _groups, np.concatenate([_parts, _buffers[_empty]])
+
+
+def _stitch_partitions(partitions=None, results=None, distance=None):
+    """
+    Merge the dissolved polygons of neighboring partitions that intersect.
+    A partition's buffers lie within its bounds grown by distance=, so only
+    the polygons that reach into the grown bounds of a neighbor are tested
+    :return: tuple of (dissolved polygons, merged label of each polygon,
+    merged label of each feature in partition order)
+    """
+    _offsets = np.cumsum([0] + [len(r[1]) for r in results])
+    _pieces = np.concatenate([r[1] for r in results])
+    _owner = np.repeat(np.arange(len(results)), np.diff(_offsets))
+    _bounds = np.array([p['bounds'] for p in partitions])
+    _grown = shapely.box(*(_bounds + [-distance, -distance, distance,
+                                      distance]).T)
+    _reach = shapely.STRtree(_grown).query(_pieces)
+    _border = np.unique(_reach[0][_owner[_reach[0]] != _reach[1]])
+    _pairs = shapely.STRtree(_pieces[_border]).query(
+        _pieces[_border], predicate='intersects'
+    )
+    _i, _j = _border[_pairs[0]], _border[_pairs[1]]
+    _across = _owner[_i] != _owner[_j]
+    _n = len(_pieces)
+    _labels = connected_components(coo_matrix(
+        (np.ones(np.count_nonzero(_across), dtype=bool),
+         (_i[_across], _j[_across])),
+        shape=(_n, _n)
+    ).tocsr(), directed=False)[1]
+    _features = np.concatenate(
+        [r[0] + _offsets[k] for k, r in enumerate(results)]
+    )
+    return _pieces, _labels, _labels[_features]
+
+
+def _partition_midpoints(bounds=None):
+    """
+    Bounding-box midpoints of our features. Missing or empty geometries are
+    parked at the lower-left corner of our total bounds
+    """
+    _midpoints = np.column_stack([
+        (bounds[:, 0] + bounds[:, 2]) / 2,
+        (bounds[:, 1] + bounds[:, 3]) / 2
+    ])
+    _missing = np.isnan(_midpoints).any(axis=1)
+    if _missing.all():
+        return np.zeros_like(_midpoints)
+    if _missing.any():
+        _midpoints[_missing] = np.nanmin(_midpoints, axis=0)
+    return _midpoints
+
+
+def _hilbert_distance(points=None, order=_HILBERT_ORDER):
+    """
+    Vectorized distance of each (x, y) point along a Hilbert curve laid over
+    the extent of our points on a 2**order x 2**order grid
+    """
+    _side = 2 ** order
+    _min = points.min(axis=0)
+    _extent = points.max(axis=0) - _min
+    _extent[_extent == 0] = 1
+    _xy = ((points - _min) / _extent * (_side - 1)).astype(np.int64)
+    _x, _y = _xy[:, 0], _xy[:, 1]
+    _d = np.zeros(len(points), dtype=np.int64)
+    _s = _side // 2
+    while _s > 0:
+        _rx = (_x & _s) > 0
+        _ry = (_y & _s) > 0
+        _d += _s * _s * ((3 * _rx) ^ _ry)
+        # rotate our quadrant so the curve stays continuous
+        _flip = ~_ry & _rx
+        _x = np.where(_flip, _side - 1 - _x, _x)
+        _y = np.where(_flip, _side - 1 - _y, _y)
+        _x, _y = np.where(_ry, _x, _y), np.where(_ry, _y, _x)
+        _s //= 2
+    return _d
+
+
+def _grid_cells(points=None, n_partitions=None):
+    """
+    Row-major id of the cell of a regular grid (of about n_partitions
+    cells over the extent of our points) that each point falls in
+    """
+    _min = points.min(axis=0)
+    _extent = points.max(axis=0) - _min
+    _extent[_extent == 0] = 1
+    # choose nx, ny so that our cells are roughly square
+    _aspect = _extent[0] / _extent[1]
+    _nx = max(1, int(round(np.sqrt(n_partitions * _aspect))))
+    _ny = max(1, int(np.ceil(n_partitions / _nx)))
+    _col = np.minimum(((points[:, 0] - _min[0]) / _extent[0] * _nx)
+                      .astype(np.int64), _nx - 1)
+    _row = np.minimum(((points[:, 1] - _min[1]) / _extent[1] * _ny)
+                      .astype(np.int64), _ny - 1)
+    return _row * _nx + _col
+
+
+def _quadtree_cells(points=None, max_features=None):
+    """
+    Leaf id of a point quadtree, balanced by feature count, for each point.
+    Cells are quartered until they hold no more than max_features points
+    (or can't be split any further)
+    """
+    _cells = np.zeros(len(points), dtype=np.int64)
+    _n_cells = 0
+    # (point positions, xmin, ymin, xmax, ymax, depth)
+    _stack = [(np.arange(len(points)),) +
+              tuple(points.min(axis=0)) + tuple(points.max(axis=0)) + (0,)]
+    while _stack:
+        _index, _xmin, _ymin, _xmax, _ymax, _depth = _stack.pop()
+        _x, _y = points[_index, 0], points[_index, 1]
+        if len(_index) <= max_features or _depth >= _QUADTREE_MAX_DEPTH or \
+                (_x.min() == _x.max() and _y.min() == _y.max()):
+            _cells[_index] = _n_cells
+            _n_cells += 1
+            continue
+        _xmid, _ymid = (_xmin + _xmax) / 2, (_ymin + _ymax) / 2
+        _quadrant = (_x > _xmid).astype(int) + 2 * (_y > _ymid)
+        # push in reverse so that quadrants are numbered SW, SE, NW, NE
+        for _q, _box in reversed(list(enumerate([
+            (_xmin, _ymin, _xmid, _ymid), (_xmid, _ymin, _xmax, _ymid),
+            (_xmin, _ymid, _xmid, _ymax), (_xmid, _ymid, _xmax, _ymax)
+        ]))):
+            _in = _quadrant == _q
+            if _in.any():
+                _stack.append((_index[_in],) + _box + (_depth + 1,))
+    return _cells
+
+
+def _partition_records(order=None, splits=None, bounds=None, margin=0):
+    """
+    Build our partition records from a feature ordering and the positions
+    where that ordering is cut into partitions
+    """
+    _partitions = []
+    for i in range(len(splits) - 1):
+        _index = np.sort(order[splits[i]:splits[i + 1]])
+        _partitions.append({
+            'id': i,
+            'index': _index,
+            'bounds': tuple(float(b) for b in (
+                np.nanmin(bounds[_index, 0]), np.nanmin(bounds[_index, 1]),
+                np.nanmax(bounds[_index, 2]), np.nanmax(bounds[_index, 3])
+            )),
+            'neighbors': []
+        })
+    _boxes = shapely.box(*np.array([p['bounds'] for p in _partitions]).T)
+    if margin:
+        _pairs = shapely.STRtree(_boxes).query(
+            _boxes, predicate='dwithin', distance=margin
+        )
+    else:
+        _pairs = shapely.STRtree(_boxes).query(_boxes, predicate='intersects')
+    for i, j in _pairs.T[_pairs[0] != _pairs[1]]:
+        _partitions[i]['neighbors'].append(int(j))
+    return _partitions
+
+
+def _features_to_columns(features=None, properties=None):
+    """
+    Single pass over an iterable of (fiona or GeoJSON) features that decodes
+    geometries into a numpy array of shapely geometries and properties into
+    typed pandas columns. This avoids building a list of property dicts
+    and iterating over our features twice.
+    :param features: fiona Collection or list of GeoJSON feature dicts
+    :param properties: (ordered) dict of fiona schema property types. If
+    None, columns are discovered from the features themselves.
+    :return: tuple of (geometry array, DataFrame)
+    """
+    _geometries = []
+    _columns = dict((k, []) for k in properties) if properties else {}
+    for i, ft in enumerate(features):
+        # fiona>=1.9 features are objects, older fiona and json give dicts
+        try:
+            _geometry, _properties = ft.geometry, ft.properties
+        except AttributeError:
+            _geometry, _properties = ft['geometry'], ft.get('properties')
+        _geometries.append(shape(_geometry) if _geometry is not None else None)
+        _properties = _properties or {}
+        if properties is None:
+            for key in _properties:
+                if key not in _columns:
+                    _columns[key] = [None] * i
+        for key, column in _columns.items():
+            column.append(_properties.get(key))
+    _array = np.empty(len(_geometries), dtype=object)
+    _array[:] = _geometries
+    del _geometries
+    _attributes = pd.DataFrame(index=pd.RangeIndex(len(_array)))
+    for key in list(_columns):
+        _attributes[key] = _fiona_column(
+            _columns.pop(key),
+            properties.get(key) if properties else None
+        )
+    return _array, _attributes
+
+
+def _fiona_column(values=None, field_type=None):
+    """
+    Build a typed pandas Series from a list of values using a fiona schema
+    field type (e.g., 'int:10', 'float:24.15', 'str:80')
+    """
+    _type = str(field_type).split(":")[0]
+    _has_nulls = any([v is None for v in values])
+    try:
+        if _type in ('int', 'int32', 'int64'):
+            return pd.Series(values, dtype='Int64' if _has_nulls else np.int64)
+        elif _type == 'float':
+            return pd.Series(values, dtype=np.float64)
+        elif _type == 'bool':
+            return pd.Series(values, dtype='boolean' if _has_nulls else bool)
+    except (TypeError, ValueError):
+        logger.warning("failed to cast a %s column -- keeping values as "
+                       "python objects", _type)
+    return pd.Series(values)
+
+
+def _schema_matches(schema=None, attributes=None, geometries=None):
+    """
+    Determine whether a (fiona) schema still describes our attributes (and,
+    if geometries= are given, the type of our geometries)
+    """
+    try:
+        _columns = list(attributes.columns) if \
+            isinstance(attributes, pd.DataFrame) else []
+        if geometries is not None and \
+                schema['geometry'] != _schema_geometry(geometries):
+            return False
+        return list(schema['properties']) == _columns
+    except (KeyError, TypeError):
+        return False
+
+
+def _schema_geometry(geometries=None):
+    """
+    fiona schema geometry type for a geometry array : its single type, the
+    Multi- type for a mix of single and multi-part geometries of one type,
+    or 'Unknown'
+    """
+    _types = set(shapely.get_type_id(geometries[~shapely.is_missing(geometries)])
+                 .tolist())
+    _names = sorted([_GEOMETRY_TYPES[t] for t in _types])
+    if len(_names) == 1:
+        return _names[0]
+    elif len(set([n.replace('Multi', '') for n in _names])) == 1:
+        return 'Multi' + _names[0].replace('Multi', '')
+    return 'Unknown'
+
+
+def _build_schema(geometries=None, attributes=None):
+    """
+    Build a fiona schema from a geometry array and an attribute DataFrame
+    """
+    _geometry = _schema_geometry(geometries)
+    _properties = {}
+    if isinstance(attributes, pd.DataFrame):
+        for column in attributes.columns:
+            _kind = attributes[column].dtype.kind
+            _properties[str(column)] = \
+                'int' if _kind in 'iu' else \
+                'float' if _kind == 'f' else \
+                'bool' if _kind == 'b' else \
+                'datetime' if _kind == 'M' else 'str'
+    return {'geometry': _geometry, 'properties': _properties}
 
-        return feature_collection
+
+def _rename_reserved_columns(columns=None, reserved=None):
+    """
+    Output names for our attribute columns, with a column that collides
+    with a driver's reserved feature id column renamed (e.g., fid -> fid_1)
+    """
+    if reserved is None:
+        return list(columns)
+    _names = []
+    for column in columns:
+        if column.lower() == reserved.lower():
+            _suffix = 1
+            while '%s_%d' % (column, _suffix) in columns:
+                _suffix += 1
+            logger.warning("'%s' is reserved for feature ids by this driver "
+                           "-- writing our '%s' column as '%s_%d'", reserved,
+                           column, column, _suffix)
+            column = '%s_%d' % (column, _suffix)
+        _names.append(column)
+    return _names
+
+
+def _feature_records(vector=None, start=None, stop=None, columns=None,
+                     names=None):
+    """
+    Build a batch of fiona feature records for a slice of a Vector. Our
+    attribute columns are written under names= (default: their own names)
+    """
+    _geometries = vector.geometries[start:stop]
+    if columns:
+        _chunk = vector.attributes.iloc[start:stop]
+        _values = [
+            _chunk[c].astype(object).where(_chunk[c].notna(), None).tolist()
+            for c in columns
+        ]
+        _properties = [dict(zip(names or columns, row))
+                       for row in zip(*_values)]
+    else:
+        _properties = [{} for g in _geometries]
+    return [
+        {
+            'geometry': mapping(g) if g is not None else None,
+            'properties': p
+        }
+        for g, p in zip(_geometries, _properties)
+    ]
+
+
+def _geojson_features(vector=None, start=None, stop=None, precision=None):
+    """
+    Serialize a slice of a Vector as a list of GeoJSON feature strings
+    """
+    _geometries = vector.geometries[start:stop]
+    # args[3]/precision=
+    if precision is not None:
+        _geometries = shapely.transform(
+            _geometries, lambda c: np.round(c, precision)
+        )
+    _geometries = [
+        g if g is not None else 'null' for g in shapely.to_geojson(_geometries)
+    ]
+    if isinstance(vector.attributes, pd.DataFrame) and \
+            len(vector.attributes.columns) > 0:
+        _properties = vector.attributes.iloc[start:stop].to_json(
+            orient='records', lines=True, double_precision=15
+        ).splitlines()
+    else:
+        _properties = ['{}'] * len(_geometries)
+    return [
+        '{"type": "Feature", "geometry": ' + g + ', "properties": ' + p + '}'
+        for g, p in zip(_geometries, _properties)
+    ]
+
+
+def _geojson_crs(crs=None):
+    """
+    Named GeoJSON CRS object for our CRS, if it has an authority code
+    """
+    if not crs:
+        return None
+    try:
+        _authority = pyproj.CRS.from_user_input(crs).to_authority()
+    except Exception:
+        return None
+    if _authority is None:
+        return None
+    return {
+        "type": "name",
+        "properties": {
+            "name": "urn:ogc:def:crs:%s::%s" % _authority
+        }
+    }
+
+
+def _crs_key(crs=None):
+    """
+    Hashable key for the many ways we see a CRS specified (dicts, EPSG codes,
+    strings, WKT, fiona and pyproj CRS objects)
+    """
+    if isinstance(crs, dict):
+        return tuple(sorted([(str(k), str(v)) for k, v in crs.items()]))
+    elif isinstance(crs, int):
+        return "EPSG:" + str(crs)
+    elif hasattr(crs, 'to_wkt'):
+        return crs.to_wkt()
+    return str(crs)
+
+
+def _get_crs(crs=None):
+    """
+    Process-wide cache of pyproj CRS objects, so that we only parse a
+    given CRS specification once
+    """
+    if crs is None or (not isinstance(crs, int) and not crs):
+        raise ValueError("a CRS is required for this operation")
+    if isinstance(crs, pyproj.CRS):
+        return crs
+    _key = _crs_key(crs)
+    try:
+        return _CRS_CACHE[_key]
+    except KeyError:
+        # legacy {'init': 'epsg:XXXX'} dicts are just an identifier
+        if isinstance(crs, dict) and 'init' in crs:
+            crs = crs['init']
+        elif hasattr(crs, 'to_wkt'):
+            crs = crs.to_wkt()
+        _CRS_CACHE[_key] = pyproj.CRS.from_user_input(crs)
+        return _CRS_CACHE[_key]
+
+
+def _get_transformer(src=None, dst=None):
+    """
+    Process-wide cache of pyproj Transformers keyed by (src, dst). pyproj
+    transformers aren't safe to share across threads, so each thread gets
+    its own.
+    """
+    _src, _dst = _get_crs(src), _get_crs(dst)
+    _key = (_crs_key(_src), _crs_key(_dst), threading.get_ident())
+    try:
+        return _TRANSFORMER_CACHE[_key]
+    except KeyError:
+        _TRANSFORMER_CACHE[_key] = pyproj.Transformer.from_crs(
+            _src, _dst, always_xy=True
+        )
+        return _TRANSFORMER_CACHE[_key]
+
+
+def _transform_geometries(geometries=None, src=None, dst=None):
+    """
+    Reproject an array of geometries by pushing all of their coordinates
+    through a (cached) transformer in a single call
+    """
+    _transformer = _get_transformer(src, dst)
+
+    def _transform(coords):
+        return np.column_stack(
+            _transformer.transform(coords[:, 0], coords[:, 1])
+        )
+
+    return shapely.transform(geometries, _transform)
+
+
+def _local_reproject(obj=None, crs=None):
+    """
+    Reproject a Vector or GeoDataFrame using our cached transformers
+    """
+    if isinstance(obj, Vector):
+        return obj.to_crs(crs)
+    _dst = _get_crs(crs)
+    return obj.set_geometry(
+        gp.GeoSeries(
+            _transform_geometries(
+                np.asarray(obj.geometry.values), obj.crs, _dst
+            ),
+            index=obj.index,
+            crs=_dst
+        )
+    )
+
+
+def _as_point_geometries(points=None, start=None, stop=None):
+    """
+    Slice of point geometries from an (n, 2) coordinate array, Vector,
+    GeoDataFrame / GeoSeries, or array of shapely points
+    """
+    if isinstance(points, np.ndarray) and points.dtype != object:
+        return shapely.points(points[start:stop, :2])
+    if isinstance(points, Vector):
+        return points.geometries[start:stop]
+    if isinstance(points, (gp.GeoDataFrame, gp.GeoSeries)):
+        return np.asarray(points.geometry.values[start:stop])
+    return _as_geometry_array(points)[start:stop]
+
+
+def points_in_polygons(points=None, polygons=None,
+                       chunk_size=_DEFAULT_CHUNK_SIZE):
+    """
+    Point-in-polygon join that returns the position of the polygon that
+    intersects each point (or -1 where no polygon does). Points are queried
+    in batches against an STRtree of our polygons, and candidate pairs are
+    tested with prepared polygons directly against point coordinates, so no
+    intermediate GeoDataFrames are built. Where polygons overlap, a point
+    takes the lowest polygon position
+    :param arg1: (n, 2) array of coordinates, Vector, GeoDataFrame, or array
+    of shapely points
+    :param arg2: Vector (whose cached STRtree is used), GeoDataFrame, or
+    array of shapely polygons -- in the same CRS as our points
+    :param points: Keyword specification for first positional arg
+    :param polygons: Keyword specification for second positional arg
+    :param chunk_size: Number of points per STRtree query
+    :return: numpy array of polygon positions, one per point
+    """
+    # args[0] / points=
+    if points is None:
+        raise IndexError("invalid points= argument provided by user")
+    # args[1] / polygons=
+    if polygons is None:
+        raise IndexError("invalid polygons= argument provided by user")
+    if isinstance(polygons, Vector):
+        _tree = polygons.sindex
+    elif isinstance(polygons, (gp.GeoDataFrame, gp.GeoSeries)):
+        _tree = shapely.STRtree(np.asarray(polygons.geometry.values))
+    else:
+        _tree = shapely.STRtree(_as_geometry_array(polygons))
+    _polygons = _tree.geometries
+    # prepared polygons are much faster to test, especially large ones
+    shapely.prepare(_polygons)
+    _n, _n_polygons = len(points), len(_polygons)
+    _ids = np.full(_n, _n_polygons, dtype=np.int64)
+    for _start in range(0, _n, chunk_size):
+        _points = _as_point_geometries(points, _start, _start + chunk_size)
+        # candidates from bounding boxes, then the exact test
+        _i, _j = _tree.query(_points)
+        _hit = shapely.intersects_xy(
+            _polygons[_j], shapely.get_x(_points[_i]), shapely.get_y(_points[_i])
+        )
+        np.minimum.at(_ids, _start + _i[_hit], _j[_hit])
+    _ids[_ids == _n_polygons] = -1
+    return _ids
 
 
 def _geom_units(*args):
@@ -367,28 +1642,23 @@ def _geom_units(*args):
         raise IndexError("1st positional argument should either "
                          "be a Vector or GeoDataFrame object")
     if isinstance(_gdf, Vector):
-        _gdf = _gdf.to_geodataframe()
-    # by default, there should be a units key
-    # associated with the CRS dict object. Prefer
-    # to use that units entry
-    try:
-        return _gdf['crs']['units']
-    # otherwise, let's hackishly lean on pyproj to figure out
-    # units from the full PROJ.4 string
-    except KeyError:
-        proj_4_string = pyproj.Proj(
-            "+init=EPSG:"+str(_gdf.crs['init'].split(":")[1])
-        )
-        _units = proj_4_string.srs.split("+units=")[1].split(" +")[0]
-        if _units.find("m") != -1:
-            return "m"
-        else:
-            return _units
+        _crs = _gdf._crs_wkt or _gdf.crs
+    else:
+        _crs = _gdf.crs
+    # lean on our cached pyproj CRS to figure out the units of
+    # our first axis
+    _units = _get_crs(_crs).axis_info[0].unit_name
+    if _units in ("metre", "meter"):
+        return "m"
+    else:
+        return _units
 
 
 def _local_rebuild_crs(*args):
     _gdf = args[0]
-    _gdf.crs = fiona.crs.from_epsg(int(_gdf.crs['init'].split(":")[1]))
+    # newer GeoPandas already keeps a pyproj CRS for us
+    if _gdf.crs is not None and not isinstance(_gdf.crs, pyproj.CRS):
+        _gdf.crs = _get_crs(_gdf.crs)
     return _gdf
 
 
@@ -402,21 +1672,9 @@ def rebuild_crs(*args):
     :param args:
     :return:
     """
-    if isinstance(args[0], "EE"):
-        return Do(
-            args[2:],
-            this=_ee_rebuild_crs,
-            that=args[1],
-        ).run()
-    elif isinstance(args[0], "Local"):
-        return Do(
-            args[2:],
-            this=_local_rebuild_crs,
-            that=args[1]
-        ).run()
-    else:
-        # our default action is to just assume local operation
-        return _local_rebuild_crs(*args)
+    # Vector and GeoDataFrame inputs aren't Backend objects, so there is
+    # nothing to dispatch on -- everything runs locally
+    return _local_rebuild_crs(*args)
 
 def is_valid_file(string=None):
     try:
@@ -13,7 +13,7 @@ except ImportError:
 from shutil import copyfile
 
 INSTALL_REQUIRES = [
-    'scipy', 'pandas', 'shapely', 'fiona', 'pyproj', 'geopandas',
+    'scipy', 'pandas', 'shapely>=2.0', 'fiona', 'pyproj', 'geopandas',
     'georasters', 'psutil', 'requests', 'bs4', 'gdal', 'numpy'
 ]
 
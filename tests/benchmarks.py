@@ -0,0 +1,359 @@
+#!/usr/bin/python3
+"""
+__author__ = "Kyle Taylor"
+__copyright__ = "Copyright 2017, Playa Lakes Joint Venture"
+__credits__ = ["Kyle Taylor", "Stephen Chang"]
+__license__ = "GPL"
+__version__ = "3"
+__maintainer__ = "Kyle Taylor"
+__email__ = "kyle.taylor@pljv.org"
+__status__ = "Testing"
+"""
+
+import sys, os, gc, json, time, platform
+import argparse as ap
+import logging
+import multiprocessing as mp
+
+import numpy as np
+import scipy
+import shapely
+import geopandas as gp
+import psutil
+
+from concurrent.futures import ProcessPoolExecutor
+
+from beatbox.convex_hulls import fuzzy_convex_hull, \
+    _dissolve_overlapping_geometries, _spatial_join
+
+try:
+    import resource
+except ImportError:
+    resource = None  # peak memory is only reported on unix-like systems
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_DEFAULT_SIZES = (10000, 100000, 1000000, 10000000)
+_DEFAULT_WIDTH = 1000  # buffer width (in meters) used by every case
+_DEFAULT_DENSITY = 0.1  # points per square kilometer over our extent
+_DEFAULT_CLUSTER_SIZE = 100  # mean number of points per cluster
+_DEFAULT_CLUSTER_RADIUS = 1500  # standard deviation (in meters) of a cluster
+_DEFAULT_TOLERANCE = 0.2  # fraction slower than a baseline that we flag
+_CRS = 'EPSG:2163'
+
+
+def synthetic_points(n=None, density=_DEFAULT_DENSITY,
+                     cluster_size=_DEFAULT_CLUSTER_SIZE,
+                     cluster_radius=_DEFAULT_CLUSTER_RADIUS, seed=0):
+    """
+    Generate clustered point features for benchmarking. Cluster centers are
+    scattered uniformly over a square extent sized so that our points have
+    the requested overall density, and points are drawn around a random
+    center with a normal spread of cluster_radius=
+    :param n: number of points
+    :param density: points per square kilometer over our extent
+    :param cluster_size: mean number of points per cluster
+    :param cluster_radius: standard deviation (in meters) of each cluster
+    :param seed: random seed -- the same arguments give the same points
+    :return: GeoDataFrame of points in a metric (EPSG:2163) CRS
+    """
+    # args[0] / n=
+    if n is None:
+        raise IndexError("invalid n= argument provided by user")
+    _rng = np.random.default_rng(seed)
+    _side = np.sqrt(n / density) * 1000
+    _n_clusters = max(1, int(round(n / cluster_size)))
+    _centers = (_rng.random((_n_clusters, 2)) - 0.5) * _side
+    _coords = _centers[_rng.integers(0, _n_clusters, n)] + \
+        _rng.normal(0, cluster_radius, (n, 2))
+    return gp.GeoDataFrame(geometry=shapely.points(_coords), crs=_CRS)
+
+
+def _setup_points(points=None, width=None):
+    return [points]
+
+
+def _setup_buffers(points=None, width=None):
+    return [points.buffer(width)]
+
+
+def _setup_join(points=None, width=None):
+    # _spatial_join dissolves its (raw) buffers itself
+    return [points.buffer(width), points]
+
+
+# case name : (setup function, benchmarked function). Setup isn't timed
+_CASES = {
+    'fuzzy_convex_hull': (
+        _setup_points,
+        lambda points, width: fuzzy_convex_hull(points, width)
+    ),
+    'fuzzy_convex_hull_kdtree': (
+        _setup_points,
+        lambda points, width: fuzzy_convex_hull(points, width,
+                                                method='kdtree')
+    ),
+    'dissolve_overlapping_geometries': (
+        _setup_buffers,
+        lambda buffers, width: _dissolve_overlapping_geometries(buffers)
+    ),
+    'spatial_join': (
+        _setup_join,
+        lambda buffers, points, width: _spatial_join(buffers, points)
+    ),
+}
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak resident memory the kernel keeps for this process, so
+    that later peaks don't include our setup. Only linux lets us do this
+    :return: True if our peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def _peak_rss():
+    """ peak resident memory of this process (in bytes) since it was last
+    reset (see _reset_peak_rss), or over its lifetime
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for _line in f:
+                if _line.startswith('VmHWM:'):
+                    return int(_line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    _peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    return _peak if sys.platform == 'darwin' else _peak * 1024
+
+
+def run_case(case=None, n=None, width=_DEFAULT_WIDTH, density=_DEFAULT_DENSITY,
+             cluster_size=_DEFAULT_CLUSTER_SIZE,
+             cluster_radius=_DEFAULT_CLUSTER_RADIUS, seed=0):
+    """
+    Time one benchmark case on synthetic points. Memory is the peak resident
+    memory of our process during the timed call, above its resident memory
+    just before it -- tracemalloc can't see the allocations that GEOS
+    makes, which dominate our geometry operations. Our peak is reset after
+    setup where the kernel lets us (linux); elsewhere peak_rss_mb is None if
+    setup may have set it. Run each case in a fresh process (see
+    run_cases) so that peaks from earlier cases don't hide later ones
+    :return: dict of our case, its parameters, seconds, and peak_rss_mb
+    """
+    # args[0] / case=
+    if case not in _CASES:
+        raise ValueError("case= should be one of " + str(sorted(_CASES)))
+    _setup, _function = _CASES[case]
+    _args = _setup(synthetic_points(n, density, cluster_size,
+                                    cluster_radius, seed), width)
+    gc.collect()
+    _setup_peak = None if _reset_peak_rss() else _peak_rss()
+    _baseline = psutil.Process().memory_info().rss
+    _start = time.perf_counter()
+    _result = _function(*_args, width=width)
+    _seconds = time.perf_counter() - _start
+    _peak = _peak_rss()
+    # without a reset, a peak no higher than our setup's isn't ours
+    if _setup_peak is not None and _peak is not None and _peak <= _setup_peak:
+        _peak = None
+    return {
+        'case': case,
+        'n': n,
+        'width': width,
+        'density': density,
+        'cluster_size': cluster_size,
+        'cluster_radius': cluster_radius,
+        'seed': seed,
+        'seconds': _seconds,
+        'peak_rss_mb': None if _peak is None else
+        max(0, _peak - _baseline) / 2 ** 20,
+        'n_results': len(_result)
+    }
+
+
+def run_cases(cases=None, sizes=_DEFAULT_SIZES, repeat=1, **kwargs):
+    """
+    Run every case at every size, each in a fresh (spawned) process,
+    keeping the fastest of repeat= runs
+    :return: list of result dicts (see run_case)
+    """
+    _results = []
+    _context = mp.get_context('spawn')
+    for _n in sizes:
+        for _case in cases or sorted(_CASES):
+            _runs = []
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1,
+                                         mp_context=_context) as pool:
+                    _runs.append(pool.submit(
+                        run_case, _case, _n, **kwargs
+                    ).result())
+            _best = min(_runs, key=lambda r: r['seconds'])
+            logger.info("%s n=%s: %.3fs, %s MB peak", _case, _n,
+                        _best['seconds'], _best['peak_rss_mb'])
+            _results.append(_best)
+    return _results
+
+
+def _environment():
+    """ versions and hardware to record alongside our results """
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'shapely': shapely.__version__,
+        'geopandas': gp.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'memory_gb': psutil.virtual_memory().total / 2 ** 30
+    }
+
+
+def compare(results=None, baseline=None, tolerance=_DEFAULT_TOLERANCE):
+    """
+    Compare our results against the results of an earlier run
+    :return: list of (case, n, seconds / baseline seconds) for every case
+    slower than the baseline by more than tolerance= (as a fraction)
+    """
+    _baseline = dict(((r['case'], r['n']), r) for r in baseline['results'])
+    _regressions = []
+    for _result in results['results']:
+        _key = (_result['case'], _result['n'])
+        if _key not in _baseline:
+            continue
+        _ratio = _result['seconds'] / _baseline[_key]['seconds']
+        logger.info("%s n=%s: %.2fx the time of our baseline", _key[0],
+                    _key[1], _ratio)
+        if _ratio > 1 + tolerance:
+            _regressions.append((_key[0], _key[1], _ratio))
+    return _regressions
+
+
+if __name__ == "__main__":
+    # define handlers for argparse for any arguments passed at runtime
+    example_text = str(
+        "example: " + sys.argv[0] +
+        " -n 10000,100000,1000000,10000000 -o results.json" +
+        " --compare baseline.json")
+    descr_text = str(
+        'Time and memory-profile our clustering and hull generation on' +
+        ' synthetic clustered points, emitting results as JSON')
+    parser = ap.ArgumentParser(
+        description=descr_text,
+        epilog=example_text,
+        formatter_class=ap.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        '-n',
+        '--sizes',
+        help='Comma-separated numbers of points to benchmark with' +
+             ' (default: %(default)s -- 10M points take a while, and' +
+             ' several GB of memory)',
+        type=str,
+        default=','.join(str(n) for n in _DEFAULT_SIZES)
+    )
+    parser.add_argument(
+        '-c',
+        '--cases',
+        help='Comma-separated cases to run (default: all of ' +
+             ', '.join(sorted(_CASES)) + ')',
+        type=str,
+        required=False
+    )
+    parser.add_argument(
+        '-w',
+        '--width',
+        help='Buffer width (in meters) used by every case',
+        type=float,
+        default=_DEFAULT_WIDTH
+    )
+    parser.add_argument(
+        '--density',
+        help='Points per square kilometer over our extent',
+        type=float,
+        default=_DEFAULT_DENSITY
+    )
+    parser.add_argument(
+        '--cluster-size',
+        help='Mean number of points per cluster',
+        type=float,
+        default=_DEFAULT_CLUSTER_SIZE
+    )
+    parser.add_argument(
+        '--cluster-radius',
+        help='Standard deviation (in meters) of each cluster',
+        type=float,
+        default=_DEFAULT_CLUSTER_RADIUS
+    )
+    parser.add_argument(
+        '--seed',
+        help='Random seed for our synthetic points',
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        '-r',
+        '--repeat',
+        help='Keep the fastest of this many runs of each case',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '-o',
+        '--output',
+        help='Write our results to this JSON file (default: stdout)',
+        type=str,
+        required=False
+    )
+    parser.add_argument(
+        '--compare',
+        help='JSON results of an earlier run to compare against -- exits' +
+             ' with status 1 if any case regressed',
+        type=str,
+        required=False
+    )
+    parser.add_argument(
+        '--tolerance',
+        help='Fraction slower than our --compare baseline to flag as a' +
+             ' regression',
+        type=float,
+        default=_DEFAULT_TOLERANCE
+    )
+    args = parser.parse_args()
+
+    results = {
+        'environment': _environment(),
+        'results': run_cases(
+            cases=args.cases.split(',') if args.cases else None,
+            sizes=[int(float(n)) for n in args.sizes.split(',')],
+            repeat=args.repeat,
+            width=args.width,
+            density=args.density,
+            cluster_size=args.cluster_size,
+            cluster_radius=args.cluster_radius,
+            seed=args.seed
+        )
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for case, n, ratio in regressions:
+            logger.warning("%s n=%s regressed: %.2fx the time of our "
+                           "baseline", case, n, ratio)
+        if regressions:
+            sys.exit(1)
@@ -1,6 +1,11 @@
+import os
+import tempfile
 import unittest
 
+import numpy as np
+
 from copy import copy, deepcopy
+from functools import partial
 
 # GeoJSON test string randomly pulled out of a browser
 _GEOJSON_TEST_STR: str = '"{"type":"FeatureCollection","features":[{"type":"Feature",' \
@@ -70,5 +75,883 @@ class TestVectorBaseMethods(unittest.TestCase):
     def test_to_ee_feature_collection(self):
         pass
 
+_GEOJSON_POINTS_STR = '{"type":"FeatureCollection","features":[' \
+                      '{"type":"Feature","geometry":{"type":"Point",' \
+                      '"coordinates":[-98.5,39.0]},"properties":{"fid":0,' \
+                      '"name":"a"}},{"type":"Feature","geometry":{"type":' \
+                      '"Point","coordinates":[-98.4,38.9]},"properties":' \
+                      '{"fid":1}}]}'
+
+class TestVectorColumnarRead(unittest.TestCase):
+    def test_read_geojson_attributes(self):
+        from beatbox import Vector
+        _vector = Vector(json=_GEOJSON_POINTS_STR)
+        self.assertEqual(len(_vector.geometries), 2)
+        self.assertEqual(list(_vector.attributes.columns), ['fid', 'name'])
+        self.assertEqual(list(_vector.attributes['fid']), [0, 1])
+        self.assertTrue(_vector.attributes['name'].isnull()[1])
+
+class TestVectorGeometryArray(unittest.TestCase):
+    def setUp(self):
+        from beatbox import Vector
+        self.vector = Vector(json=_GEOJSON_POINTS_STR)
+
+    def test_geometries_are_an_array(self):
+        self.assertIsInstance(self.vector.geometries, np.ndarray)
+        self.assertEqual(self.vector.bounds.shape, (2, 4))
+        self.assertEqual(self.vector.coordinates.shape, (2, 2))
+
+    def test_vectorized_buffer_and_predicates(self):
+        _buffers = self.vector.buffer(0.01)
+        self.assertTrue(np.all(_buffers.area > 0))
+        self.assertTrue(np.all(_buffers.contains(self.vector)))
+        self.assertEqual(list(self.vector.intersects(_buffers.geometries[0])),
+                         [True, False])
+
+class TestVectorBulkWrite(unittest.TestCase):
+    def test_write_all_features_and_attributes(self):
+        from beatbox import Vector
+        _vector = Vector(json=_GEOJSON_POINTS_STR)
+        _dir = tempfile.TemporaryDirectory()
+        self.addCleanup(_dir.cleanup)
+        # GeoPackages reserve 'fid' for their feature ids
+        for _ext, _column in (('.gpkg', 'fid_1'), ('.shp', 'fid')):
+            _filename = os.path.join(_dir.name, 'points' + _ext)
+            if _ext == '.gpkg':
+                with self.assertLogs('beatbox.vector', level='WARNING'):
+                    _vector.write(_filename, chunk_size=1)
+            else:
+                _vector.write(_filename, chunk_size=1)
+            _copy = Vector(_filename)
+            self.assertEqual(len(_copy.geometries), 2)
+            self.assertEqual(sorted(_copy.attributes[_column]), [0, 1])
+
+    def test_write_after_changing_geometry_type(self):
+        from beatbox import Vector
+        _dir = tempfile.TemporaryDirectory()
+        self.addCleanup(_dir.cleanup)
+        _points = os.path.join(_dir.name, 'points.shp')
+        Vector(json=_GEOJSON_POINTS_STR).write(_points)
+        _buffers = os.path.join(_dir.name, 'buffers.shp')
+        _vector = Vector(_points).buffer(0.01)
+        # derived Vectors carry a schema for their own geometries
+        self.assertEqual(_vector.schema['geometry'], 'Polygon')
+        _dissolved, _ = Vector(_points).buffer_dissolve(0.2)
+        self.assertEqual(_dissolved.schema['geometry'], 'Polygon')
+        _vector.write(_buffers)
+        _copy = Vector(_buffers)
+        self.assertEqual(_copy.schema['geometry'], 'Polygon')
+        self.assertEqual(sorted(_copy.attributes['fid']), [0, 1])
+
+class TestVectorGeoJson(unittest.TestCase):
+    def setUp(self):
+        from beatbox import Vector
+        self.vector = Vector(json=_GEOJSON_POINTS_STR)
+
+    def test_feature_collection(self):
+        _collection = self.vector.to_geojson(precision=0)
+        self.assertEqual(len(_collection['features']), 2)
+        self.assertEqual(_collection['features'][0]['properties']['fid'], 0)
+        self.assertEqual(
+            _collection['features'][0]['geometry']['coordinates'], [-98.0, 39.0]
+        )
+
+    def test_newline_delimited(self):
+        _lines = self.vector.to_geojson(newline_delimited=True,
+                                        chunk_size=1).splitlines()
+        self.assertEqual(len(_lines), 2)
+        self.assertTrue(_lines[1].startswith('{"type": "Feature"'))
+
+class TestVectorSpatialIndex(unittest.TestCase):
+    def setUp(self):
+        from beatbox import Vector
+        self.vector = Vector(json=_GEOJSON_POINTS_STR)
+
+    def test_cached_and_invalidated(self):
+        _tree = self.vector.sindex
+        self.assertIs(_tree, self.vector.sindex)
+        self.vector.geometries = self.vector.buffer(0.01).geometries
+        self.assertIsNot(_tree, self.vector.sindex)
+
+    def test_query_and_nearest(self):
+        from shapely.geometry import Point, box
+        _pairs = self.vector.query(box(-98.6, 38.95, -98.45, 39.05),
+                                   predicate='intersects')
+        self.assertEqual(list(_pairs[1]), [0])
+        _pairs = self.vector.nearest([Point(-98.41, 38.91)])
+        self.assertEqual(list(_pairs[1]), [1])
+
+class TestVectorReprojection(unittest.TestCase):
+    def test_to_crs_uses_cached_transformers(self):
+        from beatbox import Vector
+        from beatbox.vector import _TRANSFORMER_CACHE, _geom_units
+        _vector = Vector(json=_GEOJSON_POINTS_STR)
+        _projected = _vector.to_crs(epsg=2163)
+        _n_transformers = len(_TRANSFORMER_CACHE)
+        _vector.to_crs(epsg=2163)
+        self.assertEqual(len(_TRANSFORMER_CACHE), _n_transformers)
+        self.assertEqual(_geom_units(_projected), "m")
+        self.assertTrue(np.all(np.abs(_projected.coordinates) > 1000))
+
+class TestVectorGeoDataFrame(unittest.TestCase):
+    def test_round_trip_shares_data(self):
+        from beatbox import Vector
+        _vector = Vector(json=_GEOJSON_POINTS_STR)
+        _gdf = _vector.to_geodataframe()
+        self.assertTrue(all(
+            a is b for a, b in zip(_gdf.geometry.values, _vector.geometries)
+        ))
+        self.assertEqual(_gdf.crs.to_epsg(), 4326)
+        _round_trip = Vector.from_geodataframe(_gdf)
+        self.assertTrue(np.shares_memory(
+            _round_trip.geometries, np.asarray(_gdf.geometry.values)
+        ))
+        self.assertEqual(list(_round_trip.attributes.columns), ["fid", "name"])
+        self.assertEqual(len(Vector(_gdf)), 2)
+
+class TestVectorPartition(unittest.TestCase):
+    def setUp(self):
+        from beatbox import Vector
+        import shapely
+        _rng = np.random.default_rng(0)
+        self.vector = Vector()
+        self.vector.geometries = shapely.points(np.concatenate([
+            _rng.normal(0, 1, (500, 2)), _rng.normal(20, 1, (500, 2))
+        ]))
+
+    def test_partitions_cover_all_features(self):
+        for _method in ('hilbert', 'grid', 'quadtree'):
+            _partitions = self.vector.partition(4, method=_method)
+            _index = np.concatenate([p['index'] for p in _partitions])
+            self.assertTrue(np.array_equal(np.sort(_index), np.arange(1000)))
+
+    def test_quadtree_is_balanced_and_local(self):
+        _partitions = self.vector.partition(
+            method='quadtree', max_features=100, margin=1
+        )
+        self.assertTrue(all(len(p['index']) <= 100 for p in _partitions))
+        _subset = self.vector.take(_partitions[0]['index'])
+        self.assertEqual(tuple(_subset.total_bounds), _partitions[0]['bounds'])
+        # our two clusters are far apart, so no partition should neighbor
+        # partitions from both
+        _west = {p['id'] for p in _partitions if p['bounds'][2] < 10}
+        for _p in _partitions:
+            _side = _p['id'] in _west
+            self.assertTrue(all((n in _west) == _side for n in _p['neighbors']))
+
+class TestVectorCache(unittest.TestCase):
+    def setUp(self):
+        from beatbox import Vector
+        _tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(_tmpdir.cleanup)
+        self.tmpdir = _tmpdir.name
+        self.cache_dir = os.environ.get('BEATBOX_CACHE_DIR')
+        os.environ['BEATBOX_CACHE_DIR'] = os.path.join(self.tmpdir, 'cache')
+        self.filename = os.path.join(self.tmpdir, 'points.gpkg')
+        Vector(json=_GEOJSON_POINTS_STR).write(self.filename)
+
+    def tearDown(self):
+        if self.cache_dir is None:
+            del os.environ['BEATBOX_CACHE_DIR']
+        else:
+            os.environ['BEATBOX_CACHE_DIR'] = self.cache_dir
+
+    def test_cached_read_matches_source(self):
+        from beatbox import Vector
+        from unittest import mock
+        _source = Vector(self.filename, cache=True)
+        self.assertEqual(len(os.listdir(os.environ['BEATBOX_CACHE_DIR'])), 1)
+        with mock.patch('fiona.open') as _open:
+            _cached = Vector(self.filename, cache=True)
+        _open.assert_not_called()
+        self.assertTrue(_cached.attributes.equals(_source.attributes))
+        self.assertTrue(all(_cached.geometries == _source.geometries))
+        self.assertEqual(_cached.crs.to_epsg(), 4326)
+
+    def test_superseded_entries_are_pruned(self):
+        from beatbox import Vector
+        from beatbox.vector import _CACHE_MAX_QUERIES
+        _cache_dir = os.environ['BEATBOX_CACHE_DIR']
+        Vector(self.filename, cache=True)
+        _stale = os.listdir(_cache_dir)
+        # a new version of our source replaces its cached copy
+        _stat = os.stat(self.filename)
+        os.utime(self.filename, ns=(_stat.st_atime_ns,
+                                    _stat.st_mtime_ns + 10 ** 9))
+        Vector(self.filename, cache=True)
+        self.assertEqual(len(os.listdir(_cache_dir)), 1)
+        self.assertNotEqual(os.listdir(_cache_dir), _stale)
+        # and only so many queries of it are kept
+        for _i in range(_CACHE_MAX_QUERIES + 2):
+            Vector(self.filename, cache=True, where="fid_1 >= %d" % _i)
+        self.assertEqual(len(os.listdir(_cache_dir)), _CACHE_MAX_QUERIES)
+
+class TestVectorReadPushdown(unittest.TestCase):
+    def setUp(self):
+        from beatbox import Vector
+        _tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(_tmpdir.cleanup)
+        self.filename = os.path.join(_tmpdir.name, 'points.gpkg')
+        Vector(json=_GEOJSON_POINTS_STR).write(self.filename)
+
+    def test_columns_and_filters(self):
+        from beatbox import Vector
+        _vector = Vector(self.filename, columns=['name'], where="name = 'a'")
+        self.assertEqual(len(_vector), 1)
+        self.assertEqual(list(_vector.attributes.columns), ['name'])
+        _vector = Vector(self.filename, columns=[], bbox=(-98.6, 38.95, -98.45, 39.1))
+        self.assertEqual(_vector.attributes.shape, (1, 0))
+
+    def test_filter_on_an_unselected_column(self):
+        from beatbox import Vector
+        _source = Vector(json=_GEOJSON_POINTS_STR)
+        for _ext in ('.shp', '.geojson'):
+            _filename = os.path.join(os.path.dirname(self.filename),
+                                     'points' + _ext)
+            _source.write(_filename)
+            _vector = Vector(_filename, columns=['fid'], where="NAME = 'a'")
+            self.assertEqual(list(_vector.attributes['fid']), [0])
+            self.assertEqual(list(_vector.schema['properties']), ['fid'])
+            _vector = Vector(_filename, columns=[], where="name IS NULL")
+            self.assertEqual(_vector.attributes.shape, (1, 0))
+
+class TestPointsInPolygons(unittest.TestCase):
+    def setUp(self):
+        import shapely
+        self.polygons = shapely.buffer(
+            shapely.points([[0, 0], [10, 0], [11, 0]]), 2
+        )
+        self.points = np.array([[0, 1], [10.5, 0], [12.5, 0], [50, 50]])
+
+    def test_polygon_ids(self):
+        from beatbox import Vector, points_in_polygons
+        _polygons = Vector()
+        _polygons.geometries = self.polygons
+        # overlapping polygons resolve to the lowest position
+        for _ids in (points_in_polygons(self.points, _polygons, chunk_size=3),
+                     points_in_polygons(self.points, self.polygons)):
+            self.assertEqual(list(_ids), [0, 1, 2, -1])
+
+    def test_matches_sjoin(self):
+        import shapely
+        import geopandas as gp
+        from beatbox import points_in_polygons
+        _rng = np.random.default_rng(0)
+        _points = gp.GeoDataFrame(
+            geometry=shapely.points(_rng.random((2000, 2)) * 100))
+        _polygons = gp.GeoDataFrame(geometry=shapely.buffer(
+            shapely.points(_rng.random((50, 2)) * 100), 3))
+        _ids = points_in_polygons(_points, _polygons)
+        _joined = gp.sjoin(_points, _polygons, predicate='intersects')
+        _expected = _joined.groupby(level=0)['index_right'].min()
+        self.assertTrue(np.array_equal(np.flatnonzero(_ids >= 0),
+                                       _expected.index))
+        self.assertTrue(np.array_equal(_ids[_ids >= 0], _expected))
+
+class TestVectorBufferDissolve(unittest.TestCase):
+    def setUp(self):
+        import shapely
+        from beatbox import Vector
+        _rng = np.random.default_rng(0)
+        _centers = _rng.random((30, 2)) * 100000
+        _geometries = shapely.points(
+            _centers[_rng.integers(0, 30, 3000)] +
+            _rng.normal(0, 1500, (3000, 2))
+        )
+        _geometries[7] = None
+        self.vector = Vector()
+        self.vector.geometries = _geometries
+
+    def test_partitioned_dissolve_matches_global(self):
+        import shapely
+        from beatbox.vector import _overlap_groups, _union_groups
+        _buffers = shapely.buffer(np.delete(self.vector.geometries, 7), 1000,
+                                  quad_segs=16)
+        _n_groups, _expected = _overlap_groups(_buffers)
+        _expected_polygons = _union_groups(_buffers, _expected, _n_groups)
+        for _kwargs in ({}, {'n_partitions': 9},
+                        {'n_partitions': 9, 'method': 'grid'},
+                        {'n_workers': 2, 'backend': 'thread'}):
+            _dissolved, _groups = self.vector.buffer_dissolve(1000, **_kwargs)
+            self.assertEqual(_groups[7], -1)
+            self.assertTrue(np.array_equal(np.delete(_groups, 7), _expected))
+            self.assertEqual(list(_dissolved.attributes['group']),
+                             list(range(_n_groups)))
+            self.assertTrue(np.allclose(_dissolved.area,
+                                        shapely.area(_expected_polygons)))
+
+class TestRasterTiles(unittest.TestCase):
+    def setUp(self):
+        from beatbox import Raster
+        self.array = np.arange(1, 37*53 + 1, dtype=np.uint16).reshape(37, 53)
+        self.raster = Raster(array=self.array)
+        self.raster.geot = (100.0, 30.0, 0.0, 500.0, 0.0, -30.0)
+
+    def test_tile_apply_matches_whole_array(self):
+        from beatbox import tile_apply
+        from scipy import ndimage
+        _result = tile_apply(
+            rasters=self.raster,
+            function=partial(ndimage.maximum_filter, size=5),
+            halo=2,
+            tile_size=(8, 11),
+            n_workers=3
+        )
+        self.assertTrue(np.array_equal(
+            _result.array.data, ndimage.maximum_filter(self.array, size=5)
+        ))
+        self.assertEqual(_result.geot, self.raster.geot)
+
+    def test_window_halos_read_neighbouring_cells(self):
+        from beatbox import tile_apply
+        from scipy import ndimage
+        _result = tile_apply(
+            rasters=self.raster,
+            function=partial(ndimage.maximum_filter, size=5),
+            halo=2,
+            tile_size=(4, 5),
+            window=(10, 20, 9, 13)
+        )
+        # cells at the edge of our window see the raster beyond it
+        self.assertTrue(np.array_equal(
+            _result.array.data,
+            ndimage.maximum_filter(self.array, size=5)[10:19, 20:33]
+        ))
+
+    def test_empty_window(self):
+        from beatbox import tile_apply
+        _dir = tempfile.TemporaryDirectory()
+        self.addCleanup(_dir.cleanup)
+        for _filename in (None, os.path.join(_dir.name, 'empty.tif')):
+            with self.assertRaises(ValueError):
+                tile_apply(self.raster, lambda x: x, window=(5, 5, 0, 10),
+                           dst_filename=_filename)
+
+    def test_split_and_merge(self):
+        from beatbox.raster import _local_split, _local_merge
+        _segments = _local_split(self.raster, 4)
+        self.assertEqual(_segments[1].geot[3], 500.0 - 10 * 30.0)
+        _merged = _local_merge(_segments[::-1])
+        self.assertTrue(np.array_equal(_merged.array.data, self.array))
+        self.assertEqual(_merged.geot, self.raster.geot)
+
+    def test_crop_reads_only_the_shape_window(self):
+        import shapely
+        from beatbox import crop
+        # cells (rows 2-9, cols 3-12) of our raster
+        _shape = shapely.box(100.0 + 3 * 30, 500.0 - 10 * 30,
+                             100.0 + 13 * 30, 500.0 - 2 * 30)
+        _result = crop(self.raster, _shape, tile_size=(3, 4), n_workers=2)
+        self.assertEqual(_result.array.shape, (8, 10))
+        self.assertEqual(_result.geot,
+                         (100.0 + 3 * 30, 30.0, 0.0, 500.0 - 2 * 30, 0.0,
+                          -30.0))
+        self.assertTrue(np.array_equal(_result.array.data,
+                                       self.array[2:10, 3:13]))
+        self.assertFalse(_result.array.mask.any())
+
+    def test_crop_masks_cells_outside_of_shape(self):
+        import shapely
+        from beatbox import crop
+        # a triangle over the upper-left corner of our raster
+        _shape = shapely.Polygon([(100.0, 500.0), (100.0 + 10 * 30, 500.0),
+                                  (100.0, 500.0 - 10 * 30)])
+        _result = crop(self.raster, _shape, tile_size=(4, 4))
+        self.assertEqual(_result.array.shape, (10, 10))
+        _rows, _cols = np.indices((10, 10))
+        self.assertTrue(np.array_equal(_result.array.mask,
+                                       _rows + _cols + 1 > 9))
+
+class TestRasterAlgebra(unittest.TestCase):
+    def setUp(self):
+        from beatbox import Raster
+        self.a = np.arange(1, 21, dtype=np.uint16).reshape(4, 5)
+        self.b = (self.a % 3 + 1).astype(np.uint16)
+        self.b[0, 0] = 0  # no data in b
+        self.raster_a = Raster(array=self.a)
+        self.raster_b = Raster(array=self.b)
+
+    def test_expression_is_lazy(self):
+        from beatbox import RasterExpression
+        _expr = (self.raster_a > 5) & (self.raster_b == 3)
+        self.assertIsInstance(_expr, RasterExpression)
+        self.assertEqual(len(_expr.rasters), 2)
+
+    def test_blockwise_evaluation(self):
+        _result = ((self.raster_a > 5) & (self.raster_b == 3)) * \
+            self.raster_a
+        _result = _result.evaluate(tile_size=2)
+        _expected = ((self.a > 5) & (self.b == 3)) * self.a
+        self.assertTrue(_result.array.mask[0, 0])
+        self.assertTrue(np.array_equal(
+            _result.array.data[1:], _expected[1:]
+        ))
+
+    def test_results_equal_to_ndv_stay_valid(self):
+        # a[0, 0] - 1 == 0, which is also our inputs' no data value
+        _result = (self.raster_a - 1).evaluate(tile_size=2)
+        self.assertEqual(_result.array[0, 0], 0)
+        self.assertFalse(_result.array.mask.any())
+        _result = (self.raster_b / 2).evaluate()
+        self.assertTrue(np.isnan(_result.ndv))
+        self.assertEqual(np.argwhere(_result.array.mask).tolist(), [[0, 0]])
+
+    def test_rasters_compare_by_identity(self):
+        from beatbox import RasterExpression
+        _rasters = [self.raster_a, self.raster_b]
+        self.assertIn(self.raster_b, _rasters)
+        self.assertEqual(_rasters.index(self.raster_b), 1)
+        self.assertNotIn(self.raster_b, [self.raster_a])
+        self.assertTrue(self.raster_a != self.raster_b)
+        # scalars and eq() still build expressions
+        self.assertIsInstance(self.raster_a == 3, RasterExpression)
+        _result = self.raster_a.eq(self.raster_b).evaluate()
+        self.assertTrue(np.array_equal(_result.array.data[1:],
+                                       (self.a == self.b)[1:]))
+
+class TestRasterCrosstab(unittest.TestCase):
+    def test_transition_counts(self):
+        from beatbox import Raster, crosstab
+        _y1 = np.array([[1, 1, 2], [2, 3, 0]], dtype=np.uint8)
+        _y2 = np.array([[1, 2, 2], [2, 3, 3]], dtype=np.uint8)
+        _table = crosstab([Raster(array=_y1), Raster(array=_y2)],
+                          names=['y1', 'y2'], tile_size=1)
+        _table = _table.set_index(['y1', 'y2'])['count']
+        self.assertEqual(_table[(1, 2)], 1)
+        self.assertEqual(_table[(2, 2)], 2)
+        # the no data cell in y1 is skipped
+        self.assertEqual(_table.sum(), 5)
+
+    def test_byte_codes_above_127_from_files(self):
+        from beatbox import Raster, crosstab, tile_apply
+        _dir = tempfile.TemporaryDirectory()
+        self.addCleanup(_dir.cleanup)
+        _y1 = np.array([[1, 176, 176], [255, 1, 128]], dtype=np.uint8)
+        _y2 = np.array([[176, 176, 1], [255, 255, 128]], dtype=np.uint8)
+        # GDAL Byte rasters, read back lazily
+        _rasters = [
+            tile_apply(Raster(array=_y), lambda x: x, tile_size=1,
+                       dst_filename=os.path.join(_dir.name, '%d.tif' % i))
+            for i, _y in enumerate((_y1, _y2))
+        ]
+        _table = crosstab(_rasters, names=['y1', 'y2'], tile_size=1)
+        _table = _table.set_index(['y1', 'y2'])['count']
+        self.assertEqual(_table.to_dict(), {(1, 176): 1, (176, 176): 1,
+                                            (176, 1): 1, (255, 255): 1,
+                                            (1, 255): 1, (128, 128): 1})
+
+    def test_wide_levels_dont_overflow(self):
+        from beatbox import Raster, crosstab
+        _wide = 2 ** 30
+        _y1 = np.array([[1, _wide, _wide], [7, 1, 5]], dtype=np.int64)
+        _y2 = np.array([[2, _wide, _wide], [2, 2, 5]], dtype=np.int64)
+        _y3 = np.array([[3, 3, 3], [_wide, 3, 5]], dtype=np.int64)
+        _rasters = [Raster(array=_y1), Raster(array=_y2), Raster(array=_y3)]
+        _expected = {(1, 2, 3): 2, (_wide, _wide, 3): 2, (7, 2, _wide): 1,
+                     (5, 5, 5): 1}
+        # 2**90 combinations can't be packed into an int64 key, 2**60
+        # combinations are too many to count densely, 512 are counted densely
+        for _levels in ([(1, _wide)] * 3, [(1, _wide), (1, _wide), (3, 3)],
+                        [(1, 8)] * 3):
+            _table = crosstab(_rasters, names=['y1', 'y2', 'y3'],
+                              levels=_levels, tile_size=1)
+            _table = _table.set_index(['y1', 'y2', 'y3'])['count']
+            _counts = dict((k, v) for k, v in _expected.items()
+                           if all(lo <= c <= hi for c, (lo, hi) in
+                                  zip(k, _levels)))
+            self.assertEqual(_table.to_dict(), _counts)
+
+class TestRasterStats(unittest.TestCase):
+    def setUp(self):
+        from beatbox import Raster
+        self.array = np.arange(0, 100, dtype=np.uint16).reshape(10, 10)
+        self.raster = Raster(array=self.array)
+
+    def test_streaming_stats(self):
+        _valid = self.array[self.array != 0]
+        _stats = self.raster.stats(quantiles=[0.5], tile_size=3)
+        self.assertEqual(_stats['count'], _valid.size)
+        self.assertEqual(_stats['min'], 1)
+        self.assertAlmostEqual(_stats['mean'], _valid.mean())
+        self.assertAlmostEqual(_stats['std'], _valid.std())
+        self.assertEqual(_stats['quantiles'][0.5], np.median(_valid))
+
+    def test_histogram(self):
+        _counts, _edges = self.raster.histogram(bins=4, tile_size=3)
+        self.assertEqual(_counts.sum(), 99)
+        self.assertEqual(_edges[0], 1)
+        self.assertEqual(_edges[-1], 99)
+
+    def test_sidecar_cache(self):
+        import json
+        from beatbox import Raster, tile_apply
+        from beatbox.raster import _STATS_SIDECAR_SUFFIX
+        _dir = tempfile.TemporaryDirectory()
+        self.addCleanup(_dir.cleanup)
+        _filename = os.path.join(_dir.name, 'stats.tif')
+        _raster = tile_apply(self.raster, lambda x: x, dst_filename=_filename)
+        self.assertEqual(_raster.stats()['count'], 99)
+        _sidecar = _filename + _STATS_SIDECAR_SUFFIX
+        self.assertTrue(os.path.exists(_sidecar))
+        # a later session answers from the sidecar, without a pass
+        with open(_sidecar) as f:
+            _cache = json.load(f)
+        _cache['summary']['count'] = -1
+        with open(_sidecar, 'w') as f:
+            json.dump(_cache, f)
+        self.assertEqual(Raster(_filename, lazy=True).stats()['count'], -1)
+        # until the raster changes (its mtime, here) and the sidecar is stale
+        _mtime = os.stat(_filename).st_mtime
+        os.utime(_filename, (_mtime + 10, _mtime + 10))
+        self.assertEqual(Raster(_filename, lazy=True).stats()['count'], 99)
+
+class TestDissolveOverlappingGeometries(unittest.TestCase):
+    def test_groups_match_unary_union(self):
+        import shapely
+        import geopandas as gp
+        from beatbox.convex_hulls import _dissolve_overlapping_geometries
+        _rng = np.random.default_rng(0)
+        _buffers = gp.GeoSeries(shapely.buffer(
+            shapely.points(_rng.random((500, 2)) * 1000), 20
+        ), crs='EPSG:2163')
+        _dissolved = _dissolve_overlapping_geometries(_buffers)
+        _union = shapely.get_parts(shapely.union_all(_buffers.values))
+        self.assertEqual(len(_dissolved), len(_union))
+        self.assertAlmostEqual(_dissolved.area.sum(),
+                               shapely.area(_union).sum())
+        self.assertEqual(list(_dissolved['group']),
+                         list(range(1, len(_union) + 1)))
+
+    def test_contained_geometries_are_grouped(self):
+        import shapely
+        from beatbox.convex_hulls import _dissolve_overlapping_geometries
+        _dissolved = _dissolve_overlapping_geometries([
+            shapely.box(0, 0, 10, 10), shapely.box(2, 2, 3, 3),
+            shapely.box(20, 20, 21, 21)
+        ])
+        self.assertEqual(len(_dissolved), 2)
+
+    def test_empty_input(self):
+        import shapely
+        import geopandas as gp
+        from beatbox import Vector
+        from beatbox.convex_hulls import _dissolve_overlapping_geometries
+        for _buffers in ([], [shapely.Polygon(), None],
+                         gp.GeoSeries([], crs='EPSG:2163')):
+            _dissolved = _dissolve_overlapping_geometries(_buffers)
+            self.assertEqual(len(_dissolved), 0)
+            self.assertEqual(list(_dissolved.columns), ['geometry', 'group'])
+        _vector = Vector()
+        _vector.geometries = [shapely.Point(), shapely.Point()]
+        _dissolved, _groups = _vector.buffer_dissolve(10)
+        self.assertEqual(len(_dissolved), 0)
+        self.assertEqual(list(_groups), [-1, -1])
+
+class TestClusterPoints(unittest.TestCase):
+    def setUp(self):
+        _rng = np.random.default_rng(0)
+        self.points = np.concatenate([
+            _rng.normal(c, 2000, (100, 2))
+            for c in [(0, 0), (50000, 0), (0, 60000)]
+        ] + [_rng.random((30, 2)) * 200000])
+
+    def test_single_linkage(self):
+        from beatbox import cluster_points
+        _labels = cluster_points(
+            np.array([[0, 0], [1, 0], [5, 0], [2.5, 0], [100, 100]]), 1.5
+        )
+        self.assertEqual(list(_labels), [0, 0, 1, 0, 2])
+
+    def test_wide_grids_dont_overflow(self):
+        from beatbox import cluster_points
+        # grid cells of side 1 -- packing cell (2**32, 0) into an int64 key
+        # with 2**32 rows would wrap around onto cell (0, 0)
+        _labels = cluster_points(
+            np.array([[0, 0], [2 ** 32 + 0.5, 0.5], [0.5, 2 ** 32 - 0.5]]),
+            np.sqrt(2)
+        )
+        self.assertEqual(list(_labels), [0, 1, 2])
+
+    def test_chunked_queries_match(self):
+        from beatbox import cluster_points
+        self.assertTrue(np.array_equal(
+            cluster_points(self.points, 2000),
+            cluster_points(self.points, 2000, chunk_size=37)
+        ))
+
+    def test_kdtree_hulls_match_buffered_hulls(self):
+        import shapely
+        import geopandas as gp
+        from beatbox import fuzzy_convex_hull
+        _points = gp.GeoDataFrame(geometry=shapely.points(self.points),
+                                  crs='EPSG:2163')
+        _buffered = fuzzy_convex_hull(_points, 1000)
+        _clustered = fuzzy_convex_hull(_points, 1000, method='kdtree')
+        self.assertEqual(len(_buffered), len(_clustered))
+        self.assertTrue(np.allclose(sorted(_buffered.area),
+                                    sorted(_clustered.area)))
+
+class TestGroupedConvexHulls(unittest.TestCase):
+    def test_hulls_match_shapely(self):
+        import shapely
+        from beatbox.convex_hulls import _grouped_convex_hulls
+        _rng = np.random.default_rng(0)
+        _coords = _rng.normal(0, 1, (5000, 2)) + \
+            np.repeat(np.arange(50), 100)[:, None] * 10
+        _labels = np.repeat(np.arange(50), 100)
+        _order = _rng.permutation(5000)
+        _ids, _hulls = _grouped_convex_hulls(_coords[_order], _labels[_order])
+        self.assertEqual(list(_ids), list(range(50)))
+        _expected = shapely.convex_hull(
+            shapely.multipoints(_coords, indices=_labels)
+        )
+        self.assertTrue(shapely.equals(_hulls, _expected).all())
+
+    def test_degenerate_groups_are_dropped(self):
+        from beatbox.convex_hulls import _grouped_convex_hulls
+        _ids, _hulls = _grouped_convex_hulls(
+            np.array([[0, 0], [1, 1], [2, 2], [5, 5], [6, 5],
+                      [0, 9], [1, 9], [0, 10]], dtype=float),
+            np.array([0, 0, 0, 1, 1, 2, 2, 2])
+        )
+        self.assertEqual(list(_ids), [2])
+        self.assertAlmostEqual(_hulls[0].area, 0.5)
+
+class TestClusterIndex(unittest.TestCase):
+    def setUp(self):
+        _rng = np.random.default_rng(0)
+        _centers = _rng.random((40, 2)) * 100000
+        self.points = _centers[_rng.integers(0, 40, 4000)] + \
+            _rng.normal(0, 1500, (4000, 2))
+
+    def test_incremental_inserts_match_full_rebuild(self):
+        from beatbox import ClusterIndex
+        _incremental = ClusterIndex(self.points[:3000], width=1000)
+        for i in range(3000, 4000, 250):
+            _incremental.insert(self.points[i:i + 250])
+        _full = ClusterIndex(self.points, width=1000)
+        self.assertTrue(np.array_equal(_incremental.labels, _full.labels))
+        self.assertTrue(np.array_equal(_incremental.hulls.index,
+                                       _full.hulls.index))
+        self.assertTrue(_incremental.hulls.geom_equals(_full.hulls).all())
+
+    def test_write_and_read(self):
+        from beatbox import ClusterIndex
+        _tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(_tmpdir.cleanup)
+        _filename = os.path.join(_tmpdir.name, 'clusters.npz')
+        _index = ClusterIndex(self.points[:3000], width=1000)
+        _index.write(_filename)
+        _restored = ClusterIndex(filename=_filename)
+        _restored.insert(self.points[3000:])
+        _index.insert(self.points[3000:])
+        self.assertTrue(np.array_equal(_restored.labels, _index.labels))
+        self.assertTrue(_restored.hulls.geom_equals(_index.hulls).all())
+
+class TestTiledClusterPoints(unittest.TestCase):
+    def test_tiled_labels_match_single_run(self):
+        from beatbox import cluster_points
+        _rng = np.random.default_rng(0)
+        _centers = _rng.random((100, 2)) * 100000
+        _points = _centers[_rng.integers(0, 100, 5000)] + \
+            _rng.normal(0, 1500, (5000, 2))
+        _labels = cluster_points(_points, 2000)
+        for _backend in ('thread', 'process'):
+            self.assertTrue(np.array_equal(_labels, cluster_points(
+                _points, 2000, n_workers=2, backend=_backend, n_tiles=9
+            )))
+
+class TestClusterSweep(unittest.TestCase):
+    def setUp(self):
+        _rng = np.random.default_rng(0)
+        _centers = _rng.random((60, 2)) * 100000
+        self.points = _centers[_rng.integers(0, 60, 3000)] + \
+            _rng.normal(0, 1500, (3000, 2))
+        # coincident points are still linked at any distance
+        self.points[1] = self.points[0]
+
+    def test_sweep_matches_single_runs(self):
+        from beatbox import cluster_points, cluster_sweep
+        _sweep = cluster_sweep(self.points, [500, 1000, 2066, 4000],
+                               chunk_size=401)
+        for _distance, _labels in _sweep.items():
+            self.assertTrue(np.array_equal(
+                _labels, cluster_points(self.points, _distance)
+            ))
+        self.assertEqual(_sweep[500][0], _sweep[500][1])
+
+    def test_hull_sweep_matches_fuzzy_convex_hull(self):
+        import shapely
+        import geopandas as gp
+        from beatbox import fuzzy_convex_hull, fuzzy_convex_hull_sweep
+        _points = gp.GeoDataFrame(geometry=shapely.points(self.points),
+                                  crs='EPSG:2163')
+        _sweep = fuzzy_convex_hull_sweep(_points, [500, 1033])
+        for _width, _hulls in _sweep.items():
+            _expected = fuzzy_convex_hull(_points, _width, method='kdtree')
+            self.assertTrue(np.array_equal(_hulls.index, _expected.index))
+            self.assertTrue(_hulls.geom_equals(_expected).all())
+
+class TestStreamClusterPoints(unittest.TestCase):
+    def setUp(self):
+        _rng = np.random.default_rng(0)
+        _centers = _rng.random((50, 2)) * 100000
+        self.points = _centers[_rng.integers(0, 50, 5000)] + \
+            _rng.normal(0, 1500, (5000, 2))
+
+    def test_bands_match_cluster_points(self):
+        from beatbox import cluster_points, stream_cluster_points
+        _expected = cluster_points(self.points, 2000)
+        for _band_rows in (1, 4):
+            self.assertTrue(np.array_equal(_expected, stream_cluster_points(
+                self.points, 2000, chunk_size=333, band_rows=_band_rows
+            )))
+
+    def test_memory_is_bounded_by_band_size(self):
+        from beatbox.clusters import _spill_bands, _STREAM_DTYPE
+        _tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(_tmpdir.cleanup)
+        _n, _bands = _spill_bands(self.points, 2000, chunk_size=333,
+                                  band_rows=1, work_dir=_tmpdir.name)
+        self.assertEqual(_n, len(self.points))
+        _sizes = [os.path.getsize(os.path.join(_tmpdir.name, '%d.band' % b))
+                  for b in _bands]
+        self.assertEqual(sum(_sizes), len(self.points) * _STREAM_DTYPE.itemsize)
+        # thin bands hold a small fraction of our points at a time
+        self.assertLess(max(_sizes), sum(_sizes) / 10)
+
+    def test_temporary_labels_are_in_memory(self):
+        from beatbox import stream_cluster_points
+        _labels = stream_cluster_points(self.points, 2000, band_rows=1)
+        self.assertNotIsInstance(_labels, np.memmap)
+        self.assertEqual(len(_labels), len(self.points))
+
+    def test_vector_file(self):
+        import shapely
+        from beatbox import Vector, cluster_points, stream_cluster_points
+        _geometries = shapely.points(self.points)
+        _geometries[3] = None
+        _vector = Vector()
+        _vector.geometries = _geometries
+        _vector.crs = 'EPSG:2163'
+        _expected = cluster_points(np.delete(self.points, 3, axis=0), 2000)
+        # GeoJSON files can't skip their attributes, but still stream
+        for _name in ('points.gpkg', 'points.geojson'):
+            _tmpdir = tempfile.TemporaryDirectory()
+            self.addCleanup(_tmpdir.cleanup)
+            _work_dir = _tmpdir.name
+            _vector.write(os.path.join(_work_dir, _name))
+            _labels = stream_cluster_points(
+                os.path.join(_work_dir, _name), 2000, chunk_size=700,
+                work_dir=_work_dir
+            )
+            self.assertEqual(_labels[3], -1)
+            self.assertTrue(np.array_equal(np.delete(_labels, 3), _expected))
+            self.assertEqual(sorted(os.listdir(_work_dir)),
+                             ['labels.npy', _name])
+
+class TestBenchmarks(unittest.TestCase):
+    def test_synthetic_points(self):
+        from benchmarks import synthetic_points
+        _points = synthetic_points(5000, density=0.5, cluster_size=50,
+                                   cluster_radius=10, seed=1)
+        self.assertEqual(len(_points), 5000)
+        self.assertEqual(_points.crs.to_epsg(), 2163)
+        self.assertTrue(_points.geom_equals(synthetic_points(
+            5000, density=0.5, cluster_size=50, cluster_radius=10, seed=1
+        )).all())
+        # ~100 tight clusters scattered over a 100 km square
+        _minx, _miny, _maxx, _maxy = _points.total_bounds
+        self.assertLess(max(_maxx - _minx, _maxy - _miny), 100100)
+
+    def test_run_case_joins_raw_buffers(self):
+        from benchmarks import run_case
+        _result = run_case('spatial_join', 2000, cluster_size=50)
+        # every point falls in (the dissolved union of) its own buffer
+        self.assertEqual(_result['n_results'], 2000)
+        self.assertTrue(_result['peak_rss_mb'] is None or
+                        _result['peak_rss_mb'] >= 0)
+
+    def test_compare_flags_regressions(self):
+        from benchmarks import compare
+        _baseline = {'results': [{'case': 'a', 'n': 10, 'seconds': 1.0},
+                                 {'case': 'b', 'n': 10, 'seconds': 1.0}]}
+        _results = {'results': [{'case': 'a', 'n': 10, 'seconds': 1.1},
+                                {'case': 'b', 'n': 10, 'seconds': 2.0},
+                                {'case': 'c', 'n': 10, 'seconds': 9.0}]}
+        self.assertEqual(compare(_results, _baseline, tolerance=0.2),
+                         [('b', 10, 2.0)])
+
+class TestDoGraph(unittest.TestCase):
+    def test_single_function(self):
+        from beatbox import Do
+        self.assertEqual(Do(this=divmod, that=[7, 2]).run(), (3, 1))
+
+        def _power(base, exponent=1):
+            return base ** exponent
+
+        self.assertEqual(Do(this=_power, that={'base': 2, 'exponent': 5})
+                         .run(), 32)
+        self.assertEqual(Do(this=_power, that=3).run(), 3)
+
+    def test_run_cannot_be_assigned(self):
+        from beatbox import Do
+        _do = Do(this=divmod, that=[7, 2])
+        with self.assertRaises(AttributeError):
+            _do.run = {'what': divmod, 'with': [9, 2]}
+        self.assertEqual(_do.run(), (3, 1))
+
+    def test_independent_steps_run_concurrently(self):
+        import threading
+        from beatbox import Do, Output
+        # both branches have to be running at once to pass the barrier
+        _barrier = threading.Barrier(2, timeout=10)
+
+        def _branch(x):
+            _barrier.wait()
+            return x * 2
+
+        _results = Do() \
+            .step('a', this=_branch, that=[1]) \
+            .step('b', this=_branch, that=[10]) \
+            .step('total', this=sum, that=[[Output('a'), Output('b')]]) \
+            .run(n_workers=2)
+        self.assertEqual(_results, {'total': 22})
+
+    def test_intermediates_are_freed(self):
+        import weakref
+        from beatbox import Do, Output
+
+        class _Intermediate(object):
+            pass
+
+        _refs = []
+
+        def _make():
+            _result = _Intermediate()
+            _refs.append(weakref.ref(_result))
+            return _result
+
+        def _check(intermediate):
+            return 'alive'
+
+        def _after(previous):
+            return _refs[0]() is None
+
+        _results = Do() \
+            .step('make', this=_make, that=[]) \
+            .step('check', this=_check, that=[Output('make')]) \
+            .step('after', this=_after, that=[Output('check')]) \
+            .run(n_workers=1)
+        self.assertEqual(_results, {'after': True})
+
+    def test_invalid_graphs(self):
+        from beatbox import Do, Output
+        with self.assertRaises(ValueError):
+            Do().step('a', this=len, that=[Output('b')]) \
+                .step('b', this=len, that=[Output('a')]).run()
+        with self.assertRaises(ValueError):
+            Do().step('a', this=len, that=[Output('missing')]).run()
+
 if __name__ == '__main__':
     unittest.main()